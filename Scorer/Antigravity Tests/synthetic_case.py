@@ -0,0 +1,126 @@
+"""
+Builders for a small synthetic CT series with an RTSTRUCT, used by the converter tests.
+"""
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+RTSTRUCT_STORAGE = '1.2.840.10008.5.1.4.1.1.481.3'
+
+ROWS, COLS = 16, 16
+SPACING = (1.5, 1.5)
+ORIGIN = (-12.0, -12.0)
+SLICE_ZS = [-5.0, -2.5, 0.0, 2.5, 5.0]
+
+
+def _base_dataset(sop_class_uid, study_uid, frame_uid, patient_id):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = sop_class_uid
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = sop_class_uid
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.PatientID = patient_id
+    ds.PatientName = patient_id
+    ds.PatientBirthDate = ''
+    ds.PatientSex = 'O'
+    ds.StudyInstanceUID = study_uid
+    ds.StudyDate = '20240101'
+    ds.StudyTime = '120000'
+    ds.StudyID = '1'
+    ds.AccessionNumber = ''
+    ds.ReferringPhysicianName = ''
+    ds.FrameOfReferenceUID = frame_uid
+    ds.Manufacturer = 'Synthetic'
+    return ds
+
+
+def make_case(directory, rois, patient_id="SynthPatient", slice_zs=SLICE_ZS):
+    """
+    Write a CT series and an RTSTRUCT into `directory`.
+
+    rois: {name: [(z, [(x, y), ...]), ...]} closed planar contours in patient coordinates (mm)
+    Returns: (series_instance_uid, rtstruct_path)
+    """
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+
+    ct_instances = []
+    for number, z in enumerate(slice_zs, start=1):
+        ds = _base_dataset(CT_IMAGE_STORAGE, study_uid, frame_uid, patient_id)
+        ds.Modality = 'CT'
+        ds.SeriesInstanceUID = series_uid
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = number
+        ds.ImagePositionPatient = [ORIGIN[0], ORIGIN[1], z]
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.PixelSpacing = [SPACING[1], SPACING[0]]
+        ds.SliceThickness = abs(slice_zs[1] - slice_zs[0]) if len(slice_zs) > 1 else 1.0
+        ds.Rows, ds.Columns = ROWS, COLS
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.RescaleIntercept = 0
+        ds.RescaleSlope = 1
+        ds.PixelData = np.zeros((ROWS, COLS), dtype=np.uint16).tobytes()
+        pydicom.dcmwrite(f"{directory}/CT_{number:03d}.dcm", ds, enforce_file_format=True)
+        ct_instances.append(ds)
+
+    rts = _base_dataset(RTSTRUCT_STORAGE, study_uid, frame_uid, patient_id)
+    rts.Modality = 'RTSTRUCT'
+    rts.SeriesInstanceUID = generate_uid()
+    rts.SeriesNumber = 2
+    rts.InstanceNumber = 1
+    rts.StructureSetLabel = 'Synthetic'
+
+    series_ref = Dataset()
+    series_ref.SeriesInstanceUID = series_uid
+    series_ref.ContourImageSequence = Sequence([])
+    for ct in ct_instances:
+        image_ref = Dataset()
+        image_ref.ReferencedSOPClassUID = ct.SOPClassUID
+        image_ref.ReferencedSOPInstanceUID = ct.SOPInstanceUID
+        series_ref.ContourImageSequence.append(image_ref)
+    study_ref = Dataset()
+    study_ref.ReferencedSOPClassUID = '1.2.840.10008.3.1.2.3.1'
+    study_ref.ReferencedSOPInstanceUID = study_uid
+    study_ref.RTReferencedSeriesSequence = Sequence([series_ref])
+    frame_ref = Dataset()
+    frame_ref.FrameOfReferenceUID = frame_uid
+    frame_ref.RTReferencedStudySequence = Sequence([study_ref])
+    rts.ReferencedFrameOfReferenceSequence = Sequence([frame_ref])
+
+    rts.StructureSetROISequence = Sequence([])
+    rts.ROIContourSequence = Sequence([])
+    for number, (name, contours) in enumerate(rois.items(), start=1):
+        roi = Dataset()
+        roi.ROINumber = number
+        roi.ReferencedFrameOfReferenceUID = frame_uid
+        roi.ROIName = name
+        rts.StructureSetROISequence.append(roi)
+
+        roi_contour = Dataset()
+        roi_contour.ReferencedROINumber = number
+        roi_contour.ContourSequence = Sequence([])
+        for z, points in contours:
+            contour = Dataset()
+            contour.ContourGeometricType = 'CLOSED_PLANAR'
+            contour.NumberOfContourPoints = len(points)
+            contour.ContourData = [float(v) for x, y in points for v in (x, y, z)]
+            roi_contour.ContourSequence.append(contour)
+        rts.ROIContourSequence.append(roi_contour)
+
+    rtstruct_path = f"{directory}/RTSTRUCT.dcm"
+    pydicom.dcmwrite(rtstruct_path, rts, enforce_file_format=True)
+    return series_uid, rtstruct_path
+
+
+def square(z, x0, y0, x1, y1):
+    """Closed square contour at height z."""
+    return z, [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
@@ -0,0 +1,95 @@
+"""
+Test the headless Step 2 batch mode (--job) on synthetic patient folders.
+"""
+import json
+
+import numpy as np
+
+from ingest import _load_step2
+from reference_format import load_reference
+from synthetic_case import make_case, square
+
+ROIS = {
+    "Heart": [square(0.0, -3, -3, 3, 3)],
+    "Lung_L": [square(-2.5, -9, -9, -6, -6)],
+    "Lung_R": [square(2.5, 6, 6, 9, 9)],
+}
+
+
+def write_job(tmp_path, workers):
+    for patient in ("PatientA", "PatientB"):
+        (tmp_path / patient).mkdir()
+        make_case(str(tmp_path / patient), ROIS, patient_id=patient)
+    job = {
+        "workers": workers,
+        "write_seg": False,
+        "header_cache": False,
+        "patients": [
+            {"folder": "PatientA", "rois": ["lung*"]},
+            "PatientB",
+            "Missing",
+        ],
+    }
+    job_path = tmp_path / "job.json"
+    job_path.write_text(json.dumps(job))
+    return job_path
+
+
+def test_batch_job(tmp_path):
+    step2 = _load_step2()
+    job_path = write_job(tmp_path, workers=2)
+
+    report = step2.run_batch(job_path)
+    assert (report["total"], report["completed"], report["failed"]) == (3, 3, 1)
+    assert json.loads((tmp_path / "job_report.json").read_text()) == report
+
+    a, b, missing = report["patients"]
+    assert sorted(c["structure_name"] for c in a["converted"]) == ["Lung_L", "Lung_R"]
+    assert sorted(c["structure_name"] for c in b["converted"]) == ["Heart", "Lung_L", "Lung_R"]
+    assert missing["status"] == "failed" and missing["error"]
+
+    indices, _ = load_reference(str(tmp_path / "References"), "PatientB", "Heart")
+    assert len(indices) == next(c["voxels"] for c in b["converted"] if c["structure_name"] == "Heart")
+
+    # A rerun finds every structure unchanged
+    rerun = step2.run_batch(job_path)
+    assert all(p["converted"] == [] for p in rerun["patients"][:2])
+    assert sorted(rerun["patients"][1]["unchanged"]) == ["Heart", "Lung_L", "Lung_R"]
+
+
+def test_batch_matches_sequential(tmp_path):
+    step2 = _load_step2()
+    (tmp_path / "par").mkdir()
+    (tmp_path / "seq").mkdir()
+    parallel = step2.run_batch(write_job(tmp_path / "par", workers=2))
+    sequential = step2.run_batch(write_job(tmp_path / "seq", workers=1))
+
+    for par, seq in zip(parallel["patients"], sequential["patients"]):
+        assert [(c["structure_name"], c["voxels"]) for c in par["converted"]] == \
+            [(c["structure_name"], c["voxels"]) for c in seq["converted"]]
+    for name in ROIS:
+        par_indices, _ = load_reference(str(tmp_path / "par" / "References"), "PatientB", name)
+        seq_indices, _ = load_reference(str(tmp_path / "seq" / "References"), "PatientB", name)
+        assert np.array_equal(par_indices, seq_indices)
+
+
+def test_batch_folders_of_one_patient(tmp_path):
+    # Two folders of the same patient, converted in parallel, update the same
+    # refs.json, manifest.json and conversion_hashes.json
+    step2 = _load_step2()
+    folders = {"Part1": ["Heart"], "Part2": ["Lung_L", "Lung_R"]}
+    for folder, names in folders.items():
+        (tmp_path / folder).mkdir()
+        make_case(str(tmp_path / folder), {name: ROIS[name] for name in names}, patient_id="PatientA")
+    job = {"workers": 2, "write_seg": False, "header_cache": False, "patients": list(folders)}
+    job_path = tmp_path / "job.json"
+    job_path.write_text(json.dumps(job))
+
+    report = step2.run_batch(job_path)
+    assert report["failed"] == 0
+
+    patient_dir = tmp_path / "References" / "PatientA"
+    expected = sorted(ROIS)
+    assert sorted(json.loads((patient_dir / "refs.json").read_text())["structures"]) == expected
+    assert sorted(json.loads((patient_dir / "manifest.json").read_text())["structures"]) == expected
+    assert sorted(step2.load_conversion_hashes(patient_dir)) == expected
@@ -0,0 +1,52 @@
+"""
+Test the even-odd slice fill against skimage.draw.polygon and on rings.
+"""
+import numpy as np
+import pytest
+
+from contour_fill import fill_slice, fill_slice_indices
+
+
+def circle(center, radius, points=64):
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    return np.c_[center[0] + radius * np.sin(angles), center[1] + radius * np.cos(angles)]
+
+
+def test_matches_skimage_polygon():
+    draw = pytest.importorskip("skimage.draw")
+    rng = np.random.default_rng(0)
+    for trial in range(600):
+        count = rng.integers(3, 12)
+        if trial % 2:
+            # Vertices on pixel centers and edges through them
+            points = rng.integers(-3, 25, size=(count, 2)).astype(float) * rng.choice([1, 0.5])
+        else:
+            points = rng.uniform(-5, 30, size=(count, 2))
+        shape = (int(rng.integers(1, 30)), int(rng.integers(1, 30)))
+
+        expected = np.zeros(shape, dtype=bool)
+        rr, cc = draw.polygon(points[:, 0], points[:, 1], shape=shape)
+        expected[rr, cc] = True
+        assert np.array_equal(fill_slice([points], shape), expected)
+
+
+def test_nested_contour_cuts_hole():
+    # Off-grid centers: no pixel center lies on either contour
+    outer, inner = circle((50.3, 50.7), 30.2), circle((50.3, 50.7), 14.6)
+    ring = fill_slice([outer, inner], (100, 100))
+    assert not ring[50, 50]
+    assert ring[50, 25] and ring[50, 75]
+    assert np.array_equal(ring, fill_slice([outer], (100, 100)) & ~fill_slice([inner], (100, 100)))
+
+    # The order of the contours does not matter
+    assert np.array_equal(ring, fill_slice([inner, outer], (100, 100)))
+
+
+def test_disjoint_contours_match_union():
+    contours = [circle((10, 10), 5), circle((30, 40), 7), circle((10, 45), 3)]
+    union = np.zeros((50, 60), dtype=bool)
+    for points in contours:
+        union |= fill_slice([points], (50, 60))
+    indices = fill_slice_indices(contours, (50, 60))
+    assert np.array_equal(indices, np.flatnonzero(union))
+    assert np.all(np.diff(indices) > 0)
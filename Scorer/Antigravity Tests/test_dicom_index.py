@@ -0,0 +1,80 @@
+"""
+Test the single-pass DICOM header index and its persistent cache.
+"""
+import os
+
+import pydicom
+
+from dicom_index import DicomIndex, HeaderCache
+from ingest import _load_step2
+from synthetic_case import make_case, square, SLICE_ZS
+
+
+def count_reads(monkeypatch):
+    reads = []
+    dcmread = pydicom.dcmread
+    monkeypatch.setattr(pydicom, "dcmread", lambda path, *args, **kwargs: reads.append(str(path)) or dcmread(path, *args, **kwargs))
+    return reads
+
+
+def test_index(tmp_path):
+    series_uid, rtstruct_path = make_case(str(tmp_path), {"Heart": [square(0.0, -3, -3, 3, 3)]})
+    (tmp_path / "notes.txt").write_text("not DICOM")
+
+    index = DicomIndex.build(tmp_path, threads=4)
+    assert len(index) == len(SLICE_ZS) + 1
+    assert [h.path for h in index.rtstructs()] == [rtstruct_path]
+    assert list(index.series()) == [series_uid]
+    assert sorted(h.position[2] for h in index.images('CT')) == SLICE_ZS
+    assert index.get(rtstruct_path).modality == 'RTSTRUCT'
+
+    sequential = DicomIndex.build(tmp_path, threads=1)
+    assert [h.path for h in sequential.headers] == [h.path for h in index.headers]
+
+
+def test_conversion_reads_each_header_once(tmp_path, monkeypatch):
+    _, rtstruct_path = make_case(str(tmp_path), {"Heart": [square(0.0, -3, -3, 3, 3)]})
+    step2 = _load_step2()
+
+    reads = count_reads(monkeypatch)
+
+    index = DicomIndex.build(tmp_path)
+    geometry = step2.load_reference_geometry(str(tmp_path), index=index)
+    converted = step2.process_rtstruct(rtstruct_path, str(tmp_path / "out"), write_seg=False,
+                                       reference_geometry=geometry, index=index)
+
+    assert converted[0]["structure_name"] == "Heart"
+    assert sorted(reads) == sorted(h.path for h in index.headers)
+
+
+def test_header_cache(tmp_path, monkeypatch):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), {"Heart": [square(0.0, -3, -3, 3, 3)]})
+    (case_dir / "notes.txt").write_text("not DICOM")
+    cache = HeaderCache(tmp_path / "headers.sqlite")
+
+    first = DicomIndex.build(case_dir, cache=cache)
+
+    # A rerun on the unchanged folder parses nothing, not even the non-DICOM file
+    reads = count_reads(monkeypatch)
+    second = DicomIndex.build(case_dir, cache=HeaderCache(tmp_path / "headers.sqlite"))
+    assert reads == []
+    assert [h.fields() for h in second.headers] == [h.fields() for h in first.headers]
+
+    # A changed file is parsed again
+    ct_path = second.images('CT')[0].path
+    stat = os.stat(ct_path)
+    os.utime(ct_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+    DicomIndex.build(case_dir, cache=cache)
+    assert reads == [ct_path]
+
+    # Cached headers still convert; only the RTSTRUCT needs its dataset
+    reads.clear()
+    step2 = _load_step2()
+    index = DicomIndex.build(case_dir, cache=cache)
+    geometry = step2.load_reference_geometry(str(case_dir), index=index)
+    converted = step2.process_rtstruct(rtstruct_path, str(tmp_path / "out"), write_seg=False,
+                                       reference_geometry=geometry, index=index)
+    assert converted[0]["structure_name"] == "Heart"
+    assert rtstruct_path in reads
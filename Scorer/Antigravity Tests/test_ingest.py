@@ -0,0 +1,116 @@
+"""
+Test the reference ingestion endpoint: authenticated upload, background conversion, publication.
+"""
+import io
+import time
+import zipfile
+
+import numpy as np
+
+from synthetic_case import make_case, square
+from test_seg_indices import make_seg, ROWS as SEG_ROWS, COLS as SEG_COLS
+
+TOKEN = "secret"
+
+
+def wait_for_job(client, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f'/references/ingest/{job_id}', headers={"Authorization": f"Bearer {TOKEN}"}).get_json()
+        if job["status"] in ("done", "failed"):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish")
+
+
+def setup_app(monkeypatch, references_dir):
+    import app as scorer_app
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(references_dir))
+    monkeypatch.setattr(scorer_app, "INGEST_TOKEN", TOKEN)
+    monkeypatch.setattr(scorer_app, "reference_pack", None)
+    monkeypatch.setattr(scorer_app, "reference_manifests", {})
+    monkeypatch.setattr(scorer_app.ingestion_queue, "references_dir", str(references_dir))
+    return scorer_app
+
+
+def test_ingest_rtstruct_archive(tmp_path, monkeypatch):
+    scorer_app = setup_app(monkeypatch, tmp_path / "References")
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    make_case(str(case_dir), {"Heart": [square(0.0, -3, -3, 3, 3)], "Lung": [square(2.5, -9, -9, -6, -6)]})
+
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as z:
+        for path in case_dir.iterdir():
+            z.write(path, f"case/{path.name}")
+    archive.seek(0)
+
+    client = scorer_app.app.test_client()
+    unauthorized = client.post('/references/ingest', data={"file": (io.BytesIO(b"x"), "case.zip")},
+                               content_type='multipart/form-data')
+    assert unauthorized.status_code == 401
+
+    response = client.post('/references/ingest', data={"file": (archive, "case.zip"), "structures": "Heart"},
+                           headers={"Authorization": f"Bearer {TOKEN}"}, content_type='multipart/form-data')
+    assert response.status_code == 202
+    job = wait_for_job(client, response.get_json()["job_id"])
+    assert job["status"] == "done", job["error"]
+    assert [r["structure_name"] for r in job["references"]] == ["Heart"]
+
+    # Live without a restart: the new reference grades immediately
+    ref_indices, _, version = scorer_app.load_reference("SynthPatient", "Heart")
+    assert version == job["references"][0]["reference_version"]
+    graded = client.post('/grade_submission', json={
+        "patient_id": "SynthPatient", "structure_name": "Heart",
+        "non_zero_indices": ref_indices.tolist(), "origin_slice_index": 0,
+    }).get_json()
+    assert graded["dice_score"] == 1.0
+
+
+def test_ingest_seg_with_slice_positions(tmp_path, monkeypatch):
+    scorer_app = setup_app(monkeypatch, tmp_path / "References")
+    mask = np.zeros((SEG_ROWS, SEG_COLS), dtype=bool)
+    mask[4:6, 4:6] = True
+
+    client = scorer_app.app.test_client()
+    response = client.post('/references/ingest', data={
+        "file": (io.BytesIO(make_seg([(2.5, 1, mask)])), "seg.dcm"),
+        "slice_positions": "[0.0, 2.5, 5.0]",
+    }, headers={"Authorization": f"Bearer {TOKEN}"}, content_type='multipart/form-data')
+    assert response.status_code == 202
+
+    job = wait_for_job(client, response.get_json()["job_id"])
+    assert job["status"] == "done", job["error"]
+    assert job["references"][0]["voxel_count"] == 4
+
+
+def test_ingest_rejects_oversized_uploads(tmp_path, monkeypatch):
+    scorer_app = setup_app(monkeypatch, tmp_path / "References")
+    client = scorer_app.app.test_client()
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+
+    def post(data):
+        return client.post('/references/ingest', headers=headers, content_type='multipart/form-data',
+                           data={"file": (io.BytesIO(data), "case.zip")})
+
+    # A highly compressible member: small upload, large unpacked size
+    bomb = io.BytesIO()
+    with zipfile.ZipFile(bomb, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr("case/ct.dcm", b"\0" * (2 * 1024 * 1024))
+    monkeypatch.setattr(scorer_app.ingestion_queue, "max_archive_bytes", 1024 * 1024)
+    response = post(bomb.getvalue())
+    assert response.status_code == 400 and "unpacks to" in response.get_json()["error"]
+
+    many = io.BytesIO()
+    with zipfile.ZipFile(many, 'w') as z:
+        for i in range(5):
+            z.writestr(f"case/{i}.dcm", b"x")
+    monkeypatch.setattr(scorer_app.ingestion_queue, "max_archive_files", 4)
+    response = post(many.getvalue())
+    assert response.status_code == 400 and "5 files" in response.get_json()["error"]
+
+    # Over the request size limit before anything is staged
+    monkeypatch.setitem(scorer_app.app.config, "MAX_CONTENT_LENGTH", 1024)
+    response = post(b"\0" * 4096)
+    assert response.status_code == 413
+    assert "error" in response.get_json()
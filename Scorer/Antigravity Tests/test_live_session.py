@@ -0,0 +1,122 @@
+"""
+Tests for incremental live-scoring sessions.
+Slice deltas must produce the same Dice as a full-volume comparison.
+"""
+import numpy as np
+import pytest
+from scorer import dice_score, reconstruct_mask
+from live_session import LiveSession, LiveSessionStore
+
+SHAPE = (6, 8, 8)
+SLICE_SIZE = SHAPE[1] * SHAPE[2]
+
+
+def full_dice(ref_indices, user_slices):
+    user_indices = [z * SLICE_SIZE + i for z, idx in user_slices.items() for i in idx]
+    return dice_score(reconstruct_mask(ref_indices, 0, SHAPE), reconstruct_mask(user_indices, 0, SHAPE))
+
+
+def test_slice_deltas_match_full_dice():
+    ref_indices = [1 * SLICE_SIZE + i for i in range(10, 20)] + [2 * SLICE_SIZE + i for i in range(5, 15)]
+    session = LiveSession("s", "P", "Heart", ref_indices, SLICE_SIZE)
+    assert session.dice() == 0.0
+
+    user_slices = {1: list(range(12, 22))}
+    session.apply_slice(1, user_slices[1])
+    assert abs(session.dice() - full_dice(ref_indices, user_slices)) < 1e-9
+
+    # Replacing a slice must not double count it
+    user_slices[1] = list(range(10, 20))
+    session.apply_slice(1, user_slices[1])
+    user_slices[4] = [0, 1, 2]
+    session.apply_slice(4, user_slices[4])
+    assert abs(session.dice() - full_dice(ref_indices, user_slices)) < 1e-9
+
+    # Clearing a slice removes its contribution
+    del user_slices[4]
+    session.apply_slice(4, [])
+    user_slices[2] = list(range(5, 15))
+    session.apply_slice(2, user_slices[2])
+    assert session.dice() == 1.0
+
+
+def test_store_rle_and_ttl_eviction():
+    now = [0.0]
+    store = LiveSessionStore(ttl_seconds=10, clock=lambda: now[0])
+    session = store.open("P", "Heart", [3 * SLICE_SIZE + 4, 3 * SLICE_SIZE + 5], SLICE_SIZE)
+
+    store.apply_slices(session.session_id, [{"slice_index": 3, "rle": [4, 2]}])
+    assert session.dice() == 1.0
+
+    now[0] = 11.0
+    assert store.get(session.session_id) is None
+    assert len(store) == 0
+
+
+def test_store_memory_cap_evicts_least_recent():
+    ref_indices = np.arange(SLICE_SIZE)
+    probe = LiveSession("probe", "P", "Heart", ref_indices, SLICE_SIZE)
+    store = LiveSessionStore(max_bytes=2 * probe.nbytes())
+
+    first = store.open("P", "Heart", ref_indices, SLICE_SIZE)
+    second = store.open("P", "Heart", ref_indices, SLICE_SIZE)
+    store.get(first.session_id)
+    third = store.open("P", "Heart", ref_indices, SLICE_SIZE)
+
+    assert store.get(second.session_id) is None
+    assert store.get(first.session_id) is first
+    assert store.get(third.session_id) is third
+
+
+def test_slices_outside_volume():
+    # Reference voxels past the last slice are ignored, as in the final score
+    ref_indices = [1 * SLICE_SIZE + i for i in range(10, 20)] + [SHAPE[0] * SLICE_SIZE + 3, -1]
+    session = LiveSession("s", "P", "Heart", ref_indices, SLICE_SIZE, depth=SHAPE[0])
+    user_slices = {1: list(range(10, 20))}
+    session.apply_slice(1, user_slices[1])
+    assert session.dice() == 1.0
+    assert abs(session.dice() - full_dice(ref_indices, user_slices)) < 1e-9
+
+    with pytest.raises(ValueError):
+        session.apply_slice(SHAPE[0], [0])
+    store = LiveSessionStore()
+    opened = store.open("P", "Heart", ref_indices, SLICE_SIZE, depth=SHAPE[0])
+    with pytest.raises(ValueError):
+        store.apply_slices(opened.session_id, [{"slice_index": 1, "indices": [10]},
+                                               {"slice_index": SHAPE[0], "indices": [0]}])
+    # The batch is rejected as a whole
+    assert opened.user_volume == 0
+
+
+def test_store_keeps_running_byte_total():
+    now = [0.0]
+    store = LiveSessionStore(ttl_seconds=10, clock=lambda: now[0])
+    ref_indices = [1 * SLICE_SIZE + i for i in range(10, 20)]
+    first = store.open("P", "Heart", ref_indices, SLICE_SIZE)
+    now[0] = 5.0
+    second = store.open("P", "Heart", ref_indices, SLICE_SIZE)
+
+    def recomputed(session):
+        return sum(a.nbytes for a in list(session.ref_slices.values()) + list(session.user_slices.values()))
+
+    store.apply_slices(second.session_id, [{"slice_index": 1, "indices": list(range(30))},
+                                           {"slice_index": 2, "rle": [0, 5]}])
+    store.apply_slices(second.session_id, [{"slice_index": 1, "indices": [3]}, {"slice_index": 2, "indices": []}])
+    assert second.nbytes() == recomputed(second)
+    assert store._bytes == first.nbytes() + second.nbytes()
+
+    # The first session expires, the second is closed
+    now[0] = 12.0
+    assert store.get(first.session_id) is None
+    assert store._bytes == second.nbytes()
+    assert store.close(second.session_id)
+    assert store._bytes == 0
+
+
+if __name__ == "__main__":
+    test_slice_deltas_match_full_dice()
+    test_store_rle_and_ttl_eviction()
+    test_store_memory_cap_evicts_least_recent()
+    test_slices_outside_volume()
+    test_store_keeps_running_byte_total()
+    print("ALL TESTS PASSED!")
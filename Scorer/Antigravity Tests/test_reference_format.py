@@ -0,0 +1,65 @@
+"""
+Test the binary reference format and its JSON fallback.
+"""
+import json
+import os
+import numpy as np
+from reference_format import (
+    write_binary_reference, read_binary_reference, load_reference,
+    convert_json_references, encode_varint_deltas, decode_varint_deltas,
+)
+
+
+def test_varint_round_trip():
+    indices = np.array([0, 1, 127, 128, 16383, 16384, 2**21, 2**28 + 5, 2**32 - 1], dtype=np.uint32)
+    encoded = encode_varint_deltas(indices)
+    assert decode_varint_deltas(encoded, len(indices)).tolist() == indices.tolist()
+
+
+def test_binary_round_trip(tmp_path):
+    indices = [512 * 512 * 40 + 7, 3, 3, 99]
+
+    raw_path = tmp_path / "raw.ref"
+    write_binary_reference(raw_path, indices, origin_slice_index=28)
+    loaded, origin = read_binary_reference(raw_path)
+    assert isinstance(loaded, np.memmap)
+    assert loaded.tolist() == [3, 99, 512 * 512 * 40 + 7]
+    assert origin == 28
+
+    packed_path = tmp_path / "packed.ref"
+    write_binary_reference(packed_path, indices, compress=True)
+    assert read_binary_reference(packed_path)[0].tolist() == [3, 99, 512 * 512 * 40 + 7]
+    assert packed_path.stat().st_size < raw_path.stat().st_size
+
+
+def test_load_prefers_binary_and_falls_back_to_json(tmp_path):
+    patient_dir = tmp_path / "P1"
+    patient_dir.mkdir()
+    with open(patient_dir / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [5, 6], "origin_slice_index": 0}, f)
+
+    indices, _ = load_reference(tmp_path, "P1", "Heart")
+    assert list(indices) == [5, 6]
+
+    assert convert_json_references(tmp_path) == 1
+    indices, _ = load_reference(tmp_path, "P1", "Heart")
+    assert isinstance(indices, np.ndarray)
+    assert indices.tolist() == [5, 6]
+
+
+def test_json_edited_after_binary(tmp_path):
+    patient_dir = tmp_path / "P1"
+    patient_dir.mkdir()
+    write_binary_reference(patient_dir / "Heart.ref", [5, 6])
+    with open(patient_dir / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [5, 6, 7], "origin_slice_index": 0}, f)
+
+    # The hand-edited JSON wins until the binary reference is regenerated
+    os.utime(patient_dir / "Heart.ref", (1000, 1000))
+    indices, _ = load_reference(tmp_path, "P1", "Heart")
+    assert list(indices) == [5, 6, 7]
+
+    convert_json_references(tmp_path)
+    indices, _ = load_reference(tmp_path, "P1", "Heart")
+    assert isinstance(indices, np.ndarray)
+    assert indices.tolist() == [5, 6, 7]
@@ -0,0 +1,87 @@
+"""
+Test reference manifests and bounding-box cropped scoring.
+"""
+import json
+
+import numpy as np
+import pytest
+from scorer import cropped_dice_score, sparse_dice_score, load_volume_geometry
+from reference_manifest import update_manifest, load_manifests, get_structure_stats, make_geometry, content_hash
+from reference_store import reference_version
+
+
+def test_structure_stats_and_geometry(tmp_path):
+    patient_dir = tmp_path / "P1"
+    patient_dir.mkdir()
+    rows, cols = 4, 5
+    # (z=2, y=1, x=3), (z=2, y=3, x=0), (z=5, y=0, x=4)
+    indices = [2 * 20 + 1 * 5 + 3, 2 * 20 + 3 * 5 + 0, 5 * 20 + 0 * 5 + 4]
+    update_manifest(patient_dir, "Heart", indices, make_geometry([0.0, 1.0], (rows, cols)))
+
+    manifests = load_manifests(tmp_path)
+    stats = get_structure_stats(manifests, "P1", "Heart")
+    assert stats["voxel_count"] == 3
+    assert stats["bounding_box"] == {"z": [2, 5], "y": [0, 3], "x": [0, 4]}
+    assert stats["slice_counts"] == {"2": 2, "5": 1}
+    assert stats["content_hash"] == content_hash(list(reversed(indices)))
+    assert stats["version"] == reference_version(indices, 0)
+
+    assert load_volume_geometry(tmp_path, "P1")["rows"] == rows
+    assert get_structure_stats(manifests, "P2", "Heart") is None
+    try:
+        get_structure_stats(manifests, "P1", "Lung")
+        assert False, "Unknown structure should be rejected"
+    except FileNotFoundError:
+        pass
+
+
+def test_cropped_dice_matches_sparse_dice():
+    shape = (20, 16, 16)
+    rng = np.random.RandomState(0)
+    ref = rng.randint(0, np.prod(shape), 300)
+    user = np.concatenate([ref[:150], rng.randint(-10, np.prod(shape) + 10, 200)])
+
+    z, rem = ref // 256, ref % 256
+    bbox = {"z": [int(z.min()), int(z.max())],
+            "y": [int((rem // 16).min()), int((rem // 16).max())],
+            "x": [int((rem % 16).min()), int((rem % 16).max())]}
+
+    assert abs(cropped_dice_score(ref, user, bbox, shape) - sparse_dice_score(ref, user, shape)) < 1e-12
+
+    # Duplicates, and a bounding box that no longer covers the reference
+    duplicated = np.concatenate([ref, ref[:50]])
+    assert abs(cropped_dice_score(duplicated, np.concatenate([user, user[:20]]), bbox, shape)
+               - sparse_dice_score(ref, user, shape)) < 1e-12
+    stale = {"z": bbox["z"], "y": [bbox["y"][0] + 1, bbox["y"][1]], "x": bbox["x"]}
+    assert abs(cropped_dice_score(ref, user, stale, shape) - sparse_dice_score(ref, user, shape)) < 1e-12
+
+
+def test_grading_with_stale_manifest(tmp_path, monkeypatch):
+    import app as scorer_app
+
+    patient_dir = tmp_path / "P1"
+    patient_dir.mkdir()
+    slice_size = 512 * 512
+    old = [slice_size + 10, slice_size + 11]
+    update_manifest(patient_dir, "Heart", old, make_geometry([0.0, 1.0, 2.0], (512, 512)))
+
+    # The reference changes on disk after the server read the manifests
+    manifests = load_manifests(tmp_path)
+    current = old + [2 * slice_size + 300]
+    with open(patient_dir / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": current, "origin_slice_index": 0}, f)
+    with open(patient_dir / "Lung.json", 'w') as f:
+        json.dump({"non_zero_indices": [5], "origin_slice_index": 0}, f)
+
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(tmp_path))
+    monkeypatch.setattr(scorer_app, "reference_pack", None)
+    monkeypatch.setattr(scorer_app, "reference_manifests", manifests)
+    client = scorer_app.app.test_client()
+
+    body = {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": current, "origin_slice_index": 0}
+    assert client.post('/grade_submission', json=body).get_json()["dice_score"] == 1.0
+
+    # A structure missing from the manifest is graded from its file
+    response = client.post('/grade_submission', json=dict(body, structure_name="Lung", non_zero_indices=[5]))
+    assert response.status_code == 200
+    assert response.get_json()["dice_score"] == pytest.approx(1.0)
@@ -0,0 +1,45 @@
+"""
+Test the per-slice run-length reference overlay and its negotiation in /grade_submission.
+"""
+import json
+import numpy as np
+
+from scorer import encode_slice_runs, decode_slice_mask
+
+SLICE_SIZE = 64
+
+
+def test_runs_round_trip():
+    rng = np.random.default_rng(0)
+    indices = np.unique(rng.integers(0, 5 * SLICE_SIZE, 150))
+    # Runs that touch a slice boundary must be split there
+    indices = np.union1d(indices, [SLICE_SIZE - 2, SLICE_SIZE - 1, SLICE_SIZE, SLICE_SIZE + 1])
+
+    slices = encode_slice_runs(indices, SLICE_SIZE)
+    decoded = np.concatenate([decode_slice_mask(s, SLICE_SIZE) + s["slice_index"] * SLICE_SIZE for s in slices])
+    assert decoded.tolist() == indices.tolist()
+    assert [s["slice_index"] for s in slices] == sorted({int(i) // SLICE_SIZE for i in indices})
+    assert encode_slice_runs([], SLICE_SIZE) == []
+
+
+def test_grade_submission_rle_overlay(tmp_path, monkeypatch):
+    import app as scorer_app
+
+    (tmp_path / "P1").mkdir()
+    ref = list(range(1000, 1200))
+    with open(tmp_path / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": ref, "origin_slice_index": 0}, f)
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(tmp_path))
+    monkeypatch.setattr(scorer_app, "reference_pack", None)
+    monkeypatch.setattr(scorer_app, "reference_manifests", {})
+
+    client = scorer_app.app.test_client()
+    body = {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": ref, "origin_slice_index": 0,
+            "reference_format": "rle"}
+    result = client.post('/grade_submission', json=body).get_json()
+    overlay = result["reference_data"]
+    assert overlay["format"] == "rle"
+    assert overlay["slices"] == [{"slice_index": 0, "rle": [1000, 200]}]
+
+    bad = client.post('/grade_submission', json=dict(body, reference_format="png"))
+    assert bad.status_code == 400
@@ -0,0 +1,83 @@
+"""
+Test building and reading a single-file reference pack.
+"""
+import io
+import json
+import numpy as np
+import pytest
+from reference_format import write_binary_reference
+from reference_manifest import update_manifest, make_geometry
+from reference_pack import build_pack, ReferencePack
+from test_seg_indices import make_seg, ROWS, COLS, SLICE_POSITIONS
+
+
+def make_references(root):
+    (root / "P1").mkdir(parents=True)
+    (root / "P 2").mkdir()
+    with open(root / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [9, 4, 7], "origin_slice_index": 0}, f)
+    with open(root / "P1" / "geometry.json", 'w') as f:
+        json.dump({"slice_positions": [0.0], "rows": 8, "columns": 8}, f)
+    write_binary_reference(root / "P 2" / "Spinal-Cord.ref", [100, 200], origin_slice_index=3)
+
+
+def test_pack_lookup(tmp_path):
+    make_references(tmp_path / "References")
+    pack_path = tmp_path / "References.pack"
+    assert build_pack(tmp_path / "References", pack_path) == 2
+
+    pack = ReferencePack(pack_path)
+    assert sorted(pack.keys()) == [("P 2", "Spinal-Cord"), ("P1", "Heart")]
+    assert ("P1", "geometry") not in pack
+
+    indices, origin = pack.lookup("P1", "Heart")
+    assert indices.tolist() == [4, 7, 9]
+    indices, origin = pack.lookup("P 2", "Spinal-Cord")
+    assert (indices.tolist(), origin) == ([100, 200], 3)
+
+    with pytest.raises(FileNotFoundError):
+        pack.lookup("P1", "Lung")
+
+
+def test_pack_checksum_mismatch(tmp_path):
+    make_references(tmp_path / "References")
+    pack_path = tmp_path / "References.pack"
+    build_pack(tmp_path / "References", pack_path)
+
+    offset = ReferencePack(pack_path).entry("P1", "Heart")["offset"]
+    data = bytearray(pack_path.read_bytes())
+    data[offset + 40] ^= 0xFF
+    pack_path.write_bytes(bytes(data))
+
+    with pytest.raises(ValueError):
+        ReferencePack(pack_path).lookup("P1", "Heart")
+
+
+def test_grade_seg_from_pack(tmp_path, monkeypatch):
+    import app as scorer_app
+
+    mask = np.zeros((ROWS, COLS), dtype=bool)
+    mask[2:5, 3:6] = True
+    source = tmp_path / "source"
+    (source / "P1").mkdir(parents=True)
+    indices = (np.flatnonzero(mask) + 2 * ROWS * COLS).tolist()
+    write_binary_reference(source / "P1" / "Heart.ref", indices)
+    update_manifest(source / "P1", "Heart", indices, make_geometry(SLICE_POSITIONS, (ROWS, COLS)))
+    pack_path = tmp_path / "References.pack"
+    build_pack(source, pack_path)
+
+    # Only the pack ships; the References folder is empty
+    (tmp_path / "References").mkdir()
+    pack = ReferencePack(pack_path)
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(tmp_path / "References"))
+    monkeypatch.setattr(scorer_app, "reference_pack", pack)
+    monkeypatch.setattr(scorer_app, "reference_manifests", dict(pack.manifests))
+
+    response = scorer_app.app.test_client().post('/grade_seg', data={
+        "file": (io.BytesIO(make_seg([(SLICE_POSITIONS[2], 1, mask)])), "seg.dcm"),
+        "patient_id": "P1",
+        "structure_name": "Heart",
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.get_json()["dice_score"] == 1.0
@@ -0,0 +1,140 @@
+"""
+Test tiered reference resolution against a local HTTP stand-in for Orthanc's DICOMweb API.
+"""
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+import pytest
+
+from reference_resolver import TieredReferenceResolver, OrthancSegSource, KEY_LOCK_STRIPES
+from reference_store import load_current_reference, resolve_version
+from test_seg_indices import make_seg, ROWS, COLS, SLICE_POSITIONS
+
+STUDY, SEG_SERIES, CT_SERIES, SOP = "1.2.3", "1.2.3.4", "1.2.3.5", "1.2.3.4.1"
+
+
+def start_orthanc_stub(seg_bytes, requests_seen):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _json(self, body):
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/dicom+json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            requests_seen.append(url.path)
+            if url.path == '/dicom-web/series':
+                query = parse_qs(url.query)
+                if query.get('PatientID') != ['P1'] or query.get('Modality') != ['SEG']:
+                    return self._json([])
+                return self._json([{
+                    "0020000D": {"vr": "UI", "Value": [STUDY]},
+                    "0020000E": {"vr": "UI", "Value": [SEG_SERIES]},
+                    "0008103E": {"vr": "LO", "Value": ["Heart"]},
+                }])
+            if url.path == f'/dicom-web/studies/{STUDY}/series/{SEG_SERIES}/instances':
+                return self._json([{"00080018": {"vr": "UI", "Value": [SOP]}}])
+            if url.path == f'/dicom-web/studies/{STUDY}/series/{CT_SERIES}/metadata':
+                return self._json([{
+                    "00200032": {"vr": "DS", "Value": [0.0, 0.0, z]},
+                    "00280010": {"vr": "US", "Value": [ROWS]},
+                    "00280011": {"vr": "US", "Value": [COLS]},
+                } for z in SLICE_POSITIONS])
+            if url.path == f'/dicom-web/studies/{STUDY}/series/{SEG_SERIES}/instances/{SOP}':
+                body = (b'--BOUNDARY\r\nContent-Type: application/dicom\r\n\r\n'
+                        + seg_bytes + b'\r\n--BOUNDARY--\r\n')
+                self.send_response(200)
+                self.send_header('Content-Type', 'multipart/related; type="application/dicom"; boundary=BOUNDARY')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(404)
+            self.end_headers()
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def orthanc(tmp_path):
+    mask = np.zeros((ROWS, COLS), dtype=bool)
+    mask[2:4, 3:6] = True
+    requests_seen = []
+    server = start_orthanc_stub(make_seg([(5.0, 1, mask)], referenced_series_uid=CT_SERIES), requests_seen)
+    expected = (np.flatnonzero(mask) + 2 * ROWS * COLS).tolist()
+    yield f"http://127.0.0.1:{server.server_port}/dicom-web", expected, requests_seen
+    server.shutdown()
+
+
+def test_fetch_from_orthanc_and_write_back(tmp_path, orthanc):
+    url, expected, requests_seen = orthanc
+    references_dir = str(tmp_path)
+    manifests = {}
+    resolver = TieredReferenceResolver(
+        lambda p, s: resolve_version(references_dir, p, s),
+        lambda p, s: load_current_reference(references_dir, p, s),
+        references_dir,
+        remote=OrthancSegSource(url),
+        manifests=manifests,
+    )
+
+    indices, origin, version = resolver.resolve("P1", "Heart")
+    assert indices.tolist() == expected
+    assert resolver.stats["remote"] == 1
+
+    # Written back to the local tier with the geometry of the CT series
+    assert resolve_version(references_dir, "P1", "Heart") == version
+    assert manifests["P1"]["geometry"]["slice_positions"] == SLICE_POSITIONS
+
+    # Second lookup is served from memory without contacting Orthanc
+    fetches = len(requests_seen)
+    assert resolver.resolve("P1", "Heart")[2] == version
+    assert resolver.stats["memory"] == 1
+    assert len(requests_seen) == fetches
+
+    with pytest.raises(FileNotFoundError):
+        resolver.resolve("P1", "Lung")
+
+
+def test_legacy_references_are_cached(tmp_path):
+    references_dir = str(tmp_path)
+    (tmp_path / "P1").mkdir()
+    heart_path = tmp_path / "P1" / "Heart.json"
+    heart_path.write_text(json.dumps({"non_zero_indices": [1, 2, 3], "origin_slice_index": 0}))
+
+    loads = []
+    def load_local(p, s):
+        loads.append((p, s))
+        return load_current_reference(references_dir, p, s)
+
+    resolver = TieredReferenceResolver(lambda p, s: resolve_version(references_dir, p, s), load_local, references_dir)
+
+    # No refs.json: the cache is keyed by the file's modification time
+    assert resolver.resolve("P1", "Heart")[0] == [1, 2, 3]
+    assert resolver.resolve("P1", "Heart")[0] == [1, 2, 3]
+    assert (len(loads), resolver.stats["memory"]) == (1, 1)
+
+    # An edited file is read again
+    heart_path.write_text(json.dumps({"non_zero_indices": [1, 2], "origin_slice_index": 0}))
+    stat = heart_path.stat()
+    os.utime(heart_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert resolver.resolve("P1", "Heart")[0] == [1, 2]
+    assert len(loads) == 2
+
+    # Names clients send do not grow the lock table
+    for i in range(200):
+        with pytest.raises(FileNotFoundError):
+            resolver.resolve("P1", f"Missing{i}")
+    assert len(resolver._key_locks) == KEY_LOCK_STRIPES
@@ -0,0 +1,127 @@
+"""
+Test the content-addressed reference store and versioned grading.
+"""
+import json
+import os
+import threading
+import pytest
+
+from reference_store import (
+    store_reference, resolve_version, list_versions, load_version,
+    load_current_reference, reference_version, patient_lock, LOCK_NAME, store_edited_references,
+)
+
+
+def test_store_versions(tmp_path):
+    v1 = store_reference(tmp_path, "P1", "Heart", [5, 1, 3], 0)
+    assert v1 == reference_version([1, 3, 5], 0)
+    assert store_reference(tmp_path, "P1", "Heart", [1, 3, 5], 0) == v1
+    assert len(list_versions(tmp_path, "P1", "Heart")) == 1
+
+    v2 = store_reference(tmp_path, "P1", "Heart", [1, 3], 0)
+    assert v2 != v1
+    assert resolve_version(tmp_path, "P1", "Heart") == v2
+    assert [v["version"] for v in list_versions(tmp_path, "P1", "Heart")] == [v1, v2]
+
+    # The old version stays addressable
+    indices, origin = load_version(tmp_path, v1)
+    assert indices.tolist() == [1, 3, 5]
+    assert origin == 0
+
+    indices, _, version = load_current_reference(tmp_path, "P1", "Heart")
+    assert indices.tolist() == [1, 3]
+    assert version == v2
+
+    with pytest.raises(FileNotFoundError):
+        load_version(tmp_path, "../P1/refs")
+
+
+def test_legacy_reference_version(tmp_path):
+    (tmp_path / "P1").mkdir()
+    with open(tmp_path / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [1, 3, 5], "origin_slice_index": 0}, f)
+
+    _, _, version = load_current_reference(tmp_path, "P1", "Heart")
+    assert version == reference_version([1, 3, 5], 0)
+
+
+def test_grade_against_version(tmp_path, monkeypatch):
+    import app as scorer_app
+
+    v1 = store_reference(tmp_path, "P1", "Heart", [1, 2, 3, 4], 0)
+    v2 = store_reference(tmp_path, "P1", "Heart", [1, 2], 0)
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(tmp_path))
+    monkeypatch.setattr(scorer_app, "reference_pack", None)
+    monkeypatch.setattr(scorer_app, "reference_manifests", {})
+
+    client = scorer_app.app.test_client()
+    body = {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0}
+
+    current = client.post('/grade_submission', json=body).get_json()
+    assert current["reference_version"] == v2
+    assert current["dice_score"] == pytest.approx(2 / 3)
+
+    pinned = client.post('/grade_submission', json=dict(body, reference_version=v1)).get_json()
+    assert pinned["reference_version"] == v1
+    assert pinned["dice_score"] == 1.0
+
+    missing = client.post('/grade_submission', json=dict(body, reference_version="0" * 64))
+    assert missing.status_code == 404
+
+
+def test_edited_in_place_reference_is_stored(tmp_path):
+    (tmp_path / "P1").mkdir()
+    v1 = store_reference(tmp_path, "P1", "Heart", [1, 2, 3], 0)
+    store_reference(tmp_path, "P1", "Lung", [7, 8], 0)
+    os.utime(tmp_path / "P1" / "refs.json", (1000, 1000))
+
+    # Hand-corrected JSONs, newer than the pointer
+    with open(tmp_path / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0}, f)
+    with open(tmp_path / "P1" / "Lung.json", 'w') as f:
+        json.dump({"non_zero_indices": [7, 8, 9], "origin_slice_index": 0}, f)
+
+    # Reads never store a version
+    assert resolve_version(tmp_path, "P1", "Heart") == v1
+    assert load_current_reference(tmp_path, "P1", "Heart")[2] == v1
+
+    assert store_edited_references(tmp_path) == 2
+    indices, _, version = load_current_reference(tmp_path, "P1", "Heart")
+    assert indices.tolist() == [1, 2, 3, 4]
+    assert version == reference_version([1, 2, 3, 4], 0)
+    assert [v["version"] for v in list_versions(tmp_path, "P1", "Heart")] == [v1, version]
+    assert resolve_version(tmp_path, "P1", "Lung") == reference_version([7, 8, 9], 0)
+
+    # Rewritten with the stored content: nothing new is stored
+    os.utime(tmp_path / "P1" / "refs.json", (1000, 1000))
+    with open(tmp_path / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0}, f)
+    assert store_edited_references(tmp_path) == 0
+    assert resolve_version(tmp_path, "P1", "Heart") == version
+    assert len(list_versions(tmp_path, "P1", "Heart")) == 2
+
+
+def test_patient_lock(tmp_path):
+    patient_dir = str(tmp_path / "P1")
+    # A lock file left behind by a crashed process does not block
+    os.makedirs(patient_dir)
+    (tmp_path / "P1" / LOCK_NAME).write_text("12345")
+    errors = []
+
+    def contend():
+        try:
+            with patient_lock(patient_dir, timeout=0.2):
+                pass
+        except TimeoutError as e:
+            errors.append(e)
+
+    with patient_lock(patient_dir):
+        # Re-entrant in the holding thread (store_reference takes it again), exclusive for the others
+        store_reference(tmp_path, "P1", "Heart", [1, 2], 0)
+        thread = threading.Thread(target=contend)
+        thread.start()
+        thread.join()
+    assert len(errors) == 1
+
+    contend()
+    assert len(errors) == 1
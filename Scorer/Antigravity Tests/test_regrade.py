@@ -0,0 +1,61 @@
+"""
+Test the cohort re-grading CLI on a small submission log.
+"""
+import json
+from regrade import regrade, write_report
+
+
+def test_regrade_log(tmp_path):
+    references_dir = tmp_path / "References"
+    (references_dir / "P1").mkdir(parents=True)
+    with open(references_dir / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0}, f)
+
+    log_path = tmp_path / "submissions.jsonl"
+    submissions = [
+        {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0, "dice_score": 0.5},
+        {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": [1, 2], "origin_slice_index": 0, "dice_score": 2 / 3},
+        {"patient_id": "P1", "structure_name": "Lung", "non_zero_indices": [1], "origin_slice_index": 0},
+    ]
+    with open(log_path, 'w') as f:
+        for s in submissions:
+            f.write(json.dumps(s) + "\n")
+
+    rows, stats = regrade(log_path, references_dir, workers=2, chunk_size=1)
+
+    assert [r["new_score"] for r in rows[:2]] == [1.0, 2 / 3]
+    assert rows[0]["delta"] == 0.5
+    assert rows[2]["error"] is not None
+    assert stats["submissions"] == 3
+    assert stats["graded"] == 2
+    assert stats["changed"] == 1
+    assert rows[0]["reference_version"] is not None
+
+    report_path = tmp_path / "report.json"
+    write_report(rows, stats, report_path)
+    with open(report_path) as f:
+        assert json.load(f)["stats"]["errors"] == 1
+
+
+def test_regrade_malformed_records(tmp_path):
+    references_dir = tmp_path / "References"
+    (references_dir / "P1").mkdir(parents=True)
+    with open(references_dir / "P1" / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": [1, 2, 3, 4], "origin_slice_index": 0}, f)
+
+    log_path = tmp_path / "submissions.jsonl"
+    submissions = [
+        {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": ["a", "b"]},
+        {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": [1, 2], "dice_score": "n/a"},
+        [1, 2, 3],
+        {"patient_id": "P1", "structure_name": "Heart", "non_zero_indices": [1, 2, 3, 4]},
+    ]
+    with open(log_path, 'w') as f:
+        for s in submissions:
+            f.write(json.dumps(s) + "\n")
+
+    rows, stats = regrade(log_path, references_dir, workers=2, chunk_size=2)
+
+    assert [r["error"] is not None for r in rows] == [True, True, True, False]
+    assert rows[3]["new_score"] == 1.0
+    assert (stats["graded"], stats["errors"]) == (1, 3)
@@ -0,0 +1,208 @@
+"""
+Test the Step 2 RTSTRUCT conversion (references and SEG side output) on a synthetic case.
+"""
+import os
+
+import numpy as np
+import pydicom
+
+from ingest import _load_step2
+from scorer import load_segmentation_indices
+from synthetic_case import make_case, square, SLICE_ZS, ROWS, COLS, ORIGIN, SPACING
+
+ROIS = {
+    "Heart": [square(0.0, -3, -3, 3, 3), square(2.5, -4, -4, 4, 4)],
+    "Lung": [square(-2.5, -9, -9, -6, -6)],
+    "Cord": [square(5.0, 0, 0, 1.5, 1.5)],
+    "Outside": [square(40.0, 0, 0, 3, 3)],
+}
+
+
+def convert(tmp_path, name, workers, **kwargs):
+    case_dir = tmp_path / name
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+    out_dir = tmp_path / f"{name}-out"
+    out_dir.mkdir()
+    return _load_step2().process_rtstruct(rtstruct_path, str(out_dir), workers=workers, **kwargs)
+
+
+def test_indices_match_seg(tmp_path):
+    converted = convert(tmp_path, "case", workers=1)
+    assert [c["structure_name"] for c in converted] == ["Heart", "Lung", "Cord"]
+    assert all(c["patient_id"] == "SynthPatient" for c in converted)
+
+    for result in converted:
+        from_seg = load_segmentation_indices(result["seg_path"], SLICE_ZS, (ROWS, COLS))
+        assert len(result["indices"]) > 0
+        assert np.array_equal(result["indices"], from_seg)
+
+    # Heart spans two slices
+    assert len(np.unique(converted[0]["indices"] // (ROWS * COLS))) == 2
+
+
+def test_references_without_seg(tmp_path):
+    with_seg = convert(tmp_path, "seg", workers=1)
+    without_seg = convert(tmp_path, "noseg", workers=1, write_seg=False)
+    assert os.listdir(tmp_path / "noseg-out") == []
+    assert all(c["seg_path"] is None for c in without_seg)
+    for a, b in zip(with_seg, without_seg):
+        assert np.array_equal(a["indices"], b["indices"])
+
+
+def test_parallel_matches_sequential(tmp_path):
+    sequential = [c["seg_path"] for c in convert(tmp_path, "seq", workers=1)]
+    parallel = [c["seg_path"] for c in convert(tmp_path, "par", workers=3)]
+
+    # The ROI outside the series is skipped; order follows the RTSTRUCT
+    assert [os.path.basename(p) for p in sequential] == ["Heart.dcm", "Lung.dcm", "Cord.dcm"]
+    assert [os.path.basename(p) for p in parallel] == [os.path.basename(p) for p in sequential]
+    assert not [f for f in os.listdir(tmp_path / "par-out") if f.endswith(".part")]
+
+    for seq_path, par_path in zip(sequential, parallel):
+        seq, par = pydicom.dcmread(seq_path), pydicom.dcmread(par_path)
+        assert seq.SeriesDescription == par.SeriesDescription
+        assert np.array_equal(seq.pixel_array, par.pixel_array)
+
+
+def test_header_geometry_matches_volume_load(tmp_path):
+    from_headers = convert(tmp_path, "headers", workers=1, write_seg=False)
+    from_volume = convert(tmp_path, "volume", workers=1, write_seg=False, load_volume=True)
+    assert [c["structure_name"] for c in from_headers] == [c["structure_name"] for c in from_volume]
+    for a, b in zip(from_headers, from_volume):
+        assert np.array_equal(a["indices"], b["indices"])
+
+
+def test_multi_segment_seg(tmp_path):
+    single = convert(tmp_path, "single", workers=1)
+    multi = convert(tmp_path, "multi", workers=2, multi_segment=True)
+
+    # One file for all ROIs, with a segment per ROI in RTSTRUCT order
+    assert os.listdir(tmp_path / "multi-out") == [os.path.basename(multi[0]["seg_path"])]
+    assert [c["segment_number"] for c in multi] == [1, 2, 3]
+
+    seg = pydicom.dcmread(multi[0]["seg_path"])
+    assert [s.SegmentLabel for s in seg.SegmentSequence] == ["Heart", "Lung", "Cord"]
+    # Sparse frames: one per (segment, slice) holding voxels
+    assert seg.NumberOfFrames == sum(len(np.unique(c["indices"] // (ROWS * COLS))) for c in multi)
+
+    for a, b in zip(single, multi):
+        assert np.array_equal(a["indices"], b["indices"])
+        from_seg = load_segmentation_indices(b["seg_path"], SLICE_ZS, (ROWS, COLS), segment_label=b["structure_name"])
+        assert np.array_equal(b["indices"], from_seg)
+
+
+def test_unchanged_rois_are_skipped(tmp_path, monkeypatch):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+    step2 = _load_step2()
+
+    first = step2.process_rtstruct(rtstruct_path, str(tmp_path), write_seg=False)
+    recorded = {c["structure_name"]: c["roi_hash"] for c in first}
+
+    asked = []
+    def is_unchanged(patient_id, structure_name, digest):
+        asked.append(structure_name)
+        return structure_name != "Lung" and recorded.get(structure_name) == digest
+
+    rerun = step2.process_rtstruct(rtstruct_path, str(tmp_path), write_seg=False, is_unchanged=is_unchanged)
+    assert asked == ["Heart", "Lung", "Cord", "Outside"]
+    assert [c["structure_name"] for c in rerun] == ["Lung"]
+    assert rerun[0]["roi_hash"] == recorded["Lung"]
+
+    # The hash follows the contours and the output mode
+    moved = dict(ROIS, Heart=[square(0.0, -3, -3, 3, 4)] + ROIS["Heart"][1:])
+    moved_dir = tmp_path / "moved"
+    moved_dir.mkdir()
+    _, moved_path = make_case(str(moved_dir), moved)
+    changed = step2.process_rtstruct(moved_path, str(tmp_path), write_seg=False,
+                                     is_unchanged=lambda p, name, digest: recorded.get(name) == digest)
+    assert [c["structure_name"] for c in changed] == ["Heart"]
+    (tmp_path / "out").mkdir()
+    with_seg = step2.process_rtstruct(rtstruct_path, str(tmp_path / "out"), write_seg=True,
+                                      is_unchanged=lambda p, name, digest: recorded.get(name) == digest)
+    assert [c["structure_name"] for c in with_seg] == ["Heart", "Lung", "Cord"]
+
+    # ... and the rasterizer version
+    monkeypatch.setattr(step2, "RASTERIZER_VERSION", step2.RASTERIZER_VERSION + 1)
+    refilled = step2.process_rtstruct(rtstruct_path, str(tmp_path), write_seg=False,
+                                      is_unchanged=lambda p, name, digest: recorded.get(name) == digest)
+    assert [c["structure_name"] for c in refilled] == ["Heart", "Lung", "Cord"]
+
+
+def test_sparse_masks(tmp_path):
+    converted = convert(tmp_path, "case", workers=1)
+    heart = pydicom.dcmread(converted[0]["seg_path"])
+
+    # Only the two Heart slices are encoded, positioned by frame
+    assert heart.NumberOfFrames == 2
+    assert sorted(float(f.PlanePositionSequence[0].ImagePositionPatient[2])
+                  for f in heart.PerFrameFunctionalGroupsSequence) == [0.0, 2.5]
+    assert "SpacingBetweenSlices" not in heart.SharedFunctionalGroupsSequence[0].PixelMeasuresSequence[0]
+
+    # The rasterized mask only holds slices with voxels
+    step2 = _load_step2()
+    series = step2.SeriesGeometry((ORIGIN[0], ORIGIN[1], SLICE_ZS[0]), (SPACING[0], SPACING[1], 2.5),
+                                  (1, 0, 0, 0, 1, 0, 0, 0, 1), (COLS, ROWS, len(SLICE_ZS)))
+    context = {"shape": (len(SLICE_ZS), ROWS, COLS), "geometry": step2.VolumeGeometry(SLICE_ZS),
+               "to_index": series.to_index(), "tolerance": 1.0}
+    contours = [np.array([(x, y, z) for x, y in outline]) for z, outline in ROIS["Heart"]]
+    mask = step2.rasterize_roi(contours, context)
+    assert sorted(mask) == [2, 3]
+    assert all(np.all(np.diff(pixels) > 0) for pixels in mask.values())
+
+
+def test_rtstructs_share_series(tmp_path, monkeypatch):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+
+    # A second observer's RTSTRUCT of the same series
+    second = pydicom.dcmread(rtstruct_path)
+    second.SOPInstanceUID = second.file_meta.MediaStorageSOPInstanceUID = pydicom.uid.generate_uid()
+    second_path = str(case_dir / "RS_observer2.dcm")
+    second.save_as(second_path)
+
+    step2 = _load_step2()
+    resolved = []
+    sort_slices = step2.sort_slices
+    monkeypatch.setattr(step2, "sort_slices", lambda headers: resolved.append(len(headers)) or sort_slices(headers))
+
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    cache = step2.SeriesCache()
+    first = step2.process_rtstruct(rtstruct_path, str(out_dir), series_cache=cache)
+    again = step2.process_rtstruct(second_path, str(out_dir), series_cache=cache)
+
+    assert resolved == [len(SLICE_ZS)]
+    for a, b in zip(first, again):
+        assert np.array_equal(a["indices"], b["indices"])
+
+
+def test_failed_seg_is_not_recorded(tmp_path, monkeypatch):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    make_case(str(case_dir), ROIS)
+    step2 = _load_step2()
+
+    loads = []
+    load_conversion_hashes = step2.load_conversion_hashes
+    monkeypatch.setattr(step2, "load_conversion_hashes", lambda d: loads.append(d) or load_conversion_hashes(d))
+
+    def failing_segmentation(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    create_segmentation = step2.create_segmentation
+    monkeypatch.setattr(step2, "create_segmentation", failing_segmentation)
+    first = step2.convert_folder(case_dir, tmp_path / "References")
+    assert [c["seg_path"] for c in first["converted"]] == [None, None, None]
+    # Hashes are read per patient (for the skip check, then again under its lock), not per structure
+    assert len(loads) == 2
+    assert step2.load_conversion_hashes(tmp_path / "References" / "SynthPatient") == {}
+
+    # ROIs without their SEG are converted again
+    monkeypatch.setattr(step2, "create_segmentation", create_segmentation)
+    rerun = step2.convert_folder(case_dir, tmp_path / "References")
+    assert [c["structure_name"] for c in rerun["converted"]] == ["Heart", "Lung", "Cord"]
+    assert all(c["seg_path"] for c in rerun["converted"])
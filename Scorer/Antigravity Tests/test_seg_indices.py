@@ -0,0 +1,111 @@
+"""
+Test frame-sparse conversion of a DICOM SEG to reference indices,
+and the /grade_seg endpoint built on it.
+"""
+import io
+import json
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from scorer import load_segmentation_indices, SEGMENTATION_STORAGE_UID
+
+ROWS, COLS = 8, 8
+SLICE_POSITIONS = [0.0, 2.5, 5.0, 7.5]
+
+
+def make_seg(frames, segment_labels=("Heart",), referenced_series_uid=None):
+    """frames: list of (z, segment_number, 2D mask). Returns the SEG as bytes."""
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE_UID
+    ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    ds.SOPClassUID = SEGMENTATION_STORAGE_UID
+    ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'SEG'
+    ds.Rows, ds.Columns = ROWS, COLS
+    ds.NumberOfFrames = len(frames)
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.SamplesPerPixel = 1
+    ds.PixelRepresentation = 0
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+
+    segments = []
+    for number, label in enumerate(segment_labels, start=1):
+        segment = Dataset()
+        segment.SegmentNumber = number
+        segment.SegmentLabel = label
+        segments.append(segment)
+    ds.SegmentSequence = Sequence(segments)
+
+    if referenced_series_uid:
+        referenced = Dataset()
+        referenced.SeriesInstanceUID = referenced_series_uid
+        ds.ReferencedSeriesSequence = Sequence([referenced])
+
+    groups = []
+    for z, segment_number, _ in frames:
+        plane = Dataset()
+        plane.ImagePositionPatient = [0.0, 0.0, z]
+        ident = Dataset()
+        ident.ReferencedSegmentNumber = segment_number
+        group = Dataset()
+        group.PlanePositionSequence = Sequence([plane])
+        group.SegmentIdentificationSequence = Sequence([ident])
+        groups.append(group)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(groups)
+
+    bits = np.concatenate([mask.astype(np.uint8).ravel() for _, _, mask in frames])
+    ds.PixelData = np.packbits(bits, bitorder='little').tobytes()
+
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, ds, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+def test_frame_sparse_indices():
+    heart = np.zeros((ROWS, COLS), dtype=bool)
+    heart[2:4, 3:5] = True
+    lung = np.zeros((ROWS, COLS), dtype=bool)
+    lung[0, 0] = True
+    empty = np.zeros((ROWS, COLS), dtype=bool)
+
+    seg = make_seg([(5.0, 1, heart), (2.5, 1, empty), (7.6, 2, lung)], segment_labels=("Heart", "Lung"))
+
+    all_indices = load_segmentation_indices(io.BytesIO(seg), SLICE_POSITIONS, (ROWS, COLS))
+    expected_heart = np.flatnonzero(heart) + 2 * ROWS * COLS
+    expected_lung = np.flatnonzero(lung) + 3 * ROWS * COLS
+    assert all_indices.tolist() == sorted(expected_heart.tolist() + expected_lung.tolist())
+
+    heart_only = load_segmentation_indices(io.BytesIO(seg), SLICE_POSITIONS, (ROWS, COLS), segment_label="heart")
+    assert heart_only.tolist() == expected_heart.tolist()
+
+
+def test_grade_seg_endpoint(tmp_path, monkeypatch):
+    import app as scorer_app
+
+    patient_dir = tmp_path / "P1"
+    patient_dir.mkdir()
+    mask = np.zeros((ROWS, COLS), dtype=bool)
+    mask[1:3, 1:3] = True
+    ref_indices = (np.flatnonzero(mask) + ROWS * COLS).tolist()
+    with open(patient_dir / "Heart.json", 'w') as f:
+        json.dump({"non_zero_indices": ref_indices, "origin_slice_index": 0}, f)
+    with open(patient_dir / "geometry.json", 'w') as f:
+        json.dump({"slice_positions": SLICE_POSITIONS, "rows": ROWS, "columns": COLS}, f)
+    monkeypatch.setattr(scorer_app, "REFERENCES_DIR", str(tmp_path))
+
+    client = scorer_app.app.test_client()
+    response = client.post('/grade_seg', data={
+        "file": (io.BytesIO(make_seg([(2.5, 1, mask)])), "seg.dcm"),
+        "patient_id": "P1",
+        "structure_name": "Heart",
+    }, content_type='multipart/form-data')
+
+    assert response.status_code == 200
+    assert response.get_json()["dice_score"] == 1.0
@@ -0,0 +1,89 @@
+"""
+Test the SEG_to_Ref bulk converter on the SEGs Step 2 writes for a synthetic case.
+"""
+import json
+import os
+import sys
+
+import numpy as np
+
+import reference_store
+from ingest import _load_step2
+from reference_format import load_reference, read_binary_reference
+from synthetic_case import make_case, square
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "RTSTRUCT to SEG and JSON converter"))
+import SEG_to_Ref  # noqa: E402
+
+ROIS = {
+    "Heart": [square(0.0, -3, -3, 3, 3), square(2.5, -4, -4, 4, 4)],
+    "Lung": [square(-2.5, -9, -9, -6, -6)],
+    "Cord": [square(5.0, 0, 0, 1.5, 1.5)],
+}
+
+
+def test_bulk_conversion(tmp_path):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+    expected = {c["structure_name"]: c["indices"]
+                for c in _load_step2().process_rtstruct(rtstruct_path, str(case_dir))}
+
+    parallel = SEG_to_Ref.convert_directory(case_dir, tmp_path / "par", workers=2,
+                                            compress=True, use_header_cache=False)
+    sequential = SEG_to_Ref.convert_directory(case_dir, tmp_path / "seq", workers=1,
+                                              use_header_cache=False)
+    assert parallel == sequential
+    assert sorted(c["structure_name"] for c in parallel) == sorted(ROIS)
+
+    for name, indices in expected.items():
+        binary, _ = read_binary_reference(str(tmp_path / "par" / "SynthPatient" / f"{name}.ref"))
+        assert np.array_equal(binary, indices)
+        seq_indices, _ = load_reference(str(tmp_path / "seq"), "SynthPatient", name)
+        assert np.array_equal(seq_indices, indices)
+        with open(tmp_path / "seq" / "SynthPatient" / f"{name}.json") as f:
+            assert json.load(f)["non_zero_indices"] == indices.tolist()
+
+    # One manifest and one pointer file hold every structure of the patient
+    with open(tmp_path / "par" / "SynthPatient" / "manifest.json") as f:
+        assert sorted(json.load(f)["structures"]) == sorted(ROIS)
+    with open(tmp_path / "par" / "SynthPatient" / "refs.json") as f:
+        assert sorted(json.load(f)["structures"]) == sorted(ROIS)
+
+
+def test_multi_segment_seg(tmp_path):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+    converted = _load_step2().process_rtstruct(rtstruct_path, str(case_dir), multi_segment=True)
+    assert len({c["seg_path"] for c in converted}) == 1
+
+    # One reference per segment, named by its SegmentLabel
+    results = SEG_to_Ref.convert_directory(case_dir, tmp_path / "References", workers=1, use_header_cache=False)
+    assert sorted(c["structure_name"] for c in results) == sorted(ROIS)
+    for c in converted:
+        indices, _ = load_reference(str(tmp_path / "References"), "SynthPatient", c["structure_name"])
+        assert np.array_equal(indices, c["indices"])
+
+
+def test_references_written_under_patient_lock(tmp_path, monkeypatch):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    _, rtstruct_path = make_case(str(case_dir), ROIS)
+    _load_step2().process_rtstruct(rtstruct_path, str(case_dir))
+    patient_dir = tmp_path / "References" / "SynthPatient"
+    lock_path = os.path.abspath(str(patient_dir / reference_store.LOCK_NAME))
+
+    locked = []
+    write_reference = SEG_to_Ref.write_reference
+
+    def checked_write(*args, **kwargs):
+        locked.append(lock_path in getattr(reference_store._held_locks, "paths", {}))
+        return write_reference(*args, **kwargs)
+
+    monkeypatch.setattr(SEG_to_Ref, "write_reference", checked_write)
+    SEG_to_Ref.convert_directory(case_dir, tmp_path / "References", workers=1, use_header_cache=False)
+    assert locked and all(locked)
+    # Every file is written through a temp file and renamed into place
+    assert not [name for name in os.listdir(patient_dir) if ".tmp" in name]
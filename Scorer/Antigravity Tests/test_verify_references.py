@@ -0,0 +1,82 @@
+"""
+Test the reference consistency verifier against the sources Step 2 converted.
+"""
+import json
+
+from ingest import _load_step2
+from reference_format import write_binary_reference
+from reference_pack import build_pack
+from reference_store import store_reference
+from synthetic_case import make_case, square
+from verify_references import verify_references
+
+ROIS = {
+    "Heart": [square(0.0, -3, -3, 3, 3), square(2.5, -4, -4, 4, 4)],
+    "Lung": [square(-2.5, -9, -9, -6, -6)],
+    "Cord": [square(5.0, 0, 0, 1.5, 1.5)],
+}
+
+
+def statuses(report):
+    return {r["structure_name"]: r["status"] for r in report["results"]}
+
+
+def test_verify_references(tmp_path):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    make_case(str(case_dir), ROIS)
+    references_dir = tmp_path / "References"
+    _load_step2().convert_folder(case_dir, references_dir)
+
+    report = verify_references(references_dir, [tmp_path / "case"], workers=2)
+    assert (report["checked"], report["ok"]) == (3, 3)
+    # Each structure is checked against its RTSTRUCT ROI and its SEG
+    assert all(sorted(s["kind"] for s in r["sources"]) == ["rtstruct", "seg"] and all(s["match"] for s in r["sources"])
+               for r in report["results"])
+    assert all(r["binary"] == "ok" for r in report["results"])
+
+    # Drift: a changed JSON, a binary reference out of step with its JSON, a reference without source
+    patient_dir = references_dir / "SynthPatient"
+    heart = json.loads((patient_dir / "Heart.json").read_text())
+    heart["non_zero_indices"] = heart["non_zero_indices"][1:]
+    (patient_dir / "Heart.json").write_text(json.dumps(heart))
+    write_binary_reference(str(patient_dir / "Lung.ref"), [1, 2, 3])
+    (patient_dir / "Liver.json").write_text(json.dumps({"non_zero_indices": [1], "origin_slice_index": 0}))
+
+    drifted = verify_references(references_dir, [tmp_path / "case"], workers=2)
+    assert statuses(drifted) == {"Cord": "ok", "Heart": "drift", "Liver": "no_source", "Lung": "drift"}
+    # The scorer serves the version refs.json points at, not the edited JSON
+    heart_result = next(r for r in drifted["results"] if r["structure_name"] == "Heart")
+    assert (heart_result["json"], heart_result["binary"]) == ("drift", "ok")
+    assert all(s["match"] for s in heart_result["sources"])
+    lung_result = next(r for r in drifted["results"] if r["structure_name"] == "Lung")
+    assert (lung_result["json"], lung_result["binary"]) == ("ok", "drift")
+
+    sequential = verify_references(references_dir, [tmp_path / "case"], workers=1)
+    assert sequential == drifted
+
+
+def test_verify_pointer_and_pack(tmp_path):
+    case_dir = tmp_path / "case"
+    case_dir.mkdir()
+    make_case(str(case_dir), ROIS)
+    references_dir = tmp_path / "References"
+    _load_step2().convert_folder(case_dir, references_dir)
+    pack_path = tmp_path / "References.pack"
+    build_pack(str(references_dir), str(pack_path))
+
+    report = verify_references(references_dir, [case_dir], workers=1, pack_path=pack_path)
+    assert statuses(report) == {"Cord": "ok", "Heart": "ok", "Lung": "ok"}
+    assert all((r["json"], r["binary"], r["pack"]) == ("ok", "ok", "ok") for r in report["results"])
+
+    # refs.json moved to another version: the scorer serves it, not the JSON or the pack
+    version = store_reference(references_dir, "SynthPatient", "Lung", [1, 2, 3])
+    drifted = verify_references(references_dir, [case_dir], workers=2, pack_path=pack_path)
+    assert statuses(drifted) == {"Cord": "ok", "Heart": "ok", "Lung": "drift"}
+    lung = next(r for r in drifted["results"] if r["structure_name"] == "Lung")
+    assert (lung["version"], lung["reference_voxels"]) == (version, 3)
+    assert (lung["json"], lung["binary"], lung["pack"]) == ("drift", "drift", "drift")
+
+    # A pack entry is checked when the folder has no copy of it
+    pack_only = verify_references(tmp_path / "Empty", [case_dir], workers=1, pack_path=pack_path)
+    assert statuses(pack_only) == {"Cord": "ok", "Heart": "ok", "Lung": "ok"}
@@ -0,0 +1,81 @@
+"""
+Test the binary-search slice lookup and the affine voxel transform against the per-point code they replaced.
+"""
+import numpy as np
+
+from volume_geometry import VolumeGeometry, PhysicalToIndexTransform, SeriesGeometry
+
+
+def linear_nearest(target_z, positions):
+    best_idx, min_dist = -1, float('inf')
+    for idx, pos in enumerate(positions):
+        if np.isnan(pos):
+            continue
+        if abs(target_z - pos) < min_dist:
+            best_idx, min_dist = idx, abs(target_z - pos)
+    return best_idx, min_dist
+
+
+def test_matches_linear_scan():
+    rng = np.random.default_rng(0)
+    # Unsorted slice order with a missing position, as in a source dataset list
+    positions = list(rng.permutation(np.arange(-50.0, 50.0, 2.5)))
+    positions[7] = float('nan')
+    geometry = VolumeGeometry(positions)
+
+    targets = rng.uniform(-60, 60, 500)
+    indices, distances = geometry.nearest(targets)
+    for target, index, distance in zip(targets, indices, distances):
+        assert (index, distance) == linear_nearest(target, positions)
+
+    lookup = geometry.lookup(targets, tolerance=0.5)
+    assert np.array_equal(lookup, np.where(distances <= 0.5, indices, -1))
+
+
+def test_sorted_positions():
+    geometry = VolumeGeometry.from_positions([5.0, -5.0, 0.0, 0.0], (16, 16))
+    assert geometry.slice_positions == [-5.0, 0.0, 5.0]
+    assert geometry.dimensions == (16, 16)
+    assert geometry.slice_spacing == 5.0
+    assert geometry.index_of(0.3) == 1
+    assert geometry.index_of(2.5) is None
+    assert geometry.index_of(2.5, tolerance=3) == 1  # ties go to the lower Z
+
+    empty = VolumeGeometry([])
+    assert empty.index_of(0.0) is None
+    assert empty.lookup([1.0, 2.0]).tolist() == [-1, -1]
+
+
+def test_transform_matches_itk():
+    import SimpleITK as sitk
+
+    image = sitk.Image(8, 8, 4, sitk.sitkUInt8)
+    image.SetOrigin((-12.0, 30.5, -7.25))
+    image.SetSpacing((0.7, 0.9, 2.5))
+    angle = np.deg2rad(20)
+    image.SetDirection((np.cos(angle), -np.sin(angle), 0, np.sin(angle), np.cos(angle), 0, 0, 0, 1))
+
+    points = np.random.default_rng(1).uniform(-40, 40, (200, 3))
+    expected = np.array([image.TransformPhysicalPointToContinuousIndex(p.tolist()) for p in points])
+
+    to_index = PhysicalToIndexTransform.from_itk_image(image)
+    assert np.allclose(to_index(points), expected, rtol=0, atol=1e-9)
+
+
+def test_series_geometry_from_headers_matches_itk(tmp_path):
+    import SimpleITK as sitk
+    from dicom_index import DicomIndex, sort_slices
+    from synthetic_case import make_case, square
+
+    series_uid, _ = make_case(str(tmp_path), {"Heart": [square(0.0, -3, -3, 3, 3)]})
+    headers = sort_slices(DicomIndex.build(tmp_path).series()[series_uid])
+
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames([h.path for h in headers])
+    expected = SeriesGeometry.from_itk_image(reader.Execute())
+    geometry = SeriesGeometry.from_headers(headers)
+
+    assert geometry.size == expected.size
+    assert np.allclose(geometry.origin, expected.origin)
+    assert np.allclose(geometry.spacing, expected.spacing)
+    assert np.allclose(geometry.direction, expected.direction)
@@ -1,213 +1,219 @@
 import os
+import sys
 import pydicom
-import numpy as np
 import json
 import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
 
+# Shared Scorer modules live one folder up
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from reference_format import write_binary_reference, REFERENCE_BINARY_EXT
+from reference_manifest import update_manifest_structures, make_geometry
+from reference_store import publish_references, patient_lock
+from scorer import load_segmentation_indices
+from volume_geometry import VolumeGeometry
+from dicom_index import read_headers, open_header_cache, SEGMENTATION_STORAGE_UID
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 
-def load_reference_geometry(input_dir):
+def load_reference_geometry(input_dir, headers=None):
     """
-    Scans for CT files to build a map of Z-position to Slice Index.
+    Scans for CT files to build the reference volume geometry.
+    headers: the dicom_index headers of the folder's .dcm files, if already read
     Returns:
-        z_map (dict): { z_position (float): slice_index (int) }
-        sorted_zs (list): List of Z positions
-        dimensions (tuple): (Rows, Columns)
+        VolumeGeometry: Sorted unique Z positions (slice 0 is the lowest) and (Rows, Columns),
+        or None if no CT was found
     """
-    z_positions = []
-    dimensions = None
-
-    files = list(input_dir.glob("*.dcm"))
+    if headers is None:
+        headers = read_headers(sorted(input_dir.glob("*.dcm")))
 
-    for f in files:
-        try:
-            # Fast header read
-            ds = pydicom.dcmread(f, stop_before_pixels=True)
-            if ds.Modality == 'CT':
-                z = float(ds.ImagePositionPatient[2])
-                z_positions.append(z)
-                if dimensions is None:
-                    dimensions = (ds.Rows, ds.Columns)
-        except Exception as e:
-            continue
+    cts = [h for h in headers if h is not None and h.is_image and h.modality == 'CT']
+    z_positions = [ct.position[2] for ct in cts]
+    dimensions = cts[0].dimensions if cts else None
 
     if not z_positions:
         logging.error("No CT files found to establish reference geometry!")
-        return None, None, None
+        return None
 
     # Sort Z positions (Image Position Patient Z)
     # This determines the slice index (0 is bottom-most usually or top-most depending on scan)
-    sorted_zs = sorted(list(set(z_positions)))
-
-    # Store map for fast lookup with some tolerance
-    z_map = {z: i for i, z in enumerate(sorted_zs)}
+    geometry = VolumeGeometry.from_positions(z_positions, dimensions)
 
-    logging.info(f"Reference Volume: {len(sorted_zs)} slices. Z range: {min(sorted_zs):.2f} to {max(sorted_zs):.2f}")
+    zs = geometry.slice_positions
+    logging.info(f"Reference Volume: {len(zs)} slices. Z range: {zs[0]:.2f} to {zs[-1]:.2f}")
 
-    return z_map, sorted_zs, dimensions
+    return geometry
 
-def find_nearest_z_index(target_z, sorted_zs, tolerance=0.5):
-    """Finds the index of the nearest Z position."""
-    best_idx = -1
-    min_dist = float('inf')
+def safe_name(name):
+    """File-system safe patient/structure name (alphanumerics, space, '_' and '-')."""
+    return "".join([c for c in str(name) if c.isalnum() or c in (' ', '_', '-')]).strip()
 
-    for i, z in enumerate(sorted_zs):
-        dist = abs(z - target_z)
-        if dist < min_dist:
-            min_dist = dist
-            best_idx = i
+def get_indices_from_seg(dcm_path, geometry):
+    """
+    Reads a DICOM SEG file and maps the frames of each segment to global indices
+    of the reference volume `geometry` (see load_reference_geometry).
+    Only frames holding segment pixels are unpacked, and the indices are
+    gathered per frame and concatenated once.
 
-    if min_dist > tolerance:
-        return None
-    return best_idx
+    A single-segment SEG is named after its SeriesDescription (as Step 2 writes
+    one SEG per ROI); the segments of a multi-segment SEG (Step 2 --multi_segment)
+    are named after their SegmentLabel, as ingestion names them.
 
-def get_indices_from_seg(dcm_path, z_map, sorted_zs, ref_dims):
-    """
-    Reads a DICOM SEG file and maps its frames to global indices.
+    Returns:
+        (str, list): Patient ID and [(structure name, sorted int64 indices)] per segment,
+        or (None, None) if the file is not a usable SEG
     """
     try:
         dcm = pydicom.dcmread(dcm_path)
     except Exception as e:
         logging.error(f"Failed to read DICOM {dcm_path}: {e}")
-        return None, None, None
+        return None, None
 
     # Check for Segmentation Storage
-    if dcm.SOPClassUID != '1.2.840.10008.5.1.4.1.1.66.4':
-        return None, None, None
+    if dcm.SOPClassUID != SEGMENTATION_STORAGE_UID:
+        return None, None
 
-    pixel_array = dcm.pixel_array
+    # Fallback if no CTs found (shouldn't happen given logic)
+    ref_dims = geometry.dimensions or (512, 512)
 
-    # Handle 2D vs 3D shapes
-    if len(pixel_array.shape) == 2:
-        # Single frame
-        pixel_array = pixel_array[np.newaxis, :, :]
+    segments = list(dcm.get('SegmentSequence', []))
+    if not segments:
+        logging.warning(f"Skipping {dcm_path}: SEG has no SegmentSequence")
+        return None, None
 
-    num_frames = pixel_array.shape[0]
+    structures = []
+    for segment in segments:
+        number = int(segment.SegmentNumber)
+        structure_name = str(segment.get('SegmentLabel', '') or f"Segment_{number}")
+        if len(segments) == 1 and dcm.get('SeriesDescription'):
+            structure_name = str(dcm.SeriesDescription)
 
-    if ref_dims:
-       current_slice_size = pixel_array.shape[1] * pixel_array.shape[2]
-       ref_slice_size = ref_dims[0] * ref_dims[1]
-       if current_slice_size != ref_slice_size:
-           logging.warning(f"Dimension mismatch for {dcm_path}. Expected {ref_dims}. Skipping.")
-           return None, None, None
-    else:
-       # Fallback if no CTs found (shouldn't happen given logic)
-       ref_dims = (512, 512)
+        try:
+            indices = load_segmentation_indices(dcm, geometry.slice_positions, ref_dims, segment_number=number)
+        except ValueError as e:
+            logging.warning(f"Skipping {dcm_path}: {e}")
+            return None, None
+        structures.append((safe_name(structure_name), indices))
 
-    slice_size = ref_dims[0] * ref_dims[1]
-    global_indices = []
+    patient_id = dcm.PatientID if 'PatientID' in dcm else "UnknownPatient"
+    return safe_name(patient_id), structures
 
-    # PerFrameFunctionalGroupsSequence logic
-    if not hasattr(dcm, 'PerFrameFunctionalGroupsSequence'):
-        logging.warning(f"SEG {dcm_path} missing PerFrameFunctionalGroupsSequence. Cannot determine slice offsets.")
-        return None, None, None
+def write_reference(patient_dir, structure_name, indices, compress=False):
+    """
+    Write the JSON and binary reference of one structure, each atomically
+    (temp file + rename). Returns the JSON path.
+    """
+    output_json = patient_dir / f"{structure_name}.json"
+    data = {
+        "non_zero_indices": indices.tolist(),
+        "origin_slice_index": 0
+    }
+    tmp_path = f"{output_json}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, output_json)
+
+    write_binary_reference(patient_dir / f"{structure_name}{REFERENCE_BINARY_EXT}", indices, 0, compress=compress)
+    return output_json
+
+def convert_seg(dcm_path, geometry):
+    """Worker of convert_directory: get_indices_from_seg for one file, tagged with its path."""
+    return str(dcm_path), get_indices_from_seg(dcm_path, geometry)
+
+def convert_directory(input_dir, output_base_dir, workers=None, compress=False, use_header_cache=True):
+    """
+    Converts every SEG of a directory to references, several SEGs at a time.
 
-    pffgs = dcm.PerFrameFunctionalGroupsSequence
+    SEGs are decoded in `workers` processes (default: all cores; 1 decodes them
+    one after another). The references are then written in file order, so a later
+    SEG of the same patient and structure replaces an earlier one as before, and
+    each patient's stored versions and manifest are updated with a single write.
+    Each patient's files are written under its lock (see reference_store.patient_lock),
+    so ingestion or a Step 2 batch writing the same patient cannot interleave.
 
-    if len(pffgs) != num_frames:
-        logging.warning(f"Frame count mismatch in {dcm_path}. Pixels: {num_frames}, Meta: {len(pffgs)}")
-        return None, None, None
+    Returns:
+        list: {"file", "patient_id", "structure_name", "voxels"} per converted segment,
+        or None if no reference geometry could be built
+    """
+    input_dir, output_base_dir = Path(input_dir), Path(output_base_dir)
 
-    for i in range(num_frames):
-        # Extract Z for this frame
-        try:
-            # Standard DICOM SEG location
-            plane_pos = pffgs[i].PlanePositionSequence[0].ImagePositionPatient
-            frame_z = float(plane_pos[2])
-        except Exception as e:
-            logging.warning(f"Could not extract Z for frame {i} in {dcm_path}: {e}")
-            continue
-
-        # Find global slice index
-        # Use nearest neighbor search against the sorted CT slice positions
-        slice_idx = find_nearest_z_index(frame_z, sorted_zs)
-
-        if slice_idx is None:
-            logging.warning(f"Frame {i} Z={frame_z} not found in reference volume geometry. Skipping.")
-            continue
-
-        # Get flattened indices for this frame
-        frame_mask = pixel_array[i].astype(bool)
-        local_indices = np.flatnonzero(frame_mask)
-
-        # Determine offset for this slice in the global volume
-        global_offset = slice_idx * slice_size
-
-        # Add to global list
-        if len(local_indices) > 0:
-            frame_global_indices = local_indices + global_offset
-            global_indices.extend(frame_global_indices.tolist())
-
-    # Extract Metadata
-    patient_id = dcm.PatientID if 'PatientID' in dcm else "UnknownPatient"
+    # 1. Build Reference Geometry (headers of unchanged files come from the shared cache)
+    logging.info("Scanning for CT files to build reference geometry...")
+    headers = read_headers(sorted(input_dir.glob("*.dcm")), cache=open_header_cache() if use_header_cache else None)
+    geometry = load_reference_geometry(input_dir, headers)
 
-    structure_name = "UnknownStructure"
-    if 'SeriesDescription' in dcm and dcm.SeriesDescription:
-        structure_name = dcm.SeriesDescription
-    elif 'ContentLabel' in dcm:
-        structure_name = dcm.ContentLabel
+    if geometry is None:
+        logging.error("Could not build reference geometry. Aborting.")
+        return None
 
-    # Sanitize
-    safe_patient_id = "".join([c for c in patient_id if c.isalnum() or c in (' ', '_', '-')]).strip()
-    safe_structure_name = "".join([c for c in structure_name if c.isalnum() or c in (' ', '_', '-')]).strip()
+    logging.info(f"Geometry established. Dimensions: {geometry.dimensions}, Slices: {len(geometry)}")
 
-    return safe_patient_id, safe_structure_name, global_indices
+    # 2. Decode SEGs (only SEGs are read in full; CT files are known from their headers)
+    seg_paths = [Path(h.path) for h in headers if h is not None and h.sop_class_uid == SEGMENTATION_STORAGE_UID]
+    workers = min(workers or os.cpu_count() or 1, max(len(seg_paths), 1))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(convert_seg, seg_paths, repeat(geometry)))
+    else:
+        results = [convert_seg(path, geometry) for path in seg_paths]
+
+    # 3. Write references, one patient at a time under its lock
+    by_patient = {}
+    for file_path, (patient_id, structures) in results:
+        if structures is not None:
+            by_patient.setdefault(patient_id, []).append((file_path, structures))
+
+    converted = []
+    volume_geometry = make_geometry(geometry.slice_positions, geometry.dimensions)
+    for patient_id, patient_results in by_patient.items():
+        patient_dir = output_base_dir / patient_id
+        with patient_lock(patient_dir):
+            references = {}
+            for file_path, structures in patient_results:
+                for structure_name, indices in structures:
+                    output_json = write_reference(patient_dir, structure_name, indices, compress)
+                    references[structure_name] = indices
+
+                    logging.info(f"Converted {Path(file_path).name} -> {output_json} ({len(indices)} voxels) + {structure_name}{REFERENCE_BINARY_EXT}")
+                    converted.append({"file": file_path, "patient_id": patient_id,
+                                      "structure_name": structure_name, "voxels": int(len(indices))})
+
+            versions = publish_references(output_base_dir, patient_id, references, 0, compress=compress)
+            update_manifest_structures(patient_dir, references, volume_geometry)
+        for structure_name, version in versions.items():
+            logging.info(f"Stored {patient_id}/{structure_name} as version {version[:12]}")
+
+    return converted
 
 def main():
     script_dir = Path(__file__).parent.absolute()
-    input_dir = script_dir / "Data to be converted"
-    output_base_dir = script_dir / "References"
 
+    parser = argparse.ArgumentParser(description="Convert the DICOM SEGs of a folder to Scorer references.")
+    parser.add_argument("input_dir", nargs="?", default=str(script_dir / "Data to be converted"),
+                        help="Folder with the CT series and SEG files (default: 'Data to be converted')")
+    parser.add_argument("--output_dir", default=str(script_dir / "References"),
+                        help="References folder to write to (default: 'References' next to this script)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of SEGs decoded in parallel (default: all cores; 1 = sequential)")
+    parser.add_argument("--compress_binary", action="store_true",
+                        help="Delta/varint-compress the binary references")
+    parser.add_argument("--no_header_cache", action="store_true",
+                        help="Read every DICOM header instead of using the shared header cache")
+    args = parser.parse_args()
+
+    input_dir = Path(args.input_dir)
     if not input_dir.exists():
         logging.error(f"Input directory not found: {input_dir}")
         return
 
-    # 1. Build Reference Geometry
-    logging.info("Scanning for CT files to build reference geometry...")
-    z_map, sorted_zs, ref_dims = load_reference_geometry(input_dir)
-
-    if not sorted_zs:
-        logging.error("Could not build reference geometry. Aborting.")
-        return
-
-    logging.info(f"Geometry established. Dimensions: {ref_dims}, Slices: {len(sorted_zs)}")
-
-    # 2. Convert SEGs
-    count = 0
-    for file_path in input_dir.glob("*.dcm"):
-        # Skipping CT files within the conversion loop is done inside get_indices check class UID
-        # But we can optimize by filename if needed.
-
-        result = get_indices_from_seg(file_path, z_map, sorted_zs, ref_dims)
-        if not result:
-            continue
-
-        patient_id, structure_name, indices = result
-
-        if indices is not None:
-            # Create output directory
-            patient_dir = output_base_dir / patient_id
-            patient_dir.mkdir(parents=True, exist_ok=True)
-
-            output_json = patient_dir / f"{structure_name}.json"
-
-            # Sort indices
-            indices.sort()
-
-            data = {
-                "non_zero_indices": indices,
-                "origin_slice_index": 0
-            }
-
-            with open(output_json, 'w') as f:
-                json.dump(data, f)
-
-            logging.info(f"Converted {file_path.name} -> {output_json} ({len(indices)} voxels)")
-            count += 1
-
-    logging.info(f"Done. Converted {count} SEG files.")
+    converted = convert_directory(input_dir, args.output_dir, workers=args.workers,
+                                  compress=args.compress_binary, use_header_cache=not args.no_header_cache)
+    if converted is not None:
+        logging.info(f"Done. Converted {len(converted)} SEG files.")
 
 if __name__ == "__main__":
     main()
@@ -9,6 +9,7 @@ import uuid
 import sys
 import tkinter as tk
 from tkinter import filedialog, messagebox
+from dicom_index import read_headers, open_header_cache
 
 # --- Optimization Logic (Embedded) ---
 
@@ -16,8 +17,10 @@ def generate_uid(prefix="1.2.826.0.1.3680043.2.1125."):
     """Generates a unique UID."""
     return prefix + str(uuid.uuid4().int)
 
-def load_dicom_series(input_dir, log_func=print):
-    """Loads DICOM files, separating Images and RTSTRUCT."""
+def load_dicom_series(input_dir, log_func=print, cache=None):
+    """Loads DICOM files, separating Images and RTSTRUCT.
+    Files are classified from their headers (served by the shared header cache
+    when given); only images and RTSTRUCTs are read in full."""
     images = []
     structs = []
 
@@ -25,17 +28,22 @@ def load_dicom_series(input_dir, log_func=print):
         log_func(f"Error: Input directory not found: {input_dir}")
         return [], []
 
-    for f in os.listdir(input_dir):
-        filepath = os.path.join(input_dir, f)
-        if os.path.isfile(filepath):
-            try:
-                ds = pydicom.dcmread(filepath, stop_before_pixels=False)
-                if ds.Modality == "RTSTRUCT":
-                    structs.append(ds)
-                elif hasattr(ds, "ImagePositionPatient"):
-                    images.append((ds.ImagePositionPatient[2], ds))
-            except:
-                pass
+    paths = [os.path.join(input_dir, f) for f in os.listdir(input_dir)]
+    paths = [p for p in paths if os.path.isfile(p)]
+
+    for filepath, header in zip(paths, read_headers(paths, cache=cache)):
+        if header is None:
+            continue
+        if header.modality != "RTSTRUCT" and header.position is None:
+            continue
+        try:
+            ds = pydicom.dcmread(filepath, stop_before_pixels=False)
+            if ds.Modality == "RTSTRUCT":
+                structs.append(ds)
+            elif hasattr(ds, "ImagePositionPatient"):
+                images.append((ds.ImagePositionPatient[2], ds))
+        except:
+            pass
 
     # Sort images by Z-position
     images.sort(key=lambda x: x[0])
@@ -365,7 +373,7 @@ class OptimizerApp:
         self.log(f"Overwrite Original: {not self.dont_overwrite.get()}")
 
         try:
-            images, structs = load_dicom_series(input_path, self.log)
+            images, structs = load_dicom_series(input_path, self.log, cache=open_header_cache())
             if not images:
                 self.log("No DICOM images found.")
                 return
@@ -2,14 +2,13 @@ import os
 import sys
 import glob
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
 import numpy as np
-import pydicom
 import json
-import tkinter as tk
-from tkinter import filedialog
-import SimpleITK as sitk
-from skimage import draw
+import time
+import fnmatch
+import hashlib
 from pathlib import Path
 from highdicom.seg import (
     Segmentation,
@@ -21,9 +20,15 @@ from highdicom.content import (
     PlanePositionSequence,
     PlaneOrientationSequence,
 )
-from highdicom import AlgorithmIdentificationSequence
+from highdicom import AlgorithmIdentificationSequence, CoordinateSystemNames
 from pydicom.sr.codedict import codes
 from pydicom.uid import generate_uid
+from reference_format import write_binary_reference, REFERENCE_BINARY_EXT
+from reference_manifest import update_manifest, make_geometry
+from reference_store import store_reference, patient_lock
+from volume_geometry import VolumeGeometry, SeriesGeometry
+from dicom_index import DicomIndex, sort_slices, open_header_cache
+from contour_fill import fill_slice_indices
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -33,78 +38,140 @@ LOG_DEBUG_COORDS = False
 # Part 1: Geometry Helpers (Shared/JSON Logic)
 # ---------------------------------------------------------
 
-def load_reference_geometry(input_dir):
+def load_reference_geometry(input_dir, index=None):
     """
-    Scans for CT files to build a map of Z-position to Slice Index.
+    Builds the reference volume geometry from the CT headers of input_dir
+    (served by `index` if given, see dicom_index.DicomIndex).
     Returns:
-        z_map (dict): { z_position (float): slice_index (int) }
-        sorted_zs (list): List of Z positions
-        dimensions (tuple): (Rows, Columns)
+        VolumeGeometry: Sorted unique Z positions (slice 0 is the lowest) and (Rows, Columns),
+        or None if no CT was found
     """
-    z_positions = []
-    dimensions = None
+    if index is None:
+        if not Path(input_dir).exists():
+            return None
+        index = DicomIndex.build(input_dir)
 
-    path_input = Path(input_dir)
-    if not path_input.exists():
-        return None, None, None
-
-    # Scan all files to find CTs
-    files = [f for f in path_input.iterdir() if f.is_file()]
-
-    for f in files:
-        try:
-            # Fast header read
-            ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
-            if ds.Modality == 'CT':
-                z = float(ds.ImagePositionPatient[2])
-                z_positions.append(z)
-                if dimensions is None:
-                    dimensions = (ds.Rows, ds.Columns)
-        except Exception as e:
-            continue
+    cts = index.images('CT')
+    if not cts:
+        return None
 
-    if not z_positions:
-        return None, None, None
+    z_positions = [ct.position[2] for ct in cts]
+    dimensions = cts[0].dimensions
 
-    # Sort Z positions (Image Position Patient Z)
-    sorted_zs = sorted(list(set(z_positions)))
+    # Slices sorted by Z position (Image Position Patient Z)
+    geometry = VolumeGeometry.from_positions(z_positions, dimensions)
 
-    # Store map for fast lookup with some tolerance
-    z_map = {z: i for i, z in enumerate(sorted_zs)}
+    zs = geometry.slice_positions
+    logging.info(f"Reference Geometry: {len(zs)} slices. Range: {zs[0]:.2f} to {zs[-1]:.2f}")
 
-    logging.info(f"Reference Geometry: {len(sorted_zs)} slices. Range: {min(sorted_zs):.2f} to {max(sorted_zs):.2f}")
+    return geometry
 
-    return z_map, sorted_zs, dimensions
+def safe_name(name):
+    """File-system safe patient/structure name (alphanumerics, space, '_' and '-')."""
+    return "".join([c for c in name if c.isalnum() or c in (' ', '_', '-')]).strip()
 
-def find_nearest_z_index(target_z, sorted_zs, tolerance=0.5):
-    """Finds the index of the nearest Z position."""
-    best_idx = -1
-    min_dist = float('inf')
+# Per-structure ROI hashes of the last conversion, next to the patient's references
+CONVERSION_HASHES_NAME = 'conversion_hashes.json'
 
-    for i, z in enumerate(sorted_zs):
-        dist = abs(z - target_z)
-        if dist < min_dist:
-            min_dist = dist
-            best_idx = i
+# Version of the contour rasterization, part of every ROI hash. Bump it whenever
+# the same contours fill to different voxels, so existing references are reconverted.
+# 1: each contour filled on its own with skimage.draw.polygon
+# 2: even-odd filling of all contours of a slice (contour_fill.py)
+RASTERIZER_VERSION = 2
 
-    if min_dist > tolerance:
-        return None
-    return best_idx
+def roi_hash(roi_name, contours, series, slice_geometry, reference_geometry, output_mode):
+    """
+    SHA-256 of everything one ROI's outputs depend on: its name and contour
+    points, the referenced series geometry, the reference geometry, which
+    SEG output is written ("none", "single" or "multi") and the rasterizer version.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "rasterizer": RASTERIZER_VERSION,
+        "roi_name": roi_name,
+        "origin": series.origin,
+        "spacing": series.spacing,
+        "direction": series.direction,
+        "size": series.size,
+        "slice_positions": slice_geometry.slice_positions,
+        "reference_positions": reference_geometry.slice_positions,
+        "reference_dimensions": reference_geometry.dimensions,
+        "output": output_mode,
+    }, sort_keys=True).encode())
+    for points in contours:
+        digest.update(np.int64(len(points)).tobytes())
+        digest.update(np.ascontiguousarray(points, dtype='<f8').tobytes())
+    return digest.hexdigest()
+
+def load_conversion_hashes(patient_dir):
+    """{structure_name: {"roi_hash", "seg_path", "compress"}} of the last conversion, or {}."""
+    hashes_path = os.path.join(patient_dir, CONVERSION_HASHES_NAME)
+    if not os.path.exists(hashes_path):
+        return {}
+    try:
+        with open(hashes_path, 'r') as f:
+            return json.load(f).get("structures", {})
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable {hashes_path}: {e}")
+        return {}
+
+def write_conversion_hashes(patient_dir, hashes):
+    """Write conversion_hashes.json atomically (temp file + rename)."""
+    hashes_path = os.path.join(patient_dir, CONVERSION_HASHES_NAME)
+    tmp_path = f"{hashes_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump({"structures": hashes}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, hashes_path)
 
 # ---------------------------------------------------------
 # Part 2: RTSTRUCT to SEG Conversion Logic
 # ---------------------------------------------------------
 
-def find_dicom_series_in_dir(directory, target_series_uid=None):
+class SeriesCache:
     """
-    Finds the DICOM series files in a directory using SimpleITK.
+    Series resolved during one run, by SeriesInstanceUID: the geometry, the slice
+    headers in slice order and, once a SEG needs them, the source datasets.
+    Every RTSTRUCT of a folder that references the series (e.g. one per observer)
+    reuses them instead of resolving the series, or loading its volume, again.
     """
-    reader = sitk.ImageSeriesReader()
-    try:
-        series_ids = reader.GetGDCMSeriesIDs(directory)
-    except Exception as e:
-        logging.warning(f"Could not read series IDs from {directory}: {e}")
-        return None, None, None
+
+    def __init__(self):
+        self._series = {}
+        self._datasets = {}
+
+    def get(self, series_uid, load_volume=False):
+        """(SeriesGeometry, slice headers) of a resolved series, or None."""
+        return self._series.get((series_uid, load_volume))
+
+    def put(self, series_uid, load_volume, series, slice_headers):
+        self._series[(series_uid, load_volume)] = (series, slice_headers)
+
+    def source_datasets(self, series_uid, slice_headers):
+        """The pixel-less datasets of the series' slices, prepared for highdicom once."""
+        if series_uid not in self._datasets:
+            datasets = [h.dataset for h in slice_headers]
+
+            # Remove SpacingBetweenSlices from source datasets to prevent it from being added to the SEG
+            # This matches the "Good" file structure and forces viewers to rely on explicit frame positions
+            for ds in datasets:
+                if 'SpacingBetweenSlices' in ds:
+                    del ds.SpacingBetweenSlices
+            self._datasets[series_uid] = datasets
+        return self._datasets[series_uid]
+
+def find_dicom_series_in_dir(directory, target_series_uid=None, index=None, load_volume=False, series_cache=None):
+    """
+    Finds the DICOM series files in a directory (served by `index` if given).
+    The series geometry comes from the slice headers (IPP/IOP/PixelSpacing);
+    load_volume=True loads the whole volume with SimpleITK instead, to cross-check.
+    series_cache: optional SeriesCache answering series resolved earlier in the run.
+    Returns: (SeriesGeometry, slice headers in slice order, series UID)
+    """
+    if index is None:
+        index = DicomIndex.build(directory)
+
+    series = index.series()
+    series_ids = list(series)
 
     if not series_ids:
         return None, None, None
@@ -119,21 +186,29 @@ def find_dicom_series_in_dir(directory, target_series_uid=None):
             # or the user wants us to guess. But strictly we should match.
             # Let's try to return the largest series if we can't find exact match,
             # BUT warning this might be wrong for multi-series folders.
-            logging.warning(f"Target Series UID {target_series_uid} not found in ITK IDs: {series_ids}. Trying best guess.")
+            logging.warning(f"Target Series UID {target_series_uid} not found in series: {series_ids}. Trying best guess.")
             # Heuristic: the series with most files is likely the CT volume
-            max_files = 0
-            best_id = None
-            for sid in series_ids:
-                fnames = reader.GetGDCMSeriesFileNames(directory, sid)
-                if len(fnames) > max_files:
-                    max_files = len(fnames)
-                    best_id = sid
-            selected_series_id = best_id
+            selected_series_id = max(series_ids, key=lambda sid: len(series[sid]))
     else:
         selected_series_id = series_ids[0]
 
-    dicom_names = reader.GetGDCMSeriesFileNames(directory, selected_series_id)
-    reader.SetFileNames(dicom_names)
+    if series_cache is not None:
+        cached = series_cache.get(selected_series_id, load_volume)
+        if cached is not None:
+            logging.info(f"Reusing series {selected_series_id} resolved earlier in this run")
+            return cached[0], cached[1], selected_series_id
+
+    headers = sort_slices(series[selected_series_id])
+
+    if not load_volume:
+        geometry = SeriesGeometry.from_headers(headers)
+        if series_cache is not None:
+            series_cache.put(selected_series_id, load_volume, geometry, headers)
+        return geometry, headers, selected_series_id
+
+    import SimpleITK as sitk
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames([h.path for h in headers])
 
     try:
         itk_image = reader.Execute()
@@ -141,17 +216,10 @@ def find_dicom_series_in_dir(directory, target_series_uid=None):
         logging.error(f"Failed to load series {selected_series_id}: {e}")
         return None, None, None
 
-    # Load source datasets for highdicom
-    source_datasets = []
-    for fname in dicom_names:
-        try:
-            ds = pydicom.dcmread(fname)
-            source_datasets.append(ds)
-        except Exception as e:
-            logging.warning(f"Failed to read DICOM file {fname}: {e}")
-            return None, None, None
-
-    return itk_image, source_datasets, selected_series_id
+    geometry = SeriesGeometry.from_itk_image(itk_image)
+    if series_cache is not None:
+        series_cache.put(selected_series_id, load_volume, geometry, headers)
+    return geometry, headers, selected_series_id
 
 def select_structures_gui(structure_info, file_name=""):
     """
@@ -162,6 +230,9 @@ def select_structures_gui(structure_info, file_name=""):
     if not structure_info:
         return []
 
+    # Imported on demand: headless runs (--job, the scorer's ingestion workers) never open a window
+    import tkinter as tk
+
     selected_roi_numbers = []
 
     # Create valid root
@@ -239,19 +310,234 @@ def select_structures_gui(structure_info, file_name=""):
     root.mainloop()
     return selected_roi_numbers
 
-def process_rtstruct(rtstruct_path, output_dir, target_roi_numbers=None):
+# Per-process state of the ROI conversion (set by _init_roi_worker)
+_roi_context = None
+
+def _init_roi_worker(context):
+    """Shares the read-only series geometry and source headers with a worker, once per process."""
+    global _roi_context
+    _roi_context = context
+
+def rasterize_roi(contours, context):
     """
-    Converts an RTSTRUCT file to multiple SEG files.
-    Returns: list of paths to generated SEG files.
+    Rasterizes the closed planar contours of one ROI, one even-odd fill per slice
+    (see contour_fill.fill_slice_indices). The mask is kept sparse, so memory
+    follows the structure's size rather than the volume's.
+    Returns: {mask slice index: sorted flat in-slice pixel indices}, or None if no
+    contour lies on a slice of the series.
     """
-    logging.info(f"Processing RTSTRUCT: {rtstruct_path}")
-    generated_files = []
+    if not contours:
+        return None
+
+    _, height, width = context["shape"]
+
+    # Determine Z-indices of all contours at once
+    z_indices, distances = context["geometry"].nearest([points[0][2] for points in contours])
+
+    # Get X,Y indices of every point of the ROI in one transform
+    contour_indices = np.split(context["to_index"](np.concatenate(contours)),
+                               np.cumsum([len(points) for points in contours])[:-1])
+
+    # Group the contours by slice: all contours of a slice fill together, even-odd,
+    # so inner contours cut holes
+    by_slice = {}
+    for indices, z_idx, dist in zip(contour_indices, z_indices, distances):
+        if dist > context["tolerance"]:
+            continue
+        # (row, column) = (y, x) continuous indices
+        by_slice.setdefault(int(z_idx), []).append(indices[:, 1::-1])
 
+    mask_slices = {}
+    for z_idx in sorted(by_slice):
+        # Rasterize
+        pixels = fill_slice_indices(by_slice[z_idx], (height, width))
+        if len(pixels):
+            mask_slices[z_idx] = pixels
+
+    return mask_slices or None
+
+def mask_to_reference_indices(mask_slices, context):
+    """
+    Flat reference indices (sorted, unique) of a rasterized mask. Mask slices are
+    mapped to reference slices by Z, as a SEG's frames would be.
+    """
+    slice_size = context["slice_size"]
+    indices = []
+    skipped = 0
+    for z_idx, pixels in mask_slices.items():
+        reference_slice = context["slice_map"][z_idx]
+        if reference_slice < 0:
+            skipped += len(pixels)
+            continue
+        indices.append(reference_slice * slice_size + pixels)
+    if skipped:
+        logging.warning(f"  {skipped} voxels on slices outside the reference geometry. Skipping them.")
+    return np.unique(np.concatenate(indices)) if indices else np.zeros(0, dtype=np.int64)
+
+def stack_frames(segment_slices, slice_positions, shape):
+    """
+    Densifies sparse masks for highdicom, on the slices that hold a voxel only.
+    segment_slices: [{mask slice index: in-slice pixel indices}], one per segment
+    slice_positions: ImagePositionPatient of every mask slice
+    shape: (depth, height, width) of the mask volume
+    Returns: (bool (frames, height, width, segments) pixel array, PlanePositionSequence of each frame)
+    """
+    _, height, width = shape
+    frame_slices = sorted(set().union(*segment_slices))
+    frame_of_slice = {z_idx: frame for frame, z_idx in enumerate(frame_slices)}
+
+    pixel_array = np.zeros((len(frame_slices), height * width, len(segment_slices)), dtype=bool)
+    for segment_index, mask_slices in enumerate(segment_slices):
+        for z_idx, pixels in mask_slices.items():
+            pixel_array[frame_of_slice[z_idx], pixels, segment_index] = True
+
+    plane_positions = [
+        PlanePositionSequence(coordinate_system=CoordinateSystemNames.PATIENT,
+                              image_position=list(slice_positions[z_idx]))
+        for z_idx in frame_slices
+    ]
+    return pixel_array.reshape(len(frame_slices), height, width, len(segment_slices)), plane_positions
+
+def make_segment_description(segment_number, roi_name):
+    return SegmentDescription(
+        segment_number=segment_number,
+        segment_label=roi_name,
+        segmented_property_category=codes.SCT.Organ,
+        segmented_property_type=codes.SCT.Organ,
+        algorithm_type=SegmentAlgorithmTypeValues.MANUAL,
+        algorithm_identification=AlgorithmIdentificationSequence(
+            name="RTSTRUCT2SEG",
+            version="1.0",
+            family=codes.DCM.ArtificialIntelligence,
+        ),
+    )
+
+def create_segmentation(source_datasets, segment_slices, segment_descriptions, series_number, context):
+    """
+    Builds a BINARY SEG of sparse masks (see stack_frames); only the slices with
+    voxels are encoded and empty frames are omitted.
+    """
+    pixel_array, plane_positions = stack_frames(segment_slices, context["slice_positions"], context["shape"])
+    seg_dataset = Segmentation(
+        source_images=source_datasets,
+        pixel_array=pixel_array,
+        plane_positions=plane_positions,
+        segmentation_type="BINARY",
+        segment_descriptions=segment_descriptions,
+        series_instance_uid=generate_uid(),
+        series_number=series_number,
+        sop_instance_uid=generate_uid(),
+        instance_number=1,
+        manufacturer="Custom RTSTRUCT Converter",
+        manufacturer_model_name="RTSTRUCT2SEG",
+        software_versions="0.1",
+        device_serial_number="123456",
+        omit_empty_frames=True,
+    )
+
+    # As for the source datasets: no SpacingBetweenSlices, viewers use the frame positions.
+    # highdicom derives one from the encoded frames, which is the gap between the
+    # structure's slices rather than the series spacing.
+    for measures in seg_dataset.SharedFunctionalGroupsSequence[0].get('PixelMeasuresSequence', []):
+        if 'SpacingBetweenSlices' in measures:
+            del measures.SpacingBetweenSlices
+    return seg_dataset
+
+def convert_roi(task):
+    """
+    Rasterizes one ROI into reference indices and, if enabled, saves it as a
+    single-segment SEG next to its final path.
+    task: (roi_number, roi_name, contours, out_path)
+    Returns: (indices, path of the saved part file or None, sparse mask (see
+    rasterize_roi) if context["keep_masks"] else None), or None if the ROI is empty.
+    """
+    roi_number, roi_name, contours, out_path = task
+    context = _roi_context
+
+    mask_slices = rasterize_roi(contours, context)
+    if mask_slices is None:
+        logging.warning(f"  ROI {roi_name} empty. Skipping.")
+        return None
+
+    logging.info(f"  Generated mask for: {roi_name}")
+    indices = mask_to_reference_indices(mask_slices, context)
+
+    # The multi-segment SEG is assembled by the caller from the sparse masks
+    mask = mask_slices if context["keep_masks"] else None
+
+    if not context["write_seg"]:
+        return indices, None, mask
+
+    # Create SEG
+    try:
+        seg_dataset = create_segmentation(context["source_datasets"], [mask_slices],
+                                          [make_segment_description(1, roi_name)], 100 + roi_number, context)
+
+        seg_dataset.SeriesDescription = roi_name
+
+        part_path = f"{out_path}.{roi_number}.part"
+        seg_dataset.save_as(part_path)
+        return indices, part_path, mask
+
+    except Exception as e:
+        logging.error(f"  Failed to save SEG for {roi_name}: {e}")
+        return indices, None, mask
+
+def write_multi_segment_seg(source_datasets, segments, context, out_path, series_description):
+    """
+    Saves the ROIs of one RTSTRUCT as a single SEG with one segment per ROI.
+    Only slices holding a voxel of some ROI are encoded, and empty (segment, slice)
+    frames are omitted, so the file stays as sparse as the structures.
+    segments: [(roi_name, sparse mask (see rasterize_roi))] in segment order
+    Returns: out_path, or None if the SEG could not be written
+    """
     try:
-        rtstruct = pydicom.dcmread(rtstruct_path)
+        seg_dataset = create_segmentation(
+            source_datasets, [mask_slices for _, mask_slices in segments],
+            [make_segment_description(n, roi_name) for n, (roi_name, _) in enumerate(segments, start=1)],
+            100, context,
+        )
+        seg_dataset.SeriesDescription = series_description
+        seg_dataset.save_as(out_path)
+        logging.info(f"  Saved multi-segment SEG: {os.path.basename(out_path)} "
+                     f"({len(segments)} segments, {seg_dataset.NumberOfFrames} frames)")
+        return out_path
     except Exception as e:
-        logging.error(f"Could not read RTSTRUCT {rtstruct_path}: {e}")
+        logging.error(f"  Failed to save multi-segment SEG {os.path.basename(out_path)}: {e}")
+        return None
+
+def process_rtstruct(rtstruct_path, output_dir, target_roi_numbers=None, workers=1,
+                     write_seg=True, reference_geometry=None, index=None, load_volume=False,
+                     multi_segment=False, is_unchanged=None, series_cache=None):
+    """
+    Converts an RTSTRUCT file to reference indices straight from the rasterized
+    masks, plus (write_seg) one SEG file per ROI in output_dir, or with
+    multi_segment a single SEG holding one segment per ROI.
+    Indices address reference_geometry (see load_reference_geometry); by default
+    the sorted slices of the referenced series.
+    With workers > 1 the ROIs are rasterized and encoded in a process pool;
+    the output is the same as a sequential run.
+    index: DicomIndex of the RTSTRUCT's folder (built here if not given).
+    load_volume: take the series geometry from a SimpleITK volume load instead of the headers.
+    is_unchanged: optional callable(patient_id, structure_name, roi_hash) -> bool; ROIs
+    it accepts are skipped (with multi_segment, only if it accepts all of them).
+    series_cache: SeriesCache shared by the RTSTRUCTs of one folder (a new one if not given).
+    Returns: list of dicts (patient_id, structure_name, indices, seg_path or None,
+    segment_number in that SEG, roi_hash), in ROI order.
+    """
+    logging.info(f"Processing RTSTRUCT: {rtstruct_path}")
+    converted = []
+
+    # Look for images in the same directory as RTSTRUCT
+    input_dir = os.path.dirname(rtstruct_path)
+    if index is None:
+        index = DicomIndex.build(input_dir)
+
+    header = index.get(rtstruct_path)
+    if header is None:
+        logging.error(f"Could not read RTSTRUCT {rtstruct_path}")
         return []
+    rtstruct = header.dataset
 
     if 'ReferencedFrameOfReferenceSequence' not in rtstruct:
         logging.error("RTSTRUCT missing ReferencedFrameOfReferenceSequence")
@@ -271,57 +557,48 @@ def process_rtstruct(rtstruct_path, output_dir, target_roi_numbers=None):
         logging.error("Could not determine Referenced Series Instance UID from RTSTRUCT")
         return []
 
-    # Look for images in the same directory as RTSTRUCT
-    input_dir = os.path.dirname(rtstruct_path)
+    if series_cache is None:
+        series_cache = SeriesCache()
 
     # Try finding series
-    itk_image, source_datasets, loaded_series_uid = find_dicom_series_in_dir(input_dir, ref_series_uid)
+    series, slice_headers, loaded_series_uid = find_dicom_series_in_dir(input_dir, ref_series_uid, index=index,
+                                                                         load_volume=load_volume,
+                                                                         series_cache=series_cache)
 
-    if itk_image is None:
+    if series is None:
         logging.error(f"Could not find Referenced Series {ref_series_uid} (or suitable fallback) in {input_dir}")
         return []
 
-    width, height, depth = itk_image.GetSize()
+    width, height, depth = series.size
 
-    # Build Z-map from source datasets
-    z_positions = []
-    for ds in source_datasets:
-        try:
-            ipp = ds.ImagePositionPatient
-            z = float(ipp[2])
-            z_positions.append(z)
-        except:
-            z_positions.append(float('nan'))
-
-    # Helper for specific conversion z-lookup
-    def get_z_index_local(target_z, positions):
-        best_idx = -1
-        min_dist = float('inf')
-        for idx, pos in enumerate(positions):
-            if np.isnan(pos): continue
-            dist = abs(target_z - pos)
-            if dist < min_dist:
-                min_dist = dist
-                best_idx = idx
-        return best_idx, min_dist
+    # Patient (mm) -> continuous voxel index, as ITK maps it, for all points at once
+    to_index = series.to_index()
+
+    # Build Z geometry from the slice headers (slice index = position in slice order)
+    geometry = VolumeGeometry([h.position[2] for h in slice_headers])
 
     # Get slice spacing for tolerance
     try:
-        if len(z_positions) > 1:
-            valid_zs = [z for z in z_positions if not np.isnan(z)]
-            slice_spacing = abs(valid_zs[1] - valid_zs[0])
+        if geometry.slice_spacing is not None:
+            slice_spacing = geometry.slice_spacing
         else:
-            slice_spacing = float(itk_image.GetSpacing()[2])
+            slice_spacing = float(series.spacing[2])
     except:
         slice_spacing = 2.0
 
     tolerance = slice_spacing * 0.55
 
-    # Remove SpacingBetweenSlices from source datasets to prevent it from being added to the SEG
-    # This matches the "Good" file structure and forces viewers to rely on explicit frame positions
-    for ds in source_datasets:
-        if 'SpacingBetweenSlices' in ds:
-            del ds.SpacingBetweenSlices
+    if reference_geometry is None:
+        reference_geometry = VolumeGeometry.from_positions(geometry.z_positions[~np.isnan(geometry.z_positions)], (height, width))
+    elif reference_geometry.dimensions and tuple(reference_geometry.dimensions) != (height, width):
+        logging.error(f"Dimension mismatch for {rtstruct_path}. Expected {reference_geometry.dimensions}, series has {(height, width)}.")
+        return []
+
+    # highdicom only reads the source headers; they are parsed (if the index has
+    # them from its cache) only when a SEG is written
+    source_datasets = None
+    if write_seg:
+        source_datasets = series_cache.source_datasets(loaded_series_uid, slice_headers)
 
     # Parse ROIs
     if 'ROIContourSequence' not in rtstruct:
@@ -333,6 +610,11 @@ def process_rtstruct(rtstruct_path, output_dir, target_roi_numbers=None):
         for roi in rtstruct.StructureSetROISequence:
             roi_map[roi.ROINumber] = roi
 
+    patient_id = safe_name(slice_headers[0].patient_id or "UnknownPatient")
+    output_mode = ("multi" if multi_segment else "single") if write_seg else "none"
+
+    tasks = []
+    hashes = []
     for roi_contour in rtstruct.ROIContourSequence:
         roi_number = roi_contour.ReferencedROINumber
         if roi_number not in roi_map:
@@ -348,179 +630,403 @@ def process_rtstruct(rtstruct_path, output_dir, target_roi_numbers=None):
         if not hasattr(roi_contour, 'ContourSequence'):
             continue
 
-        # Create mask for this ROI
-        mask_array = np.zeros((depth, height, width), dtype=np.uint8)
-        has_data = False
-
-        for contour in roi_contour.ContourSequence:
-            if not hasattr(contour, 'ContourData'):
-                continue
-
-            points_flat = contour.ContourData
-            points = np.array(points_flat).reshape(-1, 3)
+        contours = [np.array(contour.ContourData).reshape(-1, 3)
+                    for contour in roi_contour.ContourSequence if hasattr(contour, 'ContourData')]
+
+        tasks.append((roi_number, str(roi_name), contours, os.path.join(output_dir, f"{safe_name(roi_name)}.dcm")))
+        hashes.append(roi_hash(str(roi_name), contours, series, geometry, reference_geometry, output_mode))
+
+    if is_unchanged is not None and tasks:
+        unchanged = [is_unchanged(patient_id, safe_name(task[1]), digest) for task, digest in zip(tasks, hashes)]
+        if multi_segment and not all(unchanged):
+            # The shared SEG is rewritten with every ROI
+            unchanged = [False] * len(tasks)
+        if any(unchanged):
+            logging.info(f"  Skipping {sum(unchanged)} unchanged ROIs")
+            tasks = [task for task, skip in zip(tasks, unchanged) if not skip]
+            hashes = [digest for digest, skip in zip(hashes, unchanged) if not skip]
+
+    context = {
+        "source_datasets": source_datasets,
+        "geometry": geometry,
+        "to_index": to_index,
+        "tolerance": tolerance,
+        "shape": (depth, height, width),
+        "slice_positions": [h.position for h in slice_headers],
+        "slice_map": reference_geometry.lookup(geometry.z_positions),
+        "slice_size": height * width,
+        "write_seg": write_seg and not multi_segment,
+        "keep_masks": write_seg and multi_segment,
+    }
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks)),
+                                 initializer=_init_roi_worker, initargs=(context,)) as executor:
+            results = list(executor.map(convert_roi, tasks))
+    else:
+        _init_roi_worker(context)
+        results = [convert_roi(task) for task in tasks]
 
-            # Determine Z-index
-            contour_z = points[0][2]
-            z_idx, dist = get_z_index_local(contour_z, z_positions)
+    # Workers save to per-ROI part files; publishing them in ROI order keeps the
+    # output identical to a sequential run (a later ROI wins a file name clash)
+    for result, (_, roi_name, _, out_path), digest in zip(results, tasks, hashes):
+        if result is None:
+            continue
+        indices, part_path, _ = result
+        seg_path = None
+        if part_path is not None:
+            os.replace(part_path, out_path)
+            logging.info(f"  Saved SEG: {os.path.basename(out_path)}")
+            seg_path = out_path
+        converted.append({
+            "patient_id": patient_id,
+            "structure_name": safe_name(roi_name),
+            "indices": indices,
+            "seg_path": seg_path,
+            "segment_number": 1,
+            "roi_hash": digest,
+        })
+
+    if context["keep_masks"] and converted:
+        label = str(rtstruct.get('StructureSetLabel', '') or 'Structures')
+        segments = [(roi_name, result[2]) for result, (_, roi_name, _, _) in zip(results, tasks) if result is not None]
+        seg_path = write_multi_segment_seg(source_datasets, segments, context,
+                                           os.path.join(output_dir, f"{safe_name(label)}_segments.dcm"), label)
+        for segment_number, entry in enumerate(converted, start=1):
+            entry["seg_path"] = seg_path
+            entry["segment_number"] = segment_number
+
+    return converted
 
-            if dist > tolerance:
-                continue
+# ---------------------------------------------------------
+# Part 3: Orchestration
+# ---------------------------------------------------------
 
-            # Get X,Y indices using ITK
-            indices = [itk_image.TransformPhysicalPointToContinuousIndex(p) for p in points]
-            r_coords = [p[1] for p in indices]
-            c_coords = [p[0] for p in indices]
+def convert_folder(input_dir, references_base_dir, select_rois=None, workers=1, scan_threads=None,
+                   header_cache=None, load_volume=False, write_seg=True, multi_segment=False,
+                   compress_binary=False, force=False):
+    """
+    Converts every RTSTRUCT of input_dir and writes the JSON/binary references,
+    stored versions, manifests and ROI hashes to references_base_dir.
+    select_rois: optional callable(rtstruct_path, [(roi_number, roi_name)]) returning the
+    ROI numbers to convert (empty = skip the RTSTRUCT); None converts every ROI.
+    Returns: dict report (folder, rtstructs, converted [{patient_id, structure_name,
+    voxels, seg_path}], unchanged [structure names], error or None)
+    """
+    input_dir = Path(input_dir)
+    references_base_dir = Path(references_base_dir)
+    report = {"folder": str(input_dir), "rtstructs": 0, "converted": [], "unchanged": [], "error": None}
 
-            # Rasterize
-            rr, cc = draw.polygon(r_coords, c_coords, shape=(height, width))
-            mask_array[z_idx, rr, cc] = 1
-            has_data = True
+    # 1. Index every header of the folder once; all later steps are served from it
+    index = DicomIndex.build(input_dir, threads=scan_threads, cache=header_cache)
+    logging.info(f"Indexed {len(index)} DICOM headers.")
 
-        if not has_data:
-            logging.warning(f"  ROI {roi_name} empty. Skipping.")
-            continue
+    rtstruct_files = [Path(h.path) for h in index.rtstructs()]
+    report["rtstructs"] = len(rtstruct_files)
 
-        logging.info(f"  Generated mask for: {roi_name}")
-
-        # Create SEG
-        segment_description = SegmentDescription(
-            segment_number=1,
-            segment_label=roi_name,
-            segmented_property_category=codes.SCT.Organ,
-            segmented_property_type=codes.SCT.Organ,
-            algorithm_type=SegmentAlgorithmTypeValues.MANUAL,
-            algorithm_identification=AlgorithmIdentificationSequence(
-                name="RTSTRUCT2SEG",
-                version="1.0",
-                family=codes.DCM.ArtificialIntelligence,
-            ),
-        )
+    if not rtstruct_files:
+        logging.warning("No RTSTRUCT files found in directory.")
+        report["error"] = "No RTSTRUCT files found"
+        return report
 
-        try:
-            seg_dataset = Segmentation(
-                source_images=source_datasets,
-                pixel_array=mask_array,
-                segmentation_type="BINARY",
-                segment_descriptions=[segment_description],
-                series_instance_uid=generate_uid(),
-                series_number=100 + roi_number,
-                sop_instance_uid=generate_uid(),
-                instance_number=1,
-                manufacturer="Custom RTSTRUCT Converter",
-                manufacturer_model_name="RTSTRUCT2SEG",
-                software_versions="0.1",
-                device_serial_number="123456",
-            )
+    logging.info(f"Found {len(rtstruct_files)} RTSTRUCT files.")
 
-            seg_dataset.SeriesDescription = roi_name
+    # 1b. Build Reference Geometry the indices are expressed in
+    logging.info("Building Reference Geometry...")
+    geometry = load_reference_geometry(input_dir, index=index)
 
-            safe_roi_name = "".join([c for c in roi_name if c.isalnum() or c in (' ', '_', '-')]).strip()
-            out_filename = f"{safe_roi_name}.dcm"
-            out_path = os.path.join(output_dir, out_filename)
+    if geometry is None:
+        logging.error("Failed to build reference geometry from CT files. Cannot create JSONs.")
+        report["error"] = "No CT series to build the reference geometry from"
+        return report
 
-            seg_dataset.save_as(out_path)
-            logging.info(f"  Saved SEG: {out_filename}")
-            generated_files.append(out_path)
+    # 2. Process RTSTRUCTs
+    all_converted = []
+
+    # ROIs whose hash matches the last conversion and whose outputs still exist are skipped
+    recorded_hashes = {}
+    unchanged = []
+
+    # RTSTRUCTs referencing the same series share its geometry and headers
+    series_cache = SeriesCache()
+
+    def is_unchanged(patient_id, structure_name, digest):
+        if force:
+            return False
+        patient_dir = references_base_dir / patient_id
+        if patient_id not in recorded_hashes:
+            recorded_hashes[patient_id] = load_conversion_hashes(patient_dir)
+        record = recorded_hashes[patient_id].get(structure_name)
+        if record is None or record.get("roi_hash") != digest or record.get("compress") != compress_binary:
+            return False
+        outputs = [patient_dir / f"{structure_name}.json", patient_dir / f"{structure_name}{REFERENCE_BINARY_EXT}"]
+        if record.get("seg_path"):
+            outputs.append(Path(record["seg_path"]))
+        if all(path.exists() for path in outputs):
+            unchanged.append(structure_name)
+            return True
+        return False
 
-        except Exception as e:
-            logging.error(f"  Failed to save SEG for {roi_name}: {e}")
+    for rts in rtstruct_files:
+        # 2a. Pre-scan for Structure Names to allow User Selection
+        selected_roi_numbers = None
+        if select_rois is not None:
+            try:
+                # An RTSTRUCT has no pixel data, so its indexed header holds all sequences
+                temp_ds = index.get(rts).dataset
+
+                structure_info = [] # List of tuples (number, name)
+
+                if 'StructureSetROISequence' in temp_ds:
+                    for roi_item in temp_ds.StructureSetROISequence:
+                        try:
+                            r_num = roi_item.ROINumber
+                            r_name = roi_item.get("ROIName", f"Unnamed_ROI_{r_num}")
+                            structure_info.append((r_num, r_name))
+                        except Exception:
+                            continue
+
+                    # Sort by name for nicer display
+                    structure_info.sort(key=lambda x: x[1])
+
+                    if structure_info:
+                         selected_roi_numbers = select_rois(str(rts), structure_info)
+                         if not selected_roi_numbers:
+                             logging.warning(f"No structures selected for {rts.name}. Skipping file.")
+                             continue
+                else:
+                     logging.warning(f"No StructureSetROISequence in {rts.name}")
+            except Exception as e:
+                logging.error(f"Error reading structure names from {rts}: {e}")
 
-    return generated_files
+        # 2b. Process with selection
+        converted = process_rtstruct(str(rts), str(input_dir), target_roi_numbers=selected_roi_numbers,
+                                     workers=workers, write_seg=write_seg, reference_geometry=geometry,
+                                     index=index, load_volume=load_volume, multi_segment=multi_segment,
+                                     is_unchanged=is_unchanged, series_cache=series_cache)
+        all_converted.extend(converted)
+
+    converted_names = {c["structure_name"] for c in all_converted}
+    report["unchanged"] = [name for name in unchanged if name not in converted_names]
+
+    if not all_converted:
+        logging.warning("No structures were converted (or all were unchanged).")
+        return report
+
+    logging.info(f"Successfully converted {len(all_converted)} structures "
+                 f"({len(set(c['seg_path'] for c in all_converted if c['seg_path']))} SEG files).")
+
+    # 3. Write References (straight from the rasterized masks). Batch jobs convert
+    # folders in parallel processes, and two folders can hold the same patient, so
+    # each patient's files are written under its lock and the ROI hashes are
+    # re-read inside it.
+    by_patient = {}
+    for result in all_converted:
+        if len(result["indices"]) > 0:
+            by_patient.setdefault(result["patient_id"], []).append(result)
+
+    for patient_id, results in by_patient.items():
+        patient_dir = references_base_dir / patient_id
+        with patient_lock(patient_dir):
+            hashes = load_conversion_hashes(patient_dir)
+            for result in results:
+                structure_name, indices = result["structure_name"], result["indices"]
+                output_json = patient_dir / f"{structure_name}.json"
+
+                data = {
+                    "non_zero_indices": indices.tolist(),
+                    "origin_slice_index": 0
+                }
+
+                with open(output_json, 'w') as f:
+                    json.dump(data, f)
+
+                output_binary = patient_dir / f"{structure_name}{REFERENCE_BINARY_EXT}"
+                write_binary_reference(output_binary, indices, 0, compress=compress_binary)
+                version = store_reference(references_base_dir, patient_id, structure_name, indices, 0, compress=compress_binary)
+                update_manifest(patient_dir, structure_name, indices, make_geometry(geometry.slice_positions, geometry.dimensions))
+
+                logging.info(f"Created JSON: {output_json} ({len(indices)} voxels) + {output_binary.name}, version {version[:12]}")
+
+                if write_seg and not result["seg_path"]:
+                    # The requested SEG was not written; convert the ROI again next time
+                    hashes.pop(structure_name, None)
+                else:
+                    hashes[structure_name] = {
+                        "roi_hash": result["roi_hash"],
+                        "seg_path": result["seg_path"],
+                        "compress": compress_binary,
+                    }
+
+            # 4. Record the ROI hashes for the next run
+            write_conversion_hashes(patient_dir, hashes)
+
+    for result in all_converted:
+        report["converted"].append({
+            "patient_id": result["patient_id"],
+            "structure_name": result["structure_name"],
+            "voxels": int(len(result["indices"])),
+            "seg_path": result["seg_path"],
+        })
+
+    return report
 
 # ---------------------------------------------------------
-# Part 3: SEG to JSON Conversion Logic
+# Part 4: Headless batch conversion (--job)
 # ---------------------------------------------------------
 
-def get_indices_from_seg(dcm_path, z_map, sorted_zs, ref_dims):
+def load_job(job_path):
     """
-    Reads a DICOM SEG file and maps its frames to global indices.
+    Reads a batch job file (.json, or .yaml/.yml if PyYAML is installed):
+
+        references_dir: References     # optional, relative to the job file
+        workers: 4                     # patient folders converted at once
+        roi_workers: 1                 # ROI processes per folder
+        rois: ["*"]                    # default ROI name patterns (case-insensitive fnmatch)
+        write_seg: true
+        multi_segment: false
+        compress_binary: false
+        force: false
+        report: batch_report.json      # optional, relative to the job file
+        patients:
+          - folder: Patient01          # relative to the job file
+            rois: ["Heart", "Lung*"]
+          - Patient02                  # shorthand: the default patterns
+
+    Returns: dict with every key filled in (paths absolute), patients as [{folder, rois}]
     """
+    job_path = Path(job_path).absolute()
+    with open(job_path, 'r') as f:
+        if job_path.suffix.lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML job files need PyYAML (pip install pyyaml); use a JSON job file instead")
+            job = yaml.safe_load(f) or {}
+        else:
+            job = json.load(f)
+
+    base_dir = job_path.parent
+    default_rois = job.get("rois") or ["*"]
+
+    patients = []
+    for entry in job.get("patients") or []:
+        if isinstance(entry, str):
+            entry = {"folder": entry}
+        if not entry.get("folder"):
+            raise ValueError(f"Job entry without a folder: {entry}")
+        patients.append({"folder": str(base_dir / entry["folder"]), "rois": entry.get("rois") or default_rois})
+    if not patients:
+        raise ValueError(f"Job file {job_path} lists no patients")
+
+    return {
+        "references_dir": str(base_dir / job.get("references_dir", "References")),
+        "report": str(base_dir / job.get("report", f"{job_path.stem}_report.json")),
+        "workers": int(job.get("workers", os.cpu_count() or 1)),
+        "roi_workers": int(job.get("roi_workers", 1)),
+        "write_seg": bool(job.get("write_seg", True)),
+        "multi_segment": bool(job.get("multi_segment", False)),
+        "compress_binary": bool(job.get("compress_binary", False)),
+        "force": bool(job.get("force", False)),
+        "header_cache": bool(job.get("header_cache", True)),
+        "patients": patients,
+    }
+
+def roi_pattern_selector(patterns):
+    """select_rois callback of convert_folder taking the ROIs whose name matches any pattern."""
+    patterns = [str(p).lower() for p in patterns]
+
+    def select(rtstruct_path, structure_info):
+        return [number for number, name in structure_info
+                if any(fnmatch.fnmatchcase(str(name).lower(), p) for p in patterns)]
+    return select
+
+def convert_job_folder(patient, job):
+    """Converts one job entry (runs in a batch worker process). Returns its report entry."""
+    started = time.time()
     try:
-        dcm = pydicom.dcmread(dcm_path)
+        report = convert_folder(
+            patient["folder"], job["references_dir"], select_rois=roi_pattern_selector(patient["rois"]),
+            workers=job["roi_workers"], header_cache=open_header_cache() if job["header_cache"] else None,
+            write_seg=job["write_seg"], multi_segment=job["multi_segment"],
+            compress_binary=job["compress_binary"], force=job["force"],
+        )
+        report["status"] = "failed" if report["error"] else "done"
     except Exception as e:
-        logging.error(f"Failed to read DICOM {dcm_path}: {e}")
-        return None, None, None
-
-    # Check for Segmentation Storage
-    if dcm.SOPClassUID != '1.2.840.10008.5.1.4.1.1.66.4':
-        return None, None, None
-
-    pixel_array = dcm.pixel_array
-
-    # Handle single frame
-    if len(pixel_array.shape) == 2:
-        pixel_array = pixel_array[np.newaxis, :, :]
-
-    num_frames = pixel_array.shape[0]
-
-    if ref_dims:
-       current_slice_size = pixel_array.shape[1] * pixel_array.shape[2]
-       ref_slice_size = ref_dims[0] * ref_dims[1]
-       if current_slice_size != ref_slice_size:
-           logging.warning(f"Dimension mismatch for {dcm_path}. Expected {ref_dims}. Skipping.")
-           return None, None, None
+        logging.error(f"Conversion of {patient['folder']} failed: {e}")
+        report = {"folder": patient["folder"], "rtstructs": 0, "converted": [], "unchanged": [],
+                  "error": str(e), "status": "failed"}
+    report["seconds"] = round(time.time() - started, 3)
+    return report
+
+def write_batch_report(report_path, report):
+    """Write the batch report atomically (temp file + rename), so it can be polled while running."""
+    tmp_path = f"{report_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, report_path)
+
+def run_batch(job_path):
+    """
+    Converts every patient folder of a job file without any dialog, several
+    folders at a time, and keeps a JSON progress/result report up to date.
+    Returns: the final report dict
+    """
+    job = load_job(job_path)
+    patients = job["patients"]
+    report = {
+        "job": str(Path(job_path).absolute()),
+        "references_dir": job["references_dir"],
+        "total": len(patients),
+        "completed": 0,
+        "failed": 0,
+        "patients": [{"folder": p["folder"], "status": "queued"} for p in patients],
+    }
+    write_batch_report(job["report"], report)
+    logging.info(f"Batch: {len(patients)} folders, {job['workers']} at a time. Report: {job['report']}")
+
+    def record(position, entry):
+        report["patients"][position] = entry
+        report["completed"] += 1
+        report["failed"] += entry["status"] == "failed"
+        write_batch_report(job["report"], report)
+        logging.info(f"[{report['completed']}/{report['total']}] {entry['folder']}: {entry['status']}, "
+                     f"{len(entry['converted'])} converted, {len(entry['unchanged'])} unchanged")
+
+    workers = max(1, min(job["workers"], len(patients)))
+    if workers == 1:
+        for position, patient in enumerate(patients):
+            record(position, convert_job_folder(patient, job))
     else:
-       ref_dims = (512, 512)
-
-    slice_size = ref_dims[0] * ref_dims[1]
-    global_indices = []
-
-    if not hasattr(dcm, 'PerFrameFunctionalGroupsSequence'):
-        logging.warning(f"SEG {dcm_path} missing PerFrameFunctionalGroupsSequence.")
-        return None, None, None
-
-    pffgs = dcm.PerFrameFunctionalGroupsSequence
-
-    if len(pffgs) != num_frames:
-        logging.warning(f"Frame count mismatch in {dcm_path}.")
-        return None, None, None
-
-    for i in range(num_frames):
-        try:
-            plane_pos = pffgs[i].PlanePositionSequence[0].ImagePositionPatient
-            frame_z = float(plane_pos[2])
-        except Exception as e:
-            continue
-
-        slice_idx = find_nearest_z_index(frame_z, sorted_zs)
-
-        if slice_idx is None:
-            logging.warning(f"Frame {i} Z={frame_z} not found in reference geometry. Skipping.")
-            continue
-
-        frame_mask = pixel_array[i].astype(bool)
-        local_indices = np.flatnonzero(frame_mask)
-
-        global_offset = slice_idx * slice_size
-
-        if len(local_indices) > 0:
-            frame_global_indices = local_indices + global_offset
-            global_indices.extend(frame_global_indices.tolist())
-
-    patient_id = dcm.PatientID if 'PatientID' in dcm else "UnknownPatient"
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(convert_job_folder, patient, job): position
+                       for position, patient in enumerate(patients)}
+            for future in as_completed(futures):
+                record(futures[future], future.result())
 
-    structure_name = "UnknownStructure"
-    if 'SeriesDescription' in dcm and dcm.SeriesDescription:
-        structure_name = dcm.SeriesDescription
-    elif 'ContentLabel' in dcm:
-        structure_name = dcm.ContentLabel
-
-    safe_patient_id = "".join([c for c in patient_id if c.isalnum() or c in (' ', '_', '-')]).strip()
-    safe_structure_name = "".join([c for c in structure_name if c.isalnum() or c in (' ', '_', '-')]).strip()
-
-    return safe_patient_id, safe_structure_name, global_indices
-
-# ---------------------------------------------------------
-# Part 4: Orchestration
-# ---------------------------------------------------------
+    logging.info(f"Batch complete: {report['completed'] - report['failed']} folders converted, {report['failed']} failed.")
+    return report
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert RTSTRUCT to SEG, then SEG to JSON Reference.")
+    parser = argparse.ArgumentParser(description="Convert RTSTRUCT to JSON/binary References, with SEG files as a side output.")
     parser.add_argument("input_dir", nargs="?", default=None, help="Directory containing Images and RTSTRUCT")
     parser.add_argument("--references_dir", default="References", help="Output directory for JSON files (relative to script or absolute)")
+    parser.add_argument("--compress_binary", action="store_true", help="Delta/varint-compress the binary references (smaller, but not memory-mappable)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processes converting ROIs in parallel (1 = sequential)")
+    parser.add_argument("--scan_threads", type=int, default=None, help="Threads reading the DICOM headers (default: automatic)")
+    parser.add_argument("--no_header_cache", action="store_true", help="Parse every header instead of using the shared DICOM header cache")
+    parser.add_argument("--itk_geometry", action="store_true", help="Load each CT volume with SimpleITK for its geometry instead of reading it from the headers")
+    parser.add_argument("--no_seg", action="store_true", help="Only write the references, skip the DICOM SEG files")
+    parser.add_argument("--multi_segment", action="store_true", help="Write one SEG per RTSTRUCT with a segment per structure instead of one SEG per structure")
+    parser.add_argument("--force", action="store_true", help="Reconvert every selected structure, even if its contours and outputs are unchanged")
+    parser.add_argument("--job", default=None, help="Headless batch mode: convert the patient folders of a YAML/JSON job file (see load_job)")
 
     args = parser.parse_args()
 
+    if args.job:
+        report = run_batch(args.job)
+        return 1 if report["failed"] else 0
+
     # -------------------------------------------------------------------------
     # FOLDER SELECTION
     # -------------------------------------------------------------------------
@@ -540,6 +1046,9 @@ def main():
         logging.info("Opening folder selection dialog...")
 
         try:
+            import tkinter as tk
+            from tkinter import filedialog
+
             root = tk.Tk()
             root.withdraw()  # Hide the main window
             root.attributes('-topmost', True)  # Bring to front
@@ -578,115 +1087,20 @@ def main():
     logging.info(f"Scanning: {input_dir}")
     logging.info(f"Target JSON Directory: {references_base_dir}")
 
-    # 1. Scan for RTSTRUCTs
-    rtstruct_files = []
-    files_to_scan = [f for f in input_dir.iterdir() if f.is_file()]
-
-    for f in files_to_scan:
-        try:
-            ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
-            if ds.SOPClassUID == '1.2.840.10008.5.1.4.1.1.481.3':
-                rtstruct_files.append(f)
-        except:
-            pass
-
-    if not rtstruct_files:
-        logging.warning("No RTSTRUCT files found in directory.")
-        return
-
-    logging.info(f"Found {len(rtstruct_files)} RTSTRUCT files.")
-
-    # 2. Process RTSTRUCTs
-    all_generated_segs = []
-
-    for rts in rtstruct_files:
-        # 2a. Pre-scan for Structure Names to allow User Selection
-        selected_roi_numbers = None
-        try:
-            # We must read without stop_before_pixels sometimes to ensure we get all sequences
-            # properly, though normally StructureSetROI works fine.
-            # Changed to force=True and removed stop_before_pixels to be safe.
-            temp_ds = pydicom.dcmread(rts, force=True)
-
-            structure_info = [] # List of tuples (number, name)
-
-            if 'StructureSetROISequence' in temp_ds:
-                for roi_item in temp_ds.StructureSetROISequence:
-                    try:
-                        r_num = roi_item.ROINumber
-                        r_name = roi_item.get("ROIName", f"Unnamed_ROI_{r_num}")
-                        structure_info.append((r_num, r_name))
-                    except Exception:
-                        continue
-
-                # Sort by name for nicer display
-                structure_info.sort(key=lambda x: x[1])
-
-                if structure_info:
-                     selected_roi_numbers = select_structures_gui(structure_info, str(rts))
-                     if not selected_roi_numbers:
-                         logging.warning(f"No structures selected for {rts.name}. Skipping file.")
-                         continue
-            else:
-                 logging.warning(f"No StructureSetROISequence in {rts.name}")
-        except Exception as e:
-            logging.error(f"Error reading structure names from {rts}: {e}")
-
-        # 2b. Process with selection
-        generated = process_rtstruct(str(rts), str(input_dir), target_roi_numbers=selected_roi_numbers)
-        all_generated_segs.extend(generated)
-
-    if not all_generated_segs:
-        logging.warning("No SEG files were generated. Exiting.")
-        return
-
-    logging.info(f"Successfully generated {len(all_generated_segs)} SEG files.")
-
-    # 3. Build Reference Geometry for JSON conversion
-    logging.info("Building Reference Geometry for JSON conversion...")
-    z_map, sorted_zs, ref_dims = load_reference_geometry(input_dir)
-
-    if not sorted_zs:
-        logging.error("Failed to build reference geometry from CT files. Cannot create JSONs.")
-        return
-
-    # 4. Convert SEGs to JSON
-    logging.info("Converting Generated SEGs to JSON...")
-
-    for seg_path in all_generated_segs:
-        if not os.path.exists(seg_path):
-            continue
-
-        result = get_indices_from_seg(seg_path, z_map, sorted_zs, ref_dims)
-        if not result:
-            logging.warning(f"Could not extract indices from {seg_path}")
-            continue
-
-        patient_id, structure_name, indices = result
-
-        if indices is not None and len(indices) > 0:
-            patient_dir = references_base_dir / patient_id
-            patient_dir.mkdir(parents=True, exist_ok=True)
-
-            output_json = patient_dir / f"{structure_name}.json"
-
-            indices.sort()
-
-            data = {
-                "non_zero_indices": indices,
-                "origin_slice_index": 0
-            }
-
-            with open(output_json, 'w') as f:
-                json.dump(data, f)
-
-            logging.info(f"Created JSON: {output_json} ({len(indices)} voxels)")
+    convert_folder(
+        input_dir, references_base_dir,
+        select_rois=lambda rtstruct_path, structure_info: select_structures_gui(structure_info, rtstruct_path),
+        workers=args.workers, scan_threads=args.scan_threads,
+        header_cache=None if args.no_header_cache else open_header_cache(),
+        load_volume=args.itk_geometry, write_seg=not args.no_seg, multi_segment=args.multi_segment,
+        compress_binary=args.compress_binary, force=args.force,
+    )
 
-    logging.info("Validation processing complete.")
+    logging.info("Reference processing complete.")
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(main())
     except Exception as e:
         logging.error(f"Critical Error: {e}")
         import traceback
@@ -5,6 +5,7 @@ from tkinter import filedialog
 import concurrent.futures
 import threading
 import time
+from dicom_index import read_headers, open_header_cache
 
 # Configuration
 ORTHANC_URL = "http://localhost:8042/instances"
@@ -85,8 +86,13 @@ def upload_to_orthanc_parallel():
         for file in files:
             files_to_upload.append(os.path.join(root_dir, file))
 
+    # Skip files that are not DICOM (headers of unchanged files come from the shared cache)
+    headers = read_headers(files_to_upload, threads=MAX_WORKERS, cache=open_header_cache())
+    skipped = sum(1 for header in headers if header is None)
+    files_to_upload = [f for f, header in zip(files_to_upload, headers) if header is not None]
+
     total_files = len(files_to_upload)
-    print(f"Found {total_files} files.")
+    print(f"Found {total_files} DICOM files ({skipped} other files skipped).")
 
     if total_files == 0:
         input("Press Enter to exit...")
@@ -1,23 +1,355 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 import pydicom
-from scorer import dice_score, reconstruct_mask
+from scorer import sanitize_name, dice_score, reconstruct_mask, load_volume_geometry, load_segmentation_indices, sparse_dice_score, cropped_dice_score, encode_slice_runs
+from live_session import LiveSessionStore
+from reference_store import load_current_reference, load_version, list_versions, resolve_version, store_edited_references
+from reference_resolver import TieredReferenceResolver, OrthancSegSource
+from ingest import IngestionQueue
+from reference_pack import ReferencePack
+from reference_manifest import load_manifests, get_structure_stats
 import numpy as np
+import io
 import json
 import os
+import hmac
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
 
 app = Flask(__name__)
 
+# Largest request body accepted (grading submissions and ingestion uploads); larger ones get 413
+MAX_REQUEST_MB = int(os.environ.get('MAX_REQUEST_MB', 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_MB * 1024 * 1024
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": f"Request body larger than {MAX_REQUEST_MB} MB (MAX_REQUEST_MB)"}), 413
+
+
 # Enable CORS for all origins on all endpoints with explicit configuration
 CORS(app, resources={
     r"/*": {
         "origins": "*",
-        "methods": ["GET", "POST", "OPTIONS"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": False
     }
 })
 
+# Standard DICOM volume shape: (295 slices, 512x512)
+TARGET_SHAPE = (295, 512, 512)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+REFERENCES_DIR = os.path.join(SCRIPT_DIR, 'References')
+
+# Optional single-file reference pack (built by reference_pack.py), mapped once at startup
+REFERENCE_PACK_PATH = os.environ.get('REFERENCE_PACK', os.path.join(SCRIPT_DIR, 'References.pack'))
+reference_pack = ReferencePack(REFERENCE_PACK_PATH) if os.path.exists(REFERENCE_PACK_PATH) else None
+if reference_pack is not None:
+    print(f"[DEBUG] Loaded reference pack {REFERENCE_PACK_PATH} with {len(reference_pack)} references")
+
+# In-place references edited after they were stored (e.g. hand-corrected JSON) become
+# their current version here, so grading requests only read the store pointers
+try:
+    edited_count = store_edited_references(REFERENCES_DIR)
+    if edited_count:
+        print(f"[DEBUG] Stored {edited_count} references edited in place")
+except OSError as e:
+    print(f"[DEBUG] WARNING: Could not store references edited in place: {e}")
+
+# Reference manifests (precomputed statistics), the only reference data read at startup.
+# Pack manifests win for patients present in both, matching load_reference's lookup order.
+reference_manifests = load_manifests(REFERENCES_DIR)
+if reference_pack is not None:
+    for patient_key, manifest in reference_pack.manifests.items():
+        merged = dict(reference_manifests.get(patient_key) or manifest)
+        merged["structures"] = {**merged.get("structures", {}), **manifest.get("structures", {})}
+        merged["geometry"] = manifest.get("geometry") or merged.get("geometry")
+        reference_manifests[patient_key] = merged
+print(f"[DEBUG] Loaded {len(reference_manifests)} reference manifests")
+
+# Admission control: estimated voxels (reference + submission) graded concurrently.
+# 0 disables the budget.
+GRADING_VOXEL_BUDGET = int(os.environ.get('GRADING_VOXEL_BUDGET', 0))
+grading_lock = threading.Lock()
+grading_voxels_in_flight = 0
+
+# Optional JSON Lines log of graded submissions (input for regrade.py)
+SUBMISSION_LOG = os.environ.get('SUBMISSION_LOG')
+submission_log_lock = threading.Lock()
+
+# Live (incremental) scoring sessions
+live_sessions = LiveSessionStore(
+    ttl_seconds=int(os.environ.get('LIVE_SESSION_TTL_SECONDS', 900)),
+    max_bytes=int(os.environ.get('LIVE_SESSION_MAX_MB', 256)) * 1024 * 1024,
+)
+
+
+def current_reference_version(patient_id, structure_name):
+    """Version of (patient, structure) from the store pointer or the pack index, without reading index data."""
+    version = resolve_version(REFERENCES_DIR, patient_id, structure_name)
+    if version is None and reference_pack is not None and (patient_id, structure_name) in reference_pack:
+        version = reference_pack.version(patient_id, structure_name)
+    return version
+
+
+def load_local_reference(patient_id, structure_name):
+    """
+    Load the reference indices for (patient, structure) from this node.
+    The reference pack is consulted first (a dictionary lookup) unless the
+    reference store points at a newer version (e.g. one ingested at runtime);
+    otherwise the References folder is used: the reference store's current
+    version, else the in-place binary (memory-mapped) or legacy JSON reference.
+
+    Returns:
+        tuple: (indices, origin_slice_index, reference version)
+    """
+    if reference_pack is not None and (patient_id, structure_name) in reference_pack:
+        stored_version = resolve_version(REFERENCES_DIR, patient_id, structure_name)
+        if stored_version is None or stored_version == reference_pack.version(patient_id, structure_name):
+            indices, origin = reference_pack.lookup(patient_id, structure_name)
+            return indices, origin, reference_pack.version(patient_id, structure_name)
+    return load_current_reference(REFERENCES_DIR, patient_id, structure_name)
+
+
+# Optional Orthanc (DICOMweb) tier: references missing on this node are converted from their SEG
+ORTHANC_DICOMWEB_URL = os.environ.get('ORTHANC_DICOMWEB_URL')
+orthanc_source = None
+if ORTHANC_DICOMWEB_URL:
+    orthanc_auth = None
+    if os.environ.get('ORTHANC_USERNAME'):
+        orthanc_auth = (os.environ['ORTHANC_USERNAME'], os.environ.get('ORTHANC_PASSWORD', ''))
+    orthanc_source = OrthancSegSource(ORTHANC_DICOMWEB_URL, auth=orthanc_auth)
+    print(f"[DEBUG] Missing references will be fetched from {ORTHANC_DICOMWEB_URL}")
+
+reference_resolver = TieredReferenceResolver(
+    current_reference_version,
+    load_local_reference,
+    REFERENCES_DIR,
+    remote=orthanc_source,
+    manifests=reference_manifests,
+    max_bytes=int(os.environ.get('REFERENCE_CACHE_MB', 512)) * 1024 * 1024,
+)
+
+
+# Reference ingestion: authenticated uploads converted in the background (disabled without INGEST_TOKEN)
+INGEST_TOKEN = os.environ.get('INGEST_TOKEN')
+
+
+def publish_manifest(patient_id, manifest):
+    """Make a freshly ingested patient manifest visible to grading requests."""
+    reference_manifests[sanitize_name(patient_id)] = manifest
+
+
+ingestion_queue = IngestionQueue(
+    REFERENCES_DIR,
+    workers=int(os.environ.get('INGEST_WORKERS', 2)),
+    staging_dir=os.environ.get('INGEST_STAGING_DIR'),
+    on_published=publish_manifest,
+    max_archive_bytes=int(os.environ.get('INGEST_MAX_UNPACKED_MB', 4096)) * 1024 * 1024,
+    max_archive_files=int(os.environ.get('INGEST_MAX_FILES', 20000)),
+)
+
+
+def load_reference(patient_id, structure_name, version=None):
+    """
+    Load the reference indices for (patient, structure) through the tiered resolver
+    (memory, this node, Orthanc). A `version` selects that stored version instead
+    of the current one.
+
+    Returns:
+        tuple: (indices, origin_slice_index, reference version)
+    """
+    if version is not None:
+        if version not in [v["version"] for v in list_versions(REFERENCES_DIR, patient_id, structure_name)]:
+            raise FileNotFoundError(f"Reference {patient_id}/{structure_name} has no stored version {version}")
+        indices, origin = load_version(REFERENCES_DIR, version)
+        return indices, origin, version
+    return reference_resolver.resolve(patient_id, structure_name)
+
+
+def get_reference_stats(patient_id, structure_name):
+    """
+    Precomputed manifest statistics for (patient, structure), without touching index data.
+    The manifests are read at startup, so the stats may describe an older version of
+    the reference (see stats_match_reference) or miss a structure added on disk since.
+
+    Returns:
+        (dict, tuple) or (None, None): The structure's stats and the (rows, columns)
+        its bounding box was computed with; None if the manifests do not list the structure
+    """
+    try:
+        stats = get_structure_stats(reference_manifests, patient_id, structure_name)
+    except FileNotFoundError:
+        print(f"[DEBUG] No manifest statistics for {patient_id}/{structure_name}")
+        return None, None
+    if stats is None:
+        return None, None
+    geometry = reference_manifests[sanitize_name(patient_id)].get("geometry")
+    slice_shape = (geometry["rows"], geometry["columns"]) if geometry else (512, 512)
+    return stats, slice_shape
+
+
+def recorded_volume_geometry(patient_id):
+    """
+    Volume geometry recorded for a patient: next to its references in the folder,
+    else in the loaded manifests (e.g. of the reference pack).
+
+    Raises:
+        FileNotFoundError: If no geometry is recorded for the patient
+    """
+    try:
+        return load_volume_geometry(REFERENCES_DIR, patient_id)
+    except FileNotFoundError:
+        geometry = (reference_manifests.get(sanitize_name(patient_id)) or {}).get("geometry")
+        if geometry is None:
+            raise
+        return geometry
+
+
+def stats_match_reference(ref_stats, ref_version):
+    """True if manifest statistics were computed for the loaded reference version."""
+    if not ref_stats:
+        return False
+    if ref_stats.get("version") != ref_version:
+        print(f"[DEBUG] Manifest statistics are not for reference version {str(ref_version)[:12]}, scoring without them")
+        return False
+    return True
+
+
+def admit_grading(cost):
+    """Reserve `cost` voxels of the grading budget. Returns False if the server is saturated."""
+    global grading_voxels_in_flight
+    with grading_lock:
+        # A single request larger than the budget is still admitted when nothing else runs
+        if GRADING_VOXEL_BUDGET and grading_voxels_in_flight > 0 and grading_voxels_in_flight + cost > GRADING_VOXEL_BUDGET:
+            return False
+        grading_voxels_in_flight += cost
+        return True
+
+
+def release_grading(cost):
+    global grading_voxels_in_flight
+    with grading_lock:
+        grading_voxels_in_flight -= cost
+
+
+def indices_to_list(indices):
+    """JSON-serializable copy of an index array (references may be memory-mapped numpy arrays)."""
+    return indices.tolist() if isinstance(indices, np.ndarray) else indices
+
+
+# Reference overlay formats a client can negotiate with 'reference_format'
+REFERENCE_FORMATS = ('indices', 'rle', 'none')
+OVERLAY_CACHE_ENTRIES = 64
+overlay_cache = OrderedDict()
+overlay_cache_lock = threading.Lock()
+
+
+def requested_reference_format(data):
+    """Overlay format from the request body/form or the query string (default: 'indices')."""
+    reference_format = (data or {}).get('reference_format') or request.args.get('reference_format') or 'indices'
+    if reference_format not in REFERENCE_FORMATS:
+        raise ValueError(f"Unknown reference_format '{reference_format}', expected one of {', '.join(REFERENCE_FORMATS)}")
+    return reference_format
+
+
+def format_reference_data(ref_indices, ref_origin_index, ref_version, reference_format, slice_size):
+    """
+    Build the 'reference_data' of a grading response.
+    - indices: every flat voxel index (legacy)
+    - rle:     per-slice [start, length] runs, an order of magnitude smaller; cached
+               per reference version, which never changes
+    - none:    no overlay, only the voxel count (e.g. for a viewer that preloads the SEG)
+    """
+    if reference_format == 'indices':
+        return {"non_zero_indices": indices_to_list(ref_indices), "origin_slice_index": ref_origin_index}
+    if reference_format == 'none':
+        return {"format": "none", "voxel_count": int(len(ref_indices)), "origin_slice_index": ref_origin_index}
+
+    key = (ref_version, slice_size)
+    with overlay_cache_lock:
+        slices = overlay_cache.get(key)
+        if slices is not None:
+            overlay_cache.move_to_end(key)
+    if slices is None:
+        slices = encode_slice_runs(ref_indices, slice_size)
+        with overlay_cache_lock:
+            overlay_cache[key] = slices
+            while len(overlay_cache) > OVERLAY_CACHE_ENTRIES:
+                overlay_cache.popitem(last=False)
+    return {
+        "format": "rle",
+        "slice_size": slice_size,
+        "voxel_count": int(len(ref_indices)),
+        "origin_slice_index": ref_origin_index,
+        "slices": slices,
+    }
+
+
+def log_submission(data, score, reference_version):
+    """Append a graded submission to SUBMISSION_LOG so it can be re-graded later."""
+    if not SUBMISSION_LOG:
+        return
+    record = {
+        "submission_id": uuid.uuid4().hex,
+        "graded_at": datetime.now(timezone.utc).isoformat(),
+        "patient_id": data.get('patient_id'),
+        "structure_name": data.get('structure_name'),
+        "non_zero_indices": data['non_zero_indices'],
+        "origin_slice_index": data['origin_slice_index'],
+        "dice_score": float(score),
+        "reference_version": reference_version,
+    }
+    try:
+        with submission_log_lock, open(SUBMISSION_LOG, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"[ERROR] Failed to append to submission log {SUBMISSION_LOG}: {str(e)}")
+
+
+def score_submission(ref_indices, ref_origin_index, user_indices, user_origin_index, ref_stats, ref_slice_shape):
+    """
+    Score a submission against its reference.
+    With manifest statistics only the reference bounding box is rasterized;
+    otherwise both masks are reconstructed to full 3D volumes.
+    """
+    # Direct Comparison Logging
+    print(f"[DEBUG] User indices count: {len(user_indices)}")
+    print(f"[DEBUG] Reference indices count: {len(ref_indices)}")
+
+    target_shape = TARGET_SHAPE
+
+    if ref_stats and ref_stats.get("bounding_box") and tuple(ref_slice_shape) == tuple(target_shape[1:]):
+        print(f"[DEBUG] Scoring within reference bounding box: {ref_stats['bounding_box']}")
+        return cropped_dice_score(ref_indices, user_indices, ref_stats["bounding_box"], target_shape)
+
+    user_set = np.unique(np.asarray(user_indices, dtype=np.int64))
+    ref_set = np.unique(np.asarray(ref_indices, dtype=np.int64))
+    intersection = np.intersect1d(user_set, ref_set, assume_unique=True)
+
+    print(f"[DEBUG] Intersection count: {len(intersection)}")
+
+    if len(user_set) == len(ref_set) == len(intersection):
+        print("[DEBUG] SUCCESS: User and Reference indices are IDENTICAL.")
+    else:
+        print(f"[DEBUG] MISMATCH: Missing in user: {len(ref_set) - len(intersection)}, Extra in user: {len(user_set) - len(intersection)}")
+
+    # Reconstruct both masks to full 3D volumes
+    print(f"[DEBUG] Reconstructing user mask...")
+    user_mask = reconstruct_mask(user_indices, user_origin_index, target_shape)
+
+    print(f"[DEBUG] Reconstructing reference mask...")
+    reference_mask = reconstruct_mask(ref_indices, ref_origin_index, target_shape)
+
+    # Calculate Dice Score
+    return dice_score(reference_mask, user_mask)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint to verify server is running"""
@@ -41,16 +373,22 @@ def grade_submission():
     Expected request body:
     {
         "non_zero_indices": [...],  // 1D array of flat indices where mask = 1
-        "origin_slice_index": int   // Starting slice index in the volume
+        "origin_slice_index": int,  // Starting slice index in the volume
+        "reference_version": str,   // Optional: grade against this stored reference version
+        "reference_format": str     // Optional overlay format: "indices" (default), "rle" or "none"
     }
 
     Returns:
     {
         "dice_score": float (0.0 to 1.0),
+        "reference_version": str,   // Content hash of the reference that was used
         "reference_data": {
             "non_zero_indices": [...],  // 1D array of flat indices for reference mask
             "origin_slice_index": int   // Starting slice index for reference mask
         }
+        // with reference_format "rle", reference_data is instead
+        // {"format": "rle", "slice_size": int, "voxel_count": int, "origin_slice_index": int,
+        //  "slices": [{"slice_index": int, "rle": [start, length, ...]}, ...]}
     }
     """
     try:
@@ -69,6 +407,8 @@ def grade_submission():
         user_indices = data['non_zero_indices']
         user_origin_index = data['origin_slice_index']
 
+        reference_format = requested_reference_format(data)
+
         # Extract Context (Optional - Fallback to singleton mode if missing)
         patient_id = data.get('patient_id')
         structure_name = data.get('structure_name')
@@ -77,105 +417,349 @@ def grade_submission():
         print(f"[DEBUG] User origin_slice_index: {user_origin_index}")
         print(f"[DEBUG] Grading Context - Patient: {patient_id}, Structure: {structure_name}")
 
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-
         # Validate Context
         if not patient_id or not structure_name:
              return jsonify({"error": "Missing 'patient_id' or 'structure_name' in request body"}), 400
 
-        # Sanitize inputs
-        safe_patient = "".join([c for c in patient_id if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-        safe_structure = "".join([c for c in structure_name if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
-
-        json_path = os.path.join(script_dir, 'References', safe_patient, f"{safe_structure}.json")
+        # Cost estimate from the manifest (no index data read); a missing reference is
+        # reported when it is loaded
+        ref_stats, ref_slice_shape = get_reference_stats(patient_id, structure_name)
 
-        print(f"[DEBUG] Loading reference JSON from: {json_path}")
+        grading_cost = len(user_indices) + (ref_stats["voxel_count"] if ref_stats else 0)
+        if not admit_grading(grading_cost):
+            print(f"[DEBUG] Grading budget exhausted, rejecting request of ~{grading_cost} voxels")
+            response = jsonify({"error": "Scorer is busy, please retry shortly"})
+            response.headers['Retry-After'] = '1'
+            return response, 503
 
-        # Defaults
-        ref_origin_index = 28 # Legacy Default
+        # Manifest statistics describe the current version only
+        requested_version = data.get('reference_version')
+        if requested_version:
+            ref_stats = None
 
         try:
-            if not os.path.exists(json_path):
-                raise FileNotFoundError(f"Reference JSON file not found at: {json_path}")
+            try:
+                ref_indices, ref_origin_index, ref_version = load_reference(patient_id, structure_name, requested_version)
+            except FileNotFoundError:
+                raise
+            except Exception as e:
+                print(f"[ERROR] Failed to read reference: {str(e)}")
+                import traceback
+                traceback.print_exc()
+                return jsonify({
+                    "error": f"Failed to load reference: {str(e)}"
+                }), 500
+
+            # The statistics may predate a reference changed on disk
+            if not stats_match_reference(ref_stats, ref_version):
+                ref_stats = None
+            score = score_submission(ref_indices, ref_origin_index, user_indices, user_origin_index, ref_stats, ref_slice_shape)
+        finally:
+            release_grading(grading_cost)
+
+        print(f"[DEBUG] Final Dice Score: {score}")
+
+        log_submission(data, score, ref_version)
+
+        # Return the score and reference data as JSON
+        return jsonify({
+            "dice_score": float(score),
+            "reference_version": ref_version,
+            "reference_data": format_reference_data(ref_indices, ref_origin_index, ref_version,
+                                                    reference_format, TARGET_SHAPE[1] * TARGET_SHAPE[2])
+        }), 200
+
+    except ValueError as e:
+        print(f"[ERROR] ValueError: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
+    except FileNotFoundError as e:
+        print(f"[ERROR] FileNotFoundError: {str(e)}")
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        # Return error message if something goes wrong
+        print(f"[ERROR] Unexpected error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
 
-            with open(json_path, 'r') as f:
-                ref_data = json.load(f)
 
-            if 'non_zero_indices' not in ref_data:
-                raise ValueError("JSON file missing 'non_zero_indices'")
+@app.route('/grade_seg', methods=['POST'])
+def grade_seg_submission():
+    """
+    Grade a DICOM SEG upload (e.g. an exported OHIF SEG or a third-party tool's SEG).
 
-            ref_indices = ref_data['non_zero_indices']
+    Expected multipart/form-data:
+        file:            the DICOM SEG object
+        patient_id:      str
+        structure_name:  str
+        segment_number:  int (optional, default: segment labelled structure_name, else all segments)
+        slice_positions: JSON list of slice Z positions (optional, only used when no
+                         volume geometry is recorded for the patient, in the folder or the pack)
+        reference_format: overlay format, as for /grade_submission (optional)
 
-            # Check if JSON contains specific origin (Multi-structure support)
-            if 'origin_slice_index' in ref_data:
-                ref_origin_index = ref_data['origin_slice_index']
-                print(f"[DEBUG] Using origin_slice_index from JSON: {ref_origin_index}")
-            else:
-                print(f"[DEBUG] JSON missing 'origin_slice_index'. Using default: {ref_origin_index}")
+    Frames are mapped to slices through PerFrameFunctionalGroupsSequence and only
+    frames containing segment pixels are decoded, straight into sparse indices.
 
-            # Direct Comparison Logging
-            print(f"[DEBUG] User indices count: {len(user_indices)}")
-            print(f"[DEBUG] Reference indices count: {len(ref_indices)}")
+    Returns the same body as /grade_submission.
+    """
+    upload = request.files.get('file')
+    patient_id = request.form.get('patient_id')
+    structure_name = request.form.get('structure_name')
 
-            user_set = set(user_indices)
-            ref_set = set(ref_indices)
-            intersection = user_set.intersection(ref_set)
+    if upload is None:
+        return jsonify({"error": "Missing 'file' (DICOM SEG) in multipart form data"}), 400
+    if not patient_id or not structure_name:
+        return jsonify({"error": "Missing 'patient_id' or 'structure_name' in form data"}), 400
 
-            print(f"[DEBUG] Intersection count: {len(intersection)}")
+    print(f"[DEBUG] SEG Grading Context - Patient: {patient_id}, Structure: {structure_name}")
 
-            if len(user_set) == len(ref_set) == len(intersection):
-                print("[DEBUG] SUCCESS: User and Reference indices are IDENTICAL.")
-            else:
-                print(f"[DEBUG] MISMATCH: Missing in user: {len(ref_set - user_set)}, Extra in user: {len(user_set - ref_set)}")
+    try:
+        try:
+            geometry = recorded_volume_geometry(patient_id)
+        except FileNotFoundError:
+            if 'slice_positions' not in request.form:
+                raise
+            geometry = {
+                "slice_positions": json.loads(request.form['slice_positions']),
+                "rows": TARGET_SHAPE[1],
+                "columns": TARGET_SHAPE[2],
+            }
 
-        except Exception as e:
-            print(f"[ERROR] Failed to read reference JSON: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return jsonify({
-                "error": f"Failed to load reference JSON: {str(e)}"
-            }), 500
+        reference_format = requested_reference_format(request.form)
+        slice_positions = sorted(geometry['slice_positions'])
+        slice_shape = (int(geometry['rows']), int(geometry['columns']))
+        segment_number = request.form.get('segment_number', type=int)
 
-        # Reconstruct both masks to full 3D volumes
-        # Standard DICOM volume shape: (295 slices, 512x512)
-        target_shape = (295, 512, 512)
+        ref_indices, ref_origin_index, ref_version = load_reference(patient_id, structure_name)
 
-        print(f"[DEBUG] Reconstructing user mask...")
-        user_mask = reconstruct_mask(user_indices, user_origin_index, target_shape)
+        user_indices = load_segmentation_indices(
+            io.BytesIO(upload.read()),
+            slice_positions,
+            slice_shape,
+            segment_number=segment_number,
+            segment_label=structure_name,
+        )
 
-        print(f"[DEBUG] Reconstructing reference mask...")
-        reference_mask = reconstruct_mask(ref_indices, ref_origin_index, target_shape)
+        print(f"[DEBUG] SEG converted to {len(user_indices)} non-zero indices")
 
-        # Calculate Dice Score
-        score = dice_score(reference_mask, user_mask)
+        target_shape = (len(slice_positions),) + slice_shape
+        score = sparse_dice_score(ref_indices, user_indices, target_shape)
 
         print(f"[DEBUG] Final Dice Score: {score}")
 
-        # Return the score and reference data as JSON
+        log_submission({
+            "patient_id": patient_id,
+            "structure_name": structure_name,
+            "non_zero_indices": user_indices.tolist(),
+            "origin_slice_index": 0,
+        }, score, ref_version)
+
         return jsonify({
             "dice_score": float(score),
-            "reference_data": {
-                "non_zero_indices": ref_indices,
-                "origin_slice_index": ref_origin_index
-            }
+            "reference_version": ref_version,
+            "reference_data": format_reference_data(ref_indices, ref_origin_index, ref_version,
+                                                    reference_format, slice_shape[0] * slice_shape[1])
         }), 200
 
-    except ValueError as e:
-        print(f"[ERROR] ValueError: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
     except FileNotFoundError as e:
         print(f"[ERROR] FileNotFoundError: {str(e)}")
         return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        print(f"[ERROR] ValueError: {str(e)}")
+        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
     except Exception as e:
-        # Return error message if something goes wrong
         print(f"[ERROR] Unexpected error: {str(e)}")
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
 
+def ingest_authorized():
+    """Checks the request's 'Authorization: Bearer <INGEST_TOKEN>' header."""
+    auth = request.headers.get('Authorization', '')
+    scheme, _, token = auth.partition(' ')
+    return bool(INGEST_TOKEN) and scheme.lower() == 'bearer' and hmac.compare_digest(token.strip(), INGEST_TOKEN)
+
+
+@app.route('/references/ingest', methods=['POST'])
+def ingest_reference():
+    """
+    Upload a new case. Conversion runs in the background and the references
+    are published to the reference store when it finishes; no restart needed.
+
+    Requires: Authorization: Bearer <INGEST_TOKEN>
+
+    Expected multipart/form-data:
+        file:            zip of a CT series with its RTSTRUCT, or a DICOM SEG
+        structures:      comma-separated structure names to ingest (optional, default: all)
+        slice_positions: JSON list of slice Z positions (optional, for a SEG of a patient
+                         whose volume geometry is not recorded yet)
+
+    Returns (202):
+    {
+        "job_id": str,
+        "status": "queued",
+        "status_url": str
+    }
+    """
+    if not INGEST_TOKEN:
+        return jsonify({"error": "Reference ingestion is disabled (INGEST_TOKEN not set)"}), 503
+    if not ingest_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    upload = request.files.get('file')
+    if upload is None:
+        return jsonify({"error": "Missing 'file' in multipart form data"}), 400
+
+    structure_names = [s.strip() for s in request.form.get('structures', '').split(',') if s.strip()] or None
+
+    def geometry_for_patient(patient_id, seg_header):
+        if 'slice_positions' in request.form:
+            return {
+                "slice_positions": sorted(json.loads(request.form['slice_positions'])),
+                "rows": int(seg_header.Rows),
+                "columns": int(seg_header.Columns),
+            }
+        try:
+            return recorded_volume_geometry(patient_id)
+        except FileNotFoundError:
+            return None
+
+    try:
+        job = ingestion_queue.submit(upload.stream, geometry_for_patient, structure_names)
+    except ValueError as e:
+        print(f"[ERROR] Rejected upload: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
+    print(f"[DEBUG] Queued ingestion job {job['job_id']} ({job['kind']})")
+
+    return jsonify({
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "status_url": f"/references/ingest/{job['job_id']}"
+    }), 202
+
+
+@app.route('/references/ingest/<job_id>', methods=['GET'])
+def ingest_status(job_id):
+    """
+    Poll an ingestion job.
+
+    Returns:
+    {
+        "job_id": str,
+        "kind": "rtstruct" | "seg",
+        "status": "queued" | "running" | "done" | "failed",
+        "references": [{"patient_id", "structure_name", "voxel_count", "reference_version"}],
+        "error": str or null
+    }
+    """
+    if not ingest_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Ingestion job not found or expired: {job_id}"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/live_sessions', methods=['POST'])
+def open_live_session():
+    """
+    Open an incremental scoring session for (patient, structure).
+
+    Expected request body:
+    {
+        "patient_id": str,
+        "structure_name": str
+    }
+
+    Returns:
+    {
+        "session_id": str,
+        "ttl_seconds": int,
+        "reference_version": str,
+        "dice_score": float   // Score of the (still empty) user mask
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    patient_id = data.get('patient_id')
+    structure_name = data.get('structure_name')
+
+    if not patient_id or not structure_name:
+        return jsonify({"error": "Missing 'patient_id' or 'structure_name' in request body"}), 400
+
+    try:
+        ref_indices, _, ref_version = load_reference(patient_id, structure_name)
+        session = live_sessions.open(patient_id, structure_name, ref_indices, TARGET_SHAPE[1] * TARGET_SHAPE[2],
+                                     TARGET_SHAPE[0])
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    except ValueError as e:
+        return jsonify({"error": f"Failed to load reference: {str(e)}"}), 500
+    except MemoryError as e:
+        return jsonify({"error": str(e)}), 503
+
+    print(f"[DEBUG] Opened live session {session.session_id} for {patient_id}/{structure_name}")
+
+    return jsonify({
+        "session_id": session.session_id,
+        "ttl_seconds": live_sessions.ttl_seconds,
+        "reference_version": ref_version,
+        "dice_score": float(session.dice())
+    }), 201
+
+
+@app.route('/live_sessions/<session_id>/slices', methods=['POST'])
+def update_live_session(session_id):
+    """
+    Apply changed slices to a live session and return the running Dice score.
+
+    Expected request body:
+    {
+        "slices": [
+            {"slice_index": int, "indices": [...]},        // flat in-slice indices
+            {"slice_index": int, "rle": [start, len, ...]}  // or run-length pairs
+        ]
+    }
+    An empty mask clears the slice.
+
+    Returns:
+    {
+        "dice_score": float,
+        "changed_slices": int,
+        "user_voxels": int
+    }
+    """
+    data = request.get_json(silent=True) or {}
+    slices = data.get('slices')
+
+    if not isinstance(slices, list):
+        return jsonify({"error": "Missing 'slices' list in request body"}), 400
+
+    try:
+        session = live_sessions.apply_slices(session_id, slices)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid data format: {str(e)}"}), 400
+
+    if session is None:
+        return jsonify({"error": f"Live session not found or expired: {session_id}"}), 404
+
+    return jsonify({
+        "dice_score": float(session.dice()),
+        "changed_slices": len(slices),
+        "user_voxels": int(session.user_volume)
+    }), 200
+
+
+@app.route('/live_sessions/<session_id>', methods=['DELETE'])
+def close_live_session(session_id):
+    """Close a live session and release its memory."""
+    if not live_sessions.close(session_id):
+        return jsonify({"error": f"Live session not found or expired: {session_id}"}), 404
+    return jsonify({"status": "closed"}), 200
+
 
 if __name__ == '__main__':
     # Run server on 0.0.0.0:5002 to avoid conflict with Docker on 5000
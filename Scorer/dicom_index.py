@@ -0,0 +1,264 @@
+import os
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+
+RTSTRUCT_STORAGE_UID = '1.2.840.10008.5.1.4.1.1.481.3'
+SEGMENTATION_STORAGE_UID = '1.2.840.10008.5.1.4.1.1.66.4'
+
+# Shared by the optimizer, the converters and the uploader
+DEFAULT_CACHE_PATH = os.environ.get('DICOM_HEADER_CACHE') or os.path.join(
+    os.path.expanduser('~'), '.cache', 'ohif-scorer', 'dicom_headers.sqlite')
+
+
+class DicomHeader:
+    """Header fields of one DICOM file, read without its pixel data.
+
+    A header served from the HeaderCache has its fields but no dataset; the
+    dataset is parsed on first access, for the few files that need it.
+    """
+
+    def __init__(self, path, dataset=None, fields=None):
+        self.path = path
+        self._dataset = dataset
+        if fields is None:
+            fields = header_fields(dataset)
+        self.sop_class_uid = fields['sop_class_uid']
+        self.modality = fields['modality']
+        self.series_uid = fields['series_uid']
+        self.patient_id = fields['patient_id']
+        self.position = tuple(fields['position']) if fields['position'] is not None else None
+        self.orientation = tuple(fields['orientation']) if fields['orientation'] is not None else None
+        self.dimensions = tuple(fields['dimensions']) if fields['dimensions'] is not None else None
+        self.pixel_spacing = tuple(fields['pixel_spacing']) if fields['pixel_spacing'] is not None else None
+
+    @property
+    def dataset(self):
+        """The pixel-less dataset (parsed on first use for cached headers)."""
+        if self._dataset is None:
+            self._dataset = pydicom.dcmread(self.path, stop_before_pixels=True, force=True)
+        return self._dataset
+
+    @property
+    def is_image(self):
+        return self.position is not None and self.dimensions is not None
+
+    def fields(self):
+        return {
+            'sop_class_uid': self.sop_class_uid,
+            'modality': self.modality,
+            'series_uid': self.series_uid,
+            'patient_id': self.patient_id,
+            'position': self.position,
+            'orientation': self.orientation,
+            'dimensions': self.dimensions,
+            'pixel_spacing': self.pixel_spacing,
+        }
+
+
+def header_fields(dataset):
+    position = dataset.get('ImagePositionPatient')
+    orientation = dataset.get('ImageOrientationPatient')
+    rows, columns = dataset.get('Rows'), dataset.get('Columns')
+    spacing = dataset.get('PixelSpacing')
+    return {
+        'sop_class_uid': str(dataset.get('SOPClassUID', '')),
+        'modality': str(dataset.get('Modality', '')),
+        'series_uid': str(dataset.get('SeriesInstanceUID', '')),
+        'patient_id': str(dataset.get('PatientID', '')),
+        'position': [float(v) for v in position] if position is not None and len(position) == 3 else None,
+        'orientation': [float(v) for v in orientation] if orientation is not None and len(orientation) == 6 else None,
+        'dimensions': [int(rows), int(columns)] if rows is not None and columns is not None else None,
+        'pixel_spacing': [float(v) for v in spacing] if spacing is not None and len(spacing) == 2 else None,
+    }
+
+
+# Cached entries written with another field set are treated as misses
+FIELD_NAMES = frozenset(('sop_class_uid', 'modality', 'series_uid', 'patient_id',
+                         'position', 'orientation', 'dimensions', 'pixel_spacing'))
+
+
+def read_header(path):
+    """Header of one file, or None if it is not readable as DICOM."""
+    try:
+        dataset = pydicom.dcmread(path, stop_before_pixels=True, force=True)
+        # force=True "parses" any file; a real instance has a SOP Class
+        if 'SOPClassUID' not in dataset:
+            return None
+        return DicomHeader(str(path), dataset)
+    except Exception:
+        return None
+
+
+def file_identity(path):
+    """(size, mtime in ns) of a file; a change of either invalidates its cached header."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class HeaderCache:
+    """Persistent SQLite cache of header fields, keyed by (path, size, mtime).
+
+    Unchanged files are answered from the cache without parsing, including
+    files known not to be DICOM. Several tools and processes can share one
+    cache file; SQLite serializes their writes.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = str(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, fields TEXT)"
+            )
+
+    def lookup(self, paths):
+        """
+        Cached headers of the unchanged files among `paths`.
+
+        Returns:
+            dict: {path: DicomHeader, or None for a file that is not DICOM}
+        """
+        keys = [os.path.abspath(p) for p in paths]
+        rows = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            query = f"SELECT path, size, mtime_ns, fields FROM headers WHERE path IN ({','.join('?' * len(chunk))})"
+            for path, size, mtime_ns, fields in self._conn.execute(query, chunk):
+                rows[path] = (size, mtime_ns, fields)
+
+        found = {}
+        for path, key in zip(paths, keys):
+            row = rows.get(key)
+            if row is None:
+                continue
+            try:
+                if file_identity(path) != row[:2]:
+                    continue
+            except OSError:
+                continue
+            if row[2] is None:
+                found[path] = None
+                continue
+            fields = json.loads(row[2])
+            if set(fields) == FIELD_NAMES:
+                found[path] = DicomHeader(str(path), fields=fields)
+        return found
+
+    def store(self, entries):
+        """Cache [(path, (size, mtime_ns), DicomHeader or None)], identities taken before parsing."""
+        rows = [(os.path.abspath(path), identity[0], identity[1],
+                 json.dumps(header.fields()) if header is not None else None)
+                for path, identity, header in entries]
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)", rows)
+
+    def close(self):
+        self._conn.close()
+
+
+def open_header_cache(path=DEFAULT_CACHE_PATH):
+    """The shared header cache, or None (no caching) if it cannot be opened."""
+    try:
+        return HeaderCache(path)
+    except (OSError, sqlite3.Error) as e:
+        logging.warning(f"DICOM header cache unavailable ({path}): {e}")
+        return None
+
+
+def read_headers(paths, threads=None, cache=None):
+    """
+    Headers of `paths`, in order (None for files that are not DICOM).
+    Files missing from `cache` (or changed since) are parsed, optionally in a
+    thread pool, and written back to it.
+    threads: size of the reader thread pool (None = executor default, 1 = read in this thread)
+    """
+    paths = [str(p) for p in paths]
+    found = cache.lookup(paths) if cache is not None else {}
+
+    misses = []
+    for path in paths:
+        if path in found:
+            continue
+        try:
+            misses.append((path, file_identity(path)))
+        except OSError:
+            found[path] = None
+
+    if threads == 1 or len(misses) < 2:
+        parsed = [read_header(path) for path, _ in misses]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            parsed = list(executor.map(read_header, [path for path, _ in misses]))
+
+    if cache is not None and misses:
+        cache.store([(path, identity, header) for (path, identity), header in zip(misses, parsed)])
+    found.update((path, header) for (path, _), header in zip(misses, parsed))
+    return [found[path] for path in paths]
+
+
+class DicomIndex:
+    """In-memory index of the DICOM headers of a directory.
+
+    Each file's header is read once (optionally in a thread pool, or not at
+    all if the HeaderCache has it) and every lookup after that - RTSTRUCTs,
+    image series, slice positions - is served from memory. Files that are not
+    DICOM are skipped.
+    """
+
+    def __init__(self, directory, headers):
+        self.directory = str(directory)
+        self.headers = headers
+        self._by_path = {os.path.abspath(h.path): h for h in headers}
+
+    @classmethod
+    def build(cls, directory, threads=None, cache=None):
+        """
+        Scan the files directly in `directory` (no subfolders).
+        threads: size of the reader thread pool (None = executor default, 1 = read in this thread)
+        cache: optional HeaderCache
+        """
+        paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if os.path.isfile(os.path.join(directory, name)))
+        return cls(directory, [h for h in read_headers(paths, threads, cache) if h is not None])
+
+    def __len__(self):
+        return len(self.headers)
+
+    def get(self, path):
+        """Header of a file of the index, or None."""
+        return self._by_path.get(os.path.abspath(path))
+
+    def rtstructs(self):
+        return [h for h in self.headers if h.sop_class_uid == RTSTRUCT_STORAGE_UID]
+
+    def segmentations(self):
+        return [h for h in self.headers if h.sop_class_uid == SEGMENTATION_STORAGE_UID]
+
+    def images(self, modality=None):
+        return [h for h in self.headers if h.is_image and (modality is None or h.modality == modality)]
+
+    def series(self):
+        """{series_uid: [image headers]} of all image series."""
+        by_series = {}
+        for header in self.images():
+            by_series.setdefault(header.series_uid, []).append(header)
+        return by_series
+
+
+def sort_slices(headers):
+    """Image headers ordered along the slice normal (as GDCM orders a series for ITK)."""
+    def distance(header):
+        if header.orientation is None:
+            return header.position[2]
+        row, column = header.orientation[:3], header.orientation[3:]
+        normal = (row[1] * column[2] - row[2] * column[1],
+                  row[2] * column[0] - row[0] * column[2],
+                  row[0] * column[1] - row[1] * column[0])
+        return sum(p * n for p, n in zip(header.position, normal))
+    return sorted(headers, key=distance)
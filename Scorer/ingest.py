@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import uuid
+import shutil
+import zipfile
+import tempfile
+import threading
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+
+from scorer import sanitize_name, load_segmentation_indices, SEGMENTATION_STORAGE_UID
+from reference_store import publish_references, patient_lock
+from reference_manifest import update_manifest_structures, make_geometry
+from dicom_index import DicomIndex
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STEP2_PATH = os.path.join(SCRIPT_DIR, "Step 2 - RTSTRUCT_to_SEG_and_JSON.py")
+
+# Job states
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# ---------------------------------------------------------
+# Part 1: Conversion (runs in worker processes)
+# ---------------------------------------------------------
+
+_step2 = None
+
+
+def _load_step2():
+    """Import the Step 2 converter (its file name is not a module name)."""
+    global _step2
+    if _step2 is None:
+        spec = importlib.util.spec_from_file_location("rtstruct_to_seg_and_json", STEP2_PATH)
+        module = importlib.util.module_from_spec(spec)
+        # Registered so its functions pickle into Step 2's own ROI worker pool
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        _step2 = module
+    return _step2
+
+
+def _wanted(name, structure_names):
+    return not structure_names or sanitize_name(name).lower() in {sanitize_name(s).lower() for s in structure_names}
+
+
+def convert_seg(seg_path, geometry, structure_names=None):
+    """
+    Convert an uploaded SEG to references, one per segment.
+    A single-segment SEG is named after its SeriesDescription (as written by Step 2),
+    otherwise each segment is named after its SegmentLabel.
+
+    Returns:
+        list: [(patient_id, {structure: indices}, geometry)]
+    """
+    header = pydicom.dcmread(seg_path, stop_before_pixels=True)
+    segments = list(header.get('SegmentSequence', []))
+    if not segments:
+        raise ValueError("SEG has no SegmentSequence")
+
+    references = {}
+    for segment in segments:
+        name = str(segment.get('SegmentLabel', '') or f"Segment_{segment.SegmentNumber}")
+        if len(segments) == 1 and header.get('SeriesDescription'):
+            name = str(header.SeriesDescription)
+        if not _wanted(name, structure_names):
+            continue
+        indices = load_segmentation_indices(
+            seg_path,
+            geometry["slice_positions"],
+            (geometry["rows"], geometry["columns"]),
+            segment_number=int(segment.SegmentNumber),
+        )
+        if len(indices) > 0:
+            references[sanitize_name(name)] = indices
+
+    if not references:
+        raise ValueError("No non-empty segments to ingest")
+    return [(str(header.get('PatientID', 'UnknownPatient')), references, geometry)]
+
+
+def check_archive(archive_path, max_bytes, max_members):
+    """
+    Reject a zip that would unpack to more than `max_bytes` or more than
+    `max_members` files (e.g. a zip bomb), before anything is extracted.
+    zipfile never reads a member past its declared size, so the declared
+    sizes bound what extraction writes.
+
+    Raises:
+        ValueError: If the archive is unreadable or over a limit
+    """
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            members = archive.infolist()
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"Unreadable zip archive: {e}")
+    if len(members) > max_members:
+        raise ValueError(f"Archive holds {len(members)} files (limit {max_members})")
+    unpacked = sum(member.file_size for member in members)
+    if unpacked > max_bytes:
+        raise ValueError(f"Archive unpacks to {unpacked} bytes (limit {max_bytes})")
+
+
+def convert_rtstruct_archive(archive_path, work_dir, structure_names=None):
+    """
+    Convert every RTSTRUCT of an uploaded zip with the Step 2 pipeline. Each
+    RTSTRUCT must sit in the same folder as its CT series, as for Step 2.
+
+    Returns:
+        list: [(patient_id, {structure: indices}, geometry)]
+    """
+    step2 = _load_step2()
+
+    extract_dir = os.path.join(work_dir, "input")
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.namelist():
+            target = os.path.realpath(os.path.join(extract_dir, member))
+            if not target.startswith(os.path.realpath(extract_dir) + os.sep):
+                raise ValueError(f"Unsafe path in archive: {member}")
+        archive.extractall(extract_dir)
+
+    # One header index and series cache per folder serve the RTSTRUCT search and the conversion
+    rtstructs = []
+    for root, _, _ in os.walk(extract_dir):
+        index = DicomIndex.build(root)
+        series_cache = step2.SeriesCache()
+        rtstructs.extend((header, index, series_cache) for header in index.rtstructs())
+    if not rtstructs:
+        raise ValueError("No RTSTRUCT found in the archive")
+
+    results = []
+    for header, index, series_cache in rtstructs:
+        rtstruct_path, ds = header.path, header.dataset
+        selected = [roi.ROINumber for roi in ds.get('StructureSetROISequence', [])
+                    if _wanted(str(roi.get('ROIName', '')), structure_names)]
+        if not selected:
+            continue
+
+        volume = step2.load_reference_geometry(os.path.dirname(rtstruct_path), index=index)
+        if volume is None:
+            raise ValueError(f"No CT series next to {os.path.basename(rtstruct_path)}")
+
+        # Indices come straight from the rasterized masks; no SEG is needed
+        converted = step2.process_rtstruct(rtstruct_path, work_dir, target_roi_numbers=selected,
+                                           write_seg=False, reference_geometry=volume, index=index,
+                                           series_cache=series_cache)
+
+        by_patient = {}
+        for result in converted:
+            if len(result["indices"]) > 0:
+                by_patient.setdefault(result["patient_id"], {})[result["structure_name"]] = result["indices"]
+        for patient_id, references in by_patient.items():
+            results.append((patient_id, references, make_geometry(volume.slice_positions, volume.dimensions)))
+
+    if not results:
+        raise ValueError("No non-empty structures to ingest")
+    return results
+
+
+def run_conversion(kind, upload_path, work_dir, geometry, structure_names):
+    if kind == "seg":
+        return convert_seg(upload_path, geometry, structure_names)
+    return convert_rtstruct_archive(upload_path, work_dir, structure_names)
+
+# ---------------------------------------------------------
+# Part 2: Job queue (runs in the server process)
+# ---------------------------------------------------------
+
+
+class IngestionQueue:
+    """Background conversion of uploaded cases into the reference store.
+
+    Uploads are staged on disk and converted in a process pool. When a job's
+    conversion finishes, its references are published per patient: objects
+    first, then one pointer switch (see reference_store.publish_references),
+    then the manifest. `on_published(patient_id, manifest)` lets the server
+    refresh its in-memory manifests, so new cases go live without a restart.
+    Finished jobs are kept for `retention_seconds` for status polling. Zip
+    uploads that unpack to more than `max_archive_bytes` or more than
+    `max_archive_files` files are rejected before extraction.
+    """
+
+    def __init__(self, references_dir, workers=2, staging_dir=None, on_published=None,
+                 retention_seconds=3600, clock=time.time,
+                 max_archive_bytes=4 * 1024 ** 3, max_archive_files=20000):
+        self.references_dir = references_dir
+        self.max_archive_bytes = max_archive_bytes
+        self.max_archive_files = max_archive_files
+        self.staging_dir = staging_dir or tempfile.gettempdir()
+        self.on_published = on_published
+        self.retention_seconds = retention_seconds
+        self.clock = clock
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def submit(self, stream, geometry_for_patient=None, structure_names=None):
+        """
+        Stage an upload (RTSTRUCT+CT zip or DICOM SEG) and queue its conversion.
+        `geometry_for_patient(patient_id, header)` supplies the volume geometry for SEG uploads.
+
+        Returns:
+            dict: The job status
+
+        Raises:
+            ValueError: If the upload is neither a zip nor a DICOM SEG, a zip is over the
+                        unpacked size or file count limit, or a SEG's geometry is unknown
+        """
+        job_id = uuid.uuid4().hex
+        work_dir = tempfile.mkdtemp(prefix=f"ingest-{job_id}-", dir=self.staging_dir)
+        upload_path = os.path.join(work_dir, "upload")
+        try:
+            with open(upload_path, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+
+            geometry = None
+            if zipfile.is_zipfile(upload_path):
+                kind = "rtstruct"
+                check_archive(upload_path, self.max_archive_bytes, self.max_archive_files)
+            else:
+                try:
+                    header = pydicom.dcmread(upload_path, stop_before_pixels=True)
+                except Exception as e:
+                    raise ValueError(f"Upload is neither a zip archive nor DICOM: {e}")
+                if header.get('SOPClassUID') != SEGMENTATION_STORAGE_UID:
+                    raise ValueError(f"Uploaded DICOM is not a Segmentation (Modality: {header.get('Modality')})")
+                kind = "seg"
+                patient_id = str(header.get('PatientID', 'UnknownPatient'))
+                geometry = geometry_for_patient(patient_id, header) if geometry_for_patient else None
+                if geometry is None:
+                    raise ValueError(f"Volume geometry of patient {patient_id} is unknown; "
+                                     f"ingest the RTSTRUCT+CT archive or pass 'slice_positions'")
+        except Exception:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+
+        job = {
+            "job_id": job_id,
+            "kind": kind,
+            "status": QUEUED,
+            "submitted_at": self.clock(),
+            "finished_at": None,
+            "references": [],
+            "error": None,
+        }
+        with self._lock:
+            self._expire_locked()
+            self._jobs[job_id] = job
+
+        future = self._executor.submit(run_conversion, kind, upload_path, work_dir, geometry, structure_names)
+        with self._lock:
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, work_dir, f))
+        return self.get(job_id)
+
+    def _set(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+            if fields.get("finished_at") is not None:
+                self._futures.pop(job_id, None)
+
+    def _finish(self, job_id, work_dir, future):
+        try:
+            results = future.result()
+            published = []
+            for patient_id, references, geometry in results:
+                # Converters and other ingestion jobs may update the same patient
+                patient_dir = os.path.join(self.references_dir, sanitize_name(patient_id))
+                with patient_lock(patient_dir):
+                    versions = publish_references(self.references_dir, patient_id, references)
+                    manifest = update_manifest_structures(patient_dir, references, geometry)
+                    if self.on_published:
+                        self.on_published(patient_id, manifest)
+                    for name, indices in references.items():
+                        published.append({
+                            "patient_id": patient_id,
+                            "structure_name": name,
+                            "voxel_count": int(len(indices)),
+                            "reference_version": versions[name],
+                        })
+                        print(f"[DEBUG] Ingested {patient_id}/{name} ({len(indices)} voxels) -> {versions[name][:12]}")
+            self._set(job_id, status=DONE, references=published, finished_at=self.clock())
+        except Exception as e:
+            print(f"[ERROR] Ingestion job {job_id} failed: {str(e)}")
+            self._set(job_id, status=FAILED, error=str(e), finished_at=self.clock())
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _expire_locked(self):
+        now = self.clock()
+        for job_id in [j for j, job in self._jobs.items()
+                       if job["finished_at"] is not None and now - job["finished_at"] > self.retention_seconds]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Status of a job (a copy), or None if unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            # The pool has no start hook; a queued job is running once a worker picked it up
+            future = self._futures.get(job_id)
+            if job["status"] == QUEUED and future is not None and future.running():
+                job["status"] = RUNNING
+            return job
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,189 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from scorer import decode_slice_mask
+
+
+class LiveSession:
+    """Running Dice tallies for one (patient, structure) contouring session.
+
+    The reference is split once into per-slice sorted index arrays. Each slice
+    delta only touches the tallies of that slice, so an update costs
+    O(changed slices) instead of a full-volume reconstruction.
+
+    With `depth` (slices in the volume), reference voxels outside the volume
+    are ignored and slices outside it are rejected, as `reconstruct_mask` and
+    `sparse_dice_score` ignore out-of-volume indices in the final score.
+    """
+
+    def __init__(self, session_id, patient_id, structure_name, ref_indices, slice_size, depth=None):
+        self.session_id = session_id
+        self.patient_id = patient_id
+        self.structure_name = structure_name
+        self.slice_size = slice_size
+        self.depth = depth
+
+        ref = np.unique(np.asarray(ref_indices, dtype=np.int64))
+        ref = ref[ref >= 0]
+        if depth is not None:
+            ref = ref[ref < depth * slice_size]
+        ref_z = ref // slice_size
+        # Split the sorted reference at every slice boundary
+        boundaries = np.flatnonzero(np.diff(ref_z)) + 1
+        self.ref_slices = {
+            int(chunk_z[0]): chunk % slice_size
+            for chunk, chunk_z in zip(np.split(ref, boundaries), np.split(ref_z, boundaries))
+            if len(chunk) > 0
+        }
+        self.ref_volume = int(len(ref))
+        self._nbytes = sum(a.nbytes for a in self.ref_slices.values())
+
+        self.user_slices = {}
+        self.slice_intersections = {}
+        self.user_volume = 0
+        self.intersection = 0
+        self.last_access = None
+
+    def check_slice_index(self, slice_index):
+        """Returns slice_index as an int, or raises ValueError if it is outside the volume."""
+        slice_index = int(slice_index)
+        if slice_index < 0 or (self.depth is not None and slice_index >= self.depth):
+            raise ValueError(f"Invalid slice_index: {slice_index}")
+        return slice_index
+
+    def apply_slice(self, slice_index, local_indices):
+        """Replace the user mask of one slice and update the running tallies."""
+        slice_index = self.check_slice_index(slice_index)
+
+        new = np.unique(np.asarray(local_indices, dtype=np.int64))
+        if len(new) > 0 and (new[0] < 0 or new[-1] >= self.slice_size):
+            raise ValueError(f"Slice {slice_index} has indices outside [0, {self.slice_size})")
+
+        previous = self.user_slices.pop(slice_index, None)
+        if previous is not None:
+            self.user_volume -= len(previous)
+            self._nbytes -= previous.nbytes
+        self.intersection -= self.slice_intersections.pop(slice_index, 0)
+
+        if len(new) == 0:
+            return
+
+        ref_slice = self.ref_slices.get(slice_index)
+        if ref_slice is not None:
+            overlap = len(np.intersect1d(new, ref_slice, assume_unique=True))
+        else:
+            overlap = 0
+
+        self.user_slices[slice_index] = new
+        self.slice_intersections[slice_index] = overlap
+        self.user_volume += len(new)
+        self.intersection += overlap
+        self._nbytes += new.nbytes
+
+    def dice(self):
+        """Dice of the current tallies, matching `scorer.dice_score` semantics."""
+        if self.ref_volume + self.user_volume == 0:
+            return 1.0
+        return (2.0 * self.intersection) / (self.ref_volume + self.user_volume)
+
+    def nbytes(self):
+        """Approximate memory held by the session's index arrays (kept up to date by apply_slice)."""
+        return self._nbytes
+
+
+class LiveSessionStore:
+    """Thread-safe session registry with TTL eviction and a memory cap.
+
+    Sessions are kept in least-recently-used order. Expired sessions are
+    dropped on every access, and the oldest sessions are evicted whenever the
+    total tracked memory exceeds `max_bytes`. The total is kept as a running
+    sum, so an update costs O(changed slices), not O(all live sessions).
+    """
+
+    def __init__(self, ttl_seconds=900, max_bytes=256 * 1024 * 1024, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def open(self, patient_id, structure_name, ref_indices, slice_size, depth=None):
+        session = LiveSession(uuid.uuid4().hex, patient_id, structure_name, ref_indices, slice_size, depth)
+        with self._lock:
+            session.last_access = self._clock()
+            self._sessions[session.session_id] = session
+            self._bytes += session.nbytes()
+            self._evict_locked()
+            if session.session_id not in self._sessions:
+                raise MemoryError("Live session does not fit within the configured memory cap")
+        return session
+
+    def get(self, session_id):
+        """Returns the live session (refreshing its TTL) or None if unknown/expired."""
+        with self._lock:
+            self._evict_locked()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = self._clock()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def apply_slices(self, session_id, slices):
+        """Applies a batch of slice deltas atomically and returns the session."""
+        with self._lock:
+            self._evict_locked()
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            # Decode (and validate) the whole batch before touching any tally
+            decoded = []
+            for item in slices:
+                slice_index = session.check_slice_index(item['slice_index'])
+                decoded.append((slice_index, decode_slice_mask(item, session.slice_size)))
+            before = session.nbytes()
+            try:
+                for slice_index, local_indices in decoded:
+                    session.apply_slice(slice_index, local_indices)
+            finally:
+                self._bytes += session.nbytes() - before
+            session.last_access = self._clock()
+            self._sessions.move_to_end(session_id)
+            self._evict_locked(keep=session_id)
+            return session
+
+    def close(self, session_id):
+        with self._lock:
+            return self._remove_locked(session_id) is not None
+
+    def _remove_locked(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.nbytes()
+        return session
+
+    def _evict_locked(self, keep=None):
+        # Sessions are in last-access order, so the expired ones are at the front
+        now = self._clock()
+        while self._sessions:
+            oldest_id, oldest = next(iter(self._sessions.items()))
+            if now - oldest.last_access <= self.ttl_seconds:
+                break
+            self._remove_locked(oldest_id)
+
+        while self._bytes > self.max_bytes and self._sessions:
+            oldest_id = next(iter(self._sessions))
+            if oldest_id == keep:
+                if len(self._sessions) == 1:
+                    break
+                self._sessions.move_to_end(oldest_id)
+                continue
+            self._remove_locked(oldest_id)
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import struct
+import argparse
+
+import numpy as np
+
+from scorer import sanitize_name, load_reference_json
+
+# Binary reference layout (little endian):
+#   header (32 bytes): magic, format version, flags, origin_slice_index,
+#                      index count, payload length, reserved
+#   payload:           sorted uint32 flat indices, or (FLAG_VARINT_DELTA)
+#                      LEB128 varints of the deltas between sorted indices
+REFERENCE_BINARY_EXT = '.ref'
+MAGIC = b'OHIFREF\x00'
+FORMAT_VERSION = 1
+FLAG_VARINT_DELTA = 0x1
+HEADER = struct.Struct('<8sHHiIQ4x')
+HEADER_SIZE = HEADER.size
+
+# Files living next to the references that are not references themselves
+NON_REFERENCE_FILES = {'geometry.json', 'manifest.json', 'refs.json', 'conversion_hashes.json'}
+
+# Folder of the content-addressed reference store (see reference_store.py)
+OBJECTS_DIR_NAME = '.objects'
+
+
+
+def encode_varint_deltas(sorted_indices):
+    """LEB128-encode the deltas of a sorted index array (vectorized)."""
+    values = np.diff(np.asarray(sorted_indices, dtype=np.uint64), prepend=np.uint64(0))
+    if len(values) == 0:
+        return b''
+    # Number of 7-bit groups needed per value (uint32 input -> at most 5)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        nbytes += values >= (np.uint64(1) << np.uint64(shift))
+
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    group = np.arange(len(owner)) - np.repeat(np.cumsum(nbytes) - nbytes, nbytes)
+    out = ((values[owner] >> (np.uint64(7) * group.astype(np.uint64))) & np.uint64(0x7F)).astype(np.uint8)
+    # Continuation bit on every byte except the last of each value
+    out[group < nbytes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+
+def decode_varint_deltas(payload, count):
+    """Inverse of `encode_varint_deltas`. Returns a sorted uint32 array."""
+    data = np.frombuffer(payload, dtype=np.uint8)
+    if count == 0:
+        return np.empty(0, dtype=np.uint32)
+    ends = np.flatnonzero(data < 0x80)
+    if len(ends) != count:
+        raise ValueError(f"Corrupt varint payload: expected {count} values, found {len(ends)}")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    group = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    parts = (data & 0x7F).astype(np.uint64) << (np.uint64(7) * group.astype(np.uint64))
+    deltas = np.add.reduceat(parts, starts)
+    return np.cumsum(deltas).astype(np.uint32)
+
+
+def encode_binary_reference(indices, origin_slice_index=0, compress=False):
+    """Serialize reference indices into the binary reference format (bytes)."""
+    sorted_indices = np.unique(np.asarray(indices, dtype=np.int64))
+    if len(sorted_indices) > 0 and (sorted_indices[0] < 0 or sorted_indices[-1] > np.iinfo(np.uint32).max):
+        raise ValueError("Reference indices must fit in uint32")
+
+    if compress:
+        payload = encode_varint_deltas(sorted_indices)
+        flags = FLAG_VARINT_DELTA
+    else:
+        payload = sorted_indices.astype('<u4').tobytes()
+        flags = 0
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, flags, int(origin_slice_index), len(sorted_indices), len(payload))
+    return header + payload
+
+
+def decode_binary_reference(buffer, offset=0):
+    """
+    Decode a binary reference held in a bytes-like object (e.g. an mmap).
+    Uncompressed payloads are returned as a zero-copy view on `buffer`.
+
+    Returns:
+        (numpy.ndarray, int): Sorted uint32 indices and origin_slice_index
+    """
+    magic, version, flags, origin, count, payload_length = HEADER.unpack_from(buffer, offset)
+    if magic != MAGIC:
+        raise ValueError("Not a binary reference (bad magic)")
+    if version > FORMAT_VERSION:
+        raise ValueError(f"Unsupported binary reference version: {version}")
+
+    payload_offset = offset + HEADER_SIZE
+    if flags & FLAG_VARINT_DELTA:
+        payload = bytes(memoryview(buffer)[payload_offset:payload_offset + payload_length])
+        return decode_varint_deltas(payload, count), origin
+    return np.frombuffer(buffer, dtype='<u4', count=count, offset=payload_offset), origin
+
+
+def write_binary_reference(path, indices, origin_slice_index=0, compress=False):
+    """Write a binary reference file atomically (temp file + rename)."""
+    data = encode_binary_reference(indices, origin_slice_index, compress)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_binary_reference(path):
+    """
+    Open a binary reference file.
+    Uncompressed files are memory-mapped read-only, so loading is near zero-copy.
+
+    Returns:
+        (numpy.ndarray, int): Sorted uint32 indices and origin_slice_index
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(f"Truncated binary reference: {path}")
+        magic, version, flags, origin, count, payload_length = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ValueError(f"Not a binary reference (bad magic): {path}")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"Unsupported binary reference version {version}: {path}")
+        if flags & FLAG_VARINT_DELTA:
+            return decode_varint_deltas(f.read(payload_length), count), origin
+
+    if count == 0:
+        return np.empty(0, dtype=np.uint32), origin
+    return np.memmap(path, dtype='<u4', mode='r', offset=HEADER_SIZE, shape=(count,)), origin
+
+
+def load_reference(references_dir, patient_id, structure_name):
+    """
+    Load reference indices, preferring the binary format and falling back to
+    the legacy JSON file. A JSON modified after its binary reference (edited by
+    hand without regenerating the binary) is loaded instead, with a warning.
+
+    Returns:
+        tuple: (indices as numpy array or list, origin_slice_index)
+
+    Raises:
+        FileNotFoundError: If neither a binary nor a JSON reference exists
+        ValueError: If the reference file is malformed
+    """
+    binary_path = os.path.join(references_dir, sanitize_name(patient_id), f"{sanitize_name(structure_name)}{REFERENCE_BINARY_EXT}")
+    if os.path.exists(binary_path):
+        json_path = os.path.join(references_dir, sanitize_name(patient_id), f"{sanitize_name(structure_name)}.json")
+        if os.path.exists(json_path) and os.path.getmtime(json_path) > os.path.getmtime(binary_path):
+            print(f"[DEBUG] WARNING: {json_path} is newer than {binary_path}, loading the JSON. "
+                  f"Run reference_format.py to regenerate the binary reference.")
+            return load_reference_json(references_dir, patient_id, structure_name)
+        print(f"[DEBUG] Loading binary reference from: {binary_path}")
+        return read_binary_reference(binary_path)
+    return load_reference_json(references_dir, patient_id, structure_name)
+
+
+def convert_json_references(references_dir, compress=False):
+    """Write a binary reference next to every legacy reference JSON. Returns the count."""
+    count = 0
+    for patient in sorted(os.listdir(references_dir)):
+        patient_dir = os.path.join(references_dir, patient)
+        if patient == OBJECTS_DIR_NAME or not os.path.isdir(patient_dir):
+            continue
+        for name in sorted(os.listdir(patient_dir)):
+            if not name.endswith('.json') or name in NON_REFERENCE_FILES:
+                continue
+            with open(os.path.join(patient_dir, name), 'r') as f:
+                ref_data = json.load(f)
+            if 'non_zero_indices' not in ref_data:
+                continue
+            out_path = os.path.join(patient_dir, name[:-len('.json')] + REFERENCE_BINARY_EXT)
+            write_binary_reference(out_path, ref_data['non_zero_indices'], ref_data.get('origin_slice_index', 0), compress)
+            print(f"Converted {patient}/{name} -> {os.path.basename(out_path)} ({len(ref_data['non_zero_indices'])} voxels)")
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write binary references next to the legacy reference JSON files.")
+    parser.add_argument("references_dir", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "References"))
+    parser.add_argument("--compress", action="store_true", help="Delta/varint-compress the index payload (not memory-mappable)")
+    args = parser.parse_args()
+
+    count = convert_json_references(args.references_dir, args.compress)
+    print(f"Done. Wrote {count} binary references.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+import numpy as np
+
+from scorer import sanitize_name
+from reference_store import reference_version, patient_lock
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Slice size assumed for legacy references that have no recorded geometry
+DEFAULT_SLICE_SHAPE = (512, 512)
+
+
+def content_hash(indices):
+    """SHA-256 of the sorted unique indices as little-endian uint32 (the raw binary payload)."""
+    sorted_indices = np.unique(np.asarray(indices, dtype=np.int64)).astype('<u4')
+    return hashlib.sha256(sorted_indices.tobytes()).hexdigest()
+
+
+def compute_structure_stats(indices, slice_shape=DEFAULT_SLICE_SHAPE, origin_slice_index=0):
+    """
+    Precompute the statistics the scorer needs without touching index data again.
+    `version` is the reference version (see reference_store.py) the statistics
+    describe, so a reader can tell they are stale once the reference changes.
+
+    Returns:
+        dict: voxel_count, bounding_box {"z", "y", "x": [min, max]} (or None),
+              slice_counts {"<z>": count}, content_hash, version, format_version
+    """
+    rows, columns = slice_shape
+    sorted_indices = np.unique(np.asarray(indices, dtype=np.int64))
+
+    stats = {
+        "voxel_count": int(len(sorted_indices)),
+        "bounding_box": None,
+        "slice_counts": {},
+        "content_hash": content_hash(sorted_indices),
+        "version": reference_version(sorted_indices, origin_slice_index),
+        "format_version": MANIFEST_VERSION,
+    }
+    if len(sorted_indices) == 0:
+        return stats
+
+    z = sorted_indices // (rows * columns)
+    remainder = sorted_indices % (rows * columns)
+    y = remainder // columns
+    x = remainder % columns
+
+    stats["bounding_box"] = {
+        "z": [int(z.min()), int(z.max())],
+        "y": [int(y.min()), int(y.max())],
+        "x": [int(x.min()), int(x.max())],
+    }
+    slices, counts = np.unique(z, return_counts=True)
+    stats["slice_counts"] = {str(int(s)): int(c) for s, c in zip(slices, counts)}
+    return stats
+
+
+def make_geometry(sorted_zs, ref_dims):
+    """Volume geometry block of a manifest."""
+    return {
+        "slice_positions": [float(z) for z in sorted_zs],
+        "rows": int(ref_dims[0]),
+        "columns": int(ref_dims[1]),
+    }
+
+
+def load_manifest(patient_dir):
+    """Returns the patient's manifest dict, or None if it has none."""
+    manifest_path = os.path.join(patient_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(patient_dir, manifest):
+    """Write manifest.json atomically (temp file + rename)."""
+    manifest_path = os.path.join(patient_dir, MANIFEST_NAME)
+    tmp_path = f"{manifest_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def update_manifest(patient_dir, structure_name, indices, geometry=None):
+    """
+    Add or replace one structure's statistics in the patient's manifest.
+    `geometry` (see make_geometry) replaces the recorded volume geometry when given.
+    """
+    return update_manifest_structures(patient_dir, {structure_name: indices}, geometry)
+
+
+def update_manifest_structures(patient_dir, structures, geometry=None):
+    """
+    Like update_manifest for several structures ({name: indices}), with a single
+    write under the patient's lock (see reference_store.patient_lock).
+    """
+    with patient_lock(patient_dir):
+        manifest = load_manifest(patient_dir) or {
+            "format_version": MANIFEST_VERSION,
+            "geometry": None,
+            "structures": {},
+        }
+        if geometry is not None:
+            manifest["geometry"] = geometry
+
+        slice_shape = DEFAULT_SLICE_SHAPE
+        if manifest.get("geometry"):
+            slice_shape = (manifest["geometry"]["rows"], manifest["geometry"]["columns"])
+
+        for structure_name, indices in structures.items():
+            manifest["structures"][structure_name] = compute_structure_stats(indices, slice_shape)
+        write_manifest(patient_dir, manifest)
+    return manifest
+
+
+def load_manifests(references_dir):
+    """
+    Load every patient manifest of a References folder.
+    Returns: { sanitized patient name: manifest }
+    """
+    manifests = {}
+    if not os.path.isdir(references_dir):
+        return manifests
+    for patient in sorted(os.listdir(references_dir)):
+        patient_dir = os.path.join(references_dir, patient)
+        if not os.path.isdir(patient_dir):
+            continue
+        try:
+            manifest = load_manifest(patient_dir)
+        except (OSError, ValueError) as e:
+            print(f"[ERROR] Failed to read manifest of {patient}: {str(e)}")
+            continue
+        if manifest is not None:
+            manifests[sanitize_name(patient)] = manifest
+    return manifests
+
+
+def get_structure_stats(manifests, patient_id, structure_name):
+    """
+    Look up precomputed statistics.
+
+    Returns:
+        dict or None: The structure's stats, or None if the patient has no manifest
+
+    Raises:
+        FileNotFoundError: If the patient's manifest does not list the structure
+    """
+    manifest = manifests.get(sanitize_name(patient_id))
+    if manifest is None:
+        return None
+    stats = manifest.get("structures", {}).get(sanitize_name(structure_name))
+    if stats is None:
+        raise FileNotFoundError(f"Reference {patient_id}/{structure_name} is not listed in the patient's manifest")
+    return stats
+
+
+def build_manifests(references_dir):
+    """Build or refresh the manifest of every patient folder from its stored references."""
+    # Imported here: reference_pack depends on this module
+    from reference_store import load_current_reference
+    from reference_pack import iter_reference_names
+
+    count = 0
+    for patient, structure in iter_reference_names(references_dir):
+        patient_dir = os.path.join(references_dir, patient)
+        geometry = None
+        legacy_geometry = os.path.join(patient_dir, 'geometry.json')
+        if os.path.exists(legacy_geometry) and not (load_manifest(patient_dir) or {}).get("geometry"):
+            with open(legacy_geometry, 'r') as f:
+                geometry = json.load(f)
+        indices, _, _ = load_current_reference(references_dir, patient, structure)
+        update_manifest(patient_dir, structure, indices, geometry)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build manifest.json files with precomputed reference statistics.")
+    parser.add_argument("references_dir", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "References"))
+    args = parser.parse_args()
+
+    count = build_manifests(args.references_dir)
+    print(f"Done. Recorded statistics for {count} references.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+import argparse
+
+from scorer import sanitize_name
+from reference_format import (
+    encode_binary_reference, decode_binary_reference,
+    REFERENCE_BINARY_EXT, NON_REFERENCE_FILES, OBJECTS_DIR_NAME,
+)
+from reference_manifest import load_manifest, compute_structure_stats, DEFAULT_SLICE_SHAPE, MANIFEST_VERSION
+from reference_store import reference_version, load_pointers, load_current_reference
+
+# Pack layout (little endian):
+#   header (32 bytes): magic, format version, entry count, index offset, index length
+#   entries:           binary references (see reference_format.py), 8-byte aligned
+#   index table:       JSON {"entries": {"<patient>/<structure>": {"offset", "length", "crc32", "count", "version"}},
+#                            "manifests": {"<patient>": manifest (see reference_manifest.py)}}
+#                      (version 1 packs hold only the flat entries table)
+PACK_MAGIC = b'OHIFPACK'
+PACK_VERSION = 2
+PACK_HEADER = struct.Struct('<8sHxxIQQ')
+PACK_ALIGNMENT = 8
+
+
+def pack_key(patient_id, structure_name):
+    """Index key of a (patient, structure) pair, using the same sanitization as folder lookups."""
+    return f"{sanitize_name(patient_id)}/{sanitize_name(structure_name)}"
+
+
+def iter_reference_names(references_dir):
+    """
+    Yields (patient, structure) for every reference in a References folder:
+    in-place .ref/.json files and structures pointed at by the reference store.
+    """
+    for patient in sorted(os.listdir(references_dir)):
+        patient_dir = os.path.join(references_dir, patient)
+        if patient == OBJECTS_DIR_NAME or not os.path.isdir(patient_dir):
+            continue
+        structures = set()
+        for name in os.listdir(patient_dir):
+            if name in NON_REFERENCE_FILES:
+                continue
+            stem, ext = os.path.splitext(name)
+            if ext in (REFERENCE_BINARY_EXT, '.json'):
+                structures.add(stem)
+        structures.update((load_pointers(patient_dir) or {"structures": {}})["structures"])
+        for structure in sorted(structures):
+            yield patient, structure
+
+
+def build_pack(references_dir, pack_path, compress=False):
+    """
+    Bundle every reference of a References folder into one pack file.
+    Returns the number of packed references.
+    """
+    index = {}
+    manifests = {}
+    tmp_path = f"{pack_path}.tmp{os.getpid()}"
+
+    with open(tmp_path, 'wb') as f:
+        f.write(b'\0' * PACK_HEADER.size)
+
+        for patient, structure in iter_reference_names(references_dir):
+            try:
+                indices, origin, version = load_current_reference(references_dir, patient, structure)
+            except ValueError as e:
+                print(f"Skipping {patient}/{structure}: {e}")
+                continue
+
+            blob = encode_binary_reference(indices, origin, compress)
+            offset = f.tell()
+            f.write(blob)
+            f.write(b'\0' * (-len(blob) % PACK_ALIGNMENT))
+
+            index[pack_key(patient, structure)] = {
+                "offset": offset,
+                "length": len(blob),
+                "crc32": zlib.crc32(blob),
+                "count": len(indices),
+                "version": version,
+            }
+
+            # Carry the patient's manifest; fill in stats the folder never recorded or recorded for another version
+            patient_key = sanitize_name(patient)
+            if patient_key not in manifests:
+                manifests[patient_key] = load_manifest(os.path.join(references_dir, patient)) or {
+                    "format_version": MANIFEST_VERSION, "geometry": None, "structures": {}
+                }
+            manifest = manifests[patient_key]
+            if (manifest["structures"].get(sanitize_name(structure)) or {}).get("version") != version:
+                geometry = manifest.get("geometry")
+                slice_shape = (geometry["rows"], geometry["columns"]) if geometry else DEFAULT_SLICE_SHAPE
+                manifest["structures"][sanitize_name(structure)] = compute_structure_stats(indices, slice_shape, origin)
+
+        table = {"entries": index, "manifests": manifests}
+        index_bytes = json.dumps(table, sort_keys=True).encode('utf-8')
+        index_offset = f.tell()
+        f.write(index_bytes)
+
+        f.seek(0)
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(index), index_offset, len(index_bytes)))
+
+    os.replace(tmp_path, pack_path)
+    return len(index)
+
+
+class ReferencePack:
+    """
+    Read-only view of a reference pack.
+
+    The file is memory-mapped once; lookups are a dictionary access followed by
+    a zero-copy view into the mapping. Each entry's checksum is verified the
+    first time it is read. `manifests` holds the per-patient manifests.
+    """
+
+    def __init__(self, pack_path):
+        self.path = pack_path
+        self._file = open(pack_path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f"Empty reference pack: {pack_path}")
+
+        magic, version, count, index_offset, index_length = PACK_HEADER.unpack_from(self._mm, 0)
+        if magic != PACK_MAGIC:
+            self.close()
+            raise ValueError(f"Not a reference pack (bad magic): {pack_path}")
+        if version > PACK_VERSION:
+            self.close()
+            raise ValueError(f"Unsupported reference pack version {version}: {pack_path}")
+
+        table = json.loads(self._mm[index_offset:index_offset + index_length].decode('utf-8'))
+        if version == 1:
+            table = {"entries": table, "manifests": {}}
+        self._index = table["entries"]
+        self.manifests = table["manifests"]
+        self._verified = set()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return pack_key(*key) in self._index
+
+    def keys(self):
+        return [tuple(k.split('/', 1)) for k in self._index]
+
+    def entry(self, patient_id, structure_name):
+        """Index table entry (offset, length, crc32, count, version) or None."""
+        return self._index.get(pack_key(patient_id, structure_name))
+
+    def version(self, patient_id, structure_name):
+        """
+        Reference version of a packed entry (see reference_store.py).
+        Packs built before versioning get it computed from the entry on first use.
+        """
+        entry = self._index.get(pack_key(patient_id, structure_name))
+        if entry is None:
+            return None
+        if "version" not in entry:
+            entry["version"] = reference_version(*self.lookup(patient_id, structure_name))
+        return entry["version"]
+
+    def lookup(self, patient_id, structure_name):
+        """
+        Returns:
+            (numpy.ndarray, int): Sorted uint32 indices (view into the pack) and origin_slice_index
+
+        Raises:
+            FileNotFoundError: If the pack has no such reference
+            ValueError: If the entry fails its checksum
+        """
+        key = pack_key(patient_id, structure_name)
+        entry = self._index.get(key)
+        if entry is None:
+            raise FileNotFoundError(f"Reference {key} not found in pack {self.path}")
+
+        offset, length = entry["offset"], entry["length"]
+        if key not in self._verified:
+            if zlib.crc32(self._mm[offset:offset + length]) != entry["crc32"]:
+                raise ValueError(f"Checksum mismatch for {key} in pack {self.path}")
+            self._verified.add(key)
+
+        return decode_binary_reference(self._mm, offset)
+
+    def close(self):
+        if getattr(self, '_mm', None) is not None:
+            try:
+                self._mm.close()
+            except BufferError:
+                # Views handed out by lookup() still reference the mapping;
+                # it is released together with them.
+                pass
+        self._file.close()
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Bundle all references into a single pack file.")
+    parser.add_argument("references_dir", nargs="?", default=os.path.join(script_dir, "References"))
+    parser.add_argument("pack_path", nargs="?", default=os.path.join(script_dir, "References.pack"))
+    parser.add_argument("--compress", action="store_true", help="Delta/varint-compress the packed index payloads")
+    args = parser.parse_args()
+
+    count = build_pack(args.references_dir, args.pack_path, args.compress)
+    print(f"Done. Packed {count} references into {args.pack_path} ({os.path.getsize(args.pack_path)} bytes).")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import requests
+
+from scorer import sanitize_name, load_segmentation_indices
+from reference_format import REFERENCE_BINARY_EXT
+from reference_store import store_reference, patient_lock
+from reference_manifest import update_manifest
+
+# DICOM JSON tags used in DICOMweb (QIDO-RS / metadata) responses
+TAG_STUDY_UID = '0020000D'
+TAG_SERIES_UID = '0020000E'
+TAG_SOP_UID = '00080018'
+TAG_SERIES_DESCRIPTION = '0008103E'
+TAG_IMAGE_POSITION = '00200032'
+TAG_ROWS = '00280010'
+TAG_COLUMNS = '00280011'
+
+
+def _first_value(item, tag):
+    values = item.get(tag, {}).get('Value') or [None]
+    return values[0]
+
+
+def split_multipart(content, content_type):
+    """Split a multipart/related body (WADO-RS) into its part payloads."""
+    boundary = None
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key.lower() == 'boundary':
+            boundary = value.strip('"')
+    if not boundary:
+        raise ValueError(f"No boundary in multipart content type: {content_type}")
+
+    parts = []
+    for chunk in content.split(b'--' + boundary.encode())[1:]:
+        if chunk.startswith(b'--'):
+            break
+        headers, separator, body = chunk.partition(b'\r\n\r\n')
+        if separator:
+            parts.append(body[:-2] if body.endswith(b'\r\n') else body)
+    return parts
+
+
+class OrthancSegSource:
+    """Fetches reference SEGs from Orthanc (or any DICOMweb server).
+
+    A structure's SEG is the SEG series of the patient whose SeriesDescription
+    matches the structure name, as written by Step 2. The volume geometry comes
+    from the local manifest when known, otherwise from the metadata of the CT
+    series the SEG references.
+    """
+
+    def __init__(self, base_url, auth=None, timeout=30, session=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        if auth:
+            self.session.auth = auth
+
+    def _get(self, path, params=None, accept='application/dicom+json'):
+        response = self.session.get(f"{self.base_url}{path}", params=params,
+                                    headers={'Accept': accept}, timeout=self.timeout)
+        if response.status_code == 204:
+            return None
+        response.raise_for_status()
+        return response
+
+    def _search(self, path, params=None):
+        response = self._get(path, params)
+        return response.json() if response is not None else []
+
+    def find_seg_series(self, patient_id, structure_name):
+        """Returns (study_uid, series_uid) of the structure's SEG series, or None."""
+        matches = self._search('/series', {
+            'PatientID': patient_id,
+            'Modality': 'SEG',
+            'includefield': TAG_SERIES_DESCRIPTION,
+        })
+        wanted = sanitize_name(structure_name)
+        for series in matches:
+            if sanitize_name(str(_first_value(series, TAG_SERIES_DESCRIPTION) or '')) == wanted:
+                return _first_value(series, TAG_STUDY_UID), _first_value(series, TAG_SERIES_UID)
+        return None
+
+    def fetch_series_instance(self, study_uid, series_uid):
+        """Download the (first) instance of a series as DICOM bytes."""
+        instances = self._search(f"/studies/{study_uid}/series/{series_uid}/instances")
+        if not instances:
+            raise FileNotFoundError(f"Series {series_uid} has no instances")
+        sop_uid = _first_value(instances[0], TAG_SOP_UID)
+        response = self._get(f"/studies/{study_uid}/series/{series_uid}/instances/{sop_uid}",
+                             accept='multipart/related; type="application/dicom"; transfer-syntax=*')
+        parts = split_multipart(response.content, response.headers.get('Content-Type', ''))
+        if not parts:
+            raise ValueError(f"Empty WADO-RS response for instance {sop_uid}")
+        return parts[0]
+
+    def fetch_series_geometry(self, study_uid, series_uid):
+        """Volume geometry (see reference_manifest.make_geometry) of an image series."""
+        metadata = self._search(f"/studies/{study_uid}/series/{series_uid}/metadata")
+        zs = set()
+        dims = None
+        for instance in metadata:
+            position = instance.get(TAG_IMAGE_POSITION, {}).get('Value')
+            if position:
+                zs.add(float(position[2]))
+            if dims is None and TAG_ROWS in instance:
+                dims = (int(_first_value(instance, TAG_ROWS)), int(_first_value(instance, TAG_COLUMNS)))
+        if not zs or dims is None:
+            raise ValueError(f"Series {series_uid} has no usable image geometry")
+        return {"slice_positions": sorted(zs), "rows": dims[0], "columns": dims[1]}
+
+    def fetch_reference(self, patient_id, structure_name, geometry=None):
+        """
+        Convert the structure's SEG to reference indices.
+
+        Returns:
+            (numpy.ndarray, dict): Sorted flat indices and the volume geometry used
+
+        Raises:
+            FileNotFoundError: If Orthanc has no SEG for the structure
+            ValueError: If the SEG cannot be converted
+        """
+        series = self.find_seg_series(patient_id, structure_name)
+        if series is None:
+            raise FileNotFoundError(f"No SEG series for {patient_id}/{structure_name} in {self.base_url}")
+        study_uid, series_uid = series
+        print(f"[DEBUG] Fetching reference SEG {series_uid} for {patient_id}/{structure_name} from Orthanc")
+
+        seg_bytes = self.fetch_series_instance(study_uid, series_uid)
+
+        if geometry is None:
+            import pydicom
+            header = pydicom.dcmread(io.BytesIO(seg_bytes), stop_before_pixels=True)
+            try:
+                ct_series_uid = header.ReferencedSeriesSequence[0].SeriesInstanceUID
+            except (AttributeError, IndexError):
+                raise ValueError(f"SEG {series_uid} does not reference its image series")
+            geometry = self.fetch_series_geometry(study_uid, ct_series_uid)
+
+        indices = load_segmentation_indices(
+            io.BytesIO(seg_bytes),
+            geometry["slice_positions"],
+            (geometry["rows"], geometry["columns"]),
+            segment_label=structure_name,
+        )
+        return indices, geometry
+
+
+# Number of locks that concurrent misses on the same reference are serialized with
+KEY_LOCK_STRIPES = 64
+
+
+def _indices_nbytes(indices):
+    return indices.nbytes if isinstance(indices, np.ndarray) else 8 * len(indices)
+
+
+class TieredReferenceResolver:
+    """Resolves references through memory, local storage and a remote SEG source.
+
+    Tier 1 is an in-memory LRU of reference data keyed by reference version.
+    Versions are immutable, so the cache never needs invalidating; `current_version`
+    maps a name to its version cheaply (pack index, store pointer). References
+    that are not in the store or pack (legacy in-place files) are keyed by
+    their files' modification times instead. Tier 2 is `load_local` (pack,
+    reference store, in-place files). Tier 3, if configured,
+    converts a SEG fetched from Orthanc and writes it back to the local store, so
+    a fresh replica fills itself lazily. Concurrent misses on the same reference
+    trigger a single fetch.
+    """
+
+    def __init__(self, current_version, load_local, references_dir, remote=None, manifests=None,
+                 max_bytes=512 * 1024 * 1024):
+        self.current_version = current_version
+        self.load_local = load_local
+        self.references_dir = references_dir
+        self.remote = remote
+        self.manifests = manifests if manifests is not None else {}
+        self.max_bytes = max_bytes
+        self.stats = {"memory": 0, "local": 0, "remote": 0}
+
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        # Striped per-reference locks: a fixed set, whatever names clients send
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+
+    def _cache_key(self, patient_id, structure_name):
+        """
+        The reference's version, or for a legacy reference without one the
+        modification times of its in-place files. None if neither exists.
+        """
+        version = self.current_version(patient_id, structure_name)
+        if version is not None:
+            return version
+        patient_dir = os.path.join(self.references_dir, sanitize_name(patient_id))
+        mtimes = []
+        for ext in (REFERENCE_BINARY_EXT, '.json'):
+            try:
+                mtimes.append(os.stat(os.path.join(patient_dir, f"{sanitize_name(structure_name)}{ext}")).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        if mtimes == [None, None]:
+            return None
+        return (sanitize_name(patient_id), sanitize_name(structure_name), *mtimes)
+
+    def _cache_get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def _cache_put(self, key, value):
+        nbytes = _indices_nbytes(value[0])
+        if key is None or nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = value
+            self._cache_bytes += nbytes
+            while self._cache_bytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= _indices_nbytes(evicted[0])
+
+    def resolve(self, patient_id, structure_name):
+        """
+        Returns:
+            tuple: (indices, origin_slice_index, reference version)
+
+        Raises:
+            FileNotFoundError: If no tier has the reference
+            ValueError: If a stored or fetched reference is malformed
+        """
+        cache_key = self._cache_key(patient_id, structure_name)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            self.stats["memory"] += 1
+            return cached
+
+        key = (sanitize_name(patient_id), sanitize_name(structure_name))
+        key_lock = self._key_locks[hash(key) % KEY_LOCK_STRIPES]
+
+        # Under the per-reference lock a concurrent miss finds the written-back copy locally
+        with key_lock:
+            try:
+                value = self.load_local(patient_id, structure_name)
+                self.stats["local"] += 1
+            except FileNotFoundError:
+                if self.remote is None:
+                    raise
+                value = self._fetch_remote(patient_id, structure_name)
+                self.stats["remote"] += 1
+
+            # Versioned data is cached under the version actually loaded (the pointer may
+            # have moved since the lookup, and a remote fetch is stored under its version)
+            self._cache_put(cache_key if isinstance(cache_key, tuple) else value[2], value)
+            return value
+
+    def _fetch_remote(self, patient_id, structure_name):
+        patient_key = sanitize_name(patient_id)
+        geometry = (self.manifests.get(patient_key) or {}).get("geometry")
+
+        indices, geometry = self.remote.fetch_reference(patient_id, structure_name, geometry)
+
+        # Write back to the local tier; the store pointer makes later lookups local
+        patient_dir = os.path.join(self.references_dir, patient_key)
+        with patient_lock(patient_dir):
+            store_reference(self.references_dir, patient_id, structure_name, indices, 0)
+            manifest = update_manifest(patient_dir, sanitize_name(structure_name), indices, geometry)
+        self.manifests[patient_key] = manifest
+        print(f"[DEBUG] Stored {len(indices)} reference voxels for {patient_id}/{structure_name} fetched from Orthanc")
+
+        return self.load_local(patient_id, structure_name)
@@ -0,0 +1,354 @@
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from scorer import sanitize_name
+from reference_format import (
+    encode_binary_reference, read_binary_reference, load_reference,
+    REFERENCE_BINARY_EXT, OBJECTS_DIR_NAME,
+)
+
+# Content-addressed reference storage:
+#   References/.objects/<vv>/<version>.ref   immutable binary references, named by version
+#   References/<patient>/refs.json           mutable pointers {"structures": {name: {"current", "history"}}}
+# A version is the SHA-256 of the canonical (uncompressed) binary encoding, so it
+# covers both the indices and origin_slice_index.
+POINTERS_NAME = 'refs.json'
+LOCK_NAME = '.lock'
+
+
+def reference_version(indices, origin_slice_index=0):
+    """Content hash identifying one version of a reference."""
+    return hashlib.sha256(encode_binary_reference(indices, origin_slice_index)).hexdigest()
+
+
+def object_path(references_dir, version):
+    return os.path.join(references_dir, OBJECTS_DIR_NAME, version[:2], f"{version}{REFERENCE_BINARY_EXT}")
+
+
+def load_pointers(patient_dir):
+    """Returns the patient's pointer table, or None if it has none."""
+    pointers_path = os.path.join(patient_dir, POINTERS_NAME)
+    if not os.path.exists(pointers_path):
+        return None
+    with open(pointers_path, 'r') as f:
+        return json.load(f)
+
+
+def write_pointers(patient_dir, pointers):
+    """Write refs.json atomically (temp file + rename)."""
+    pointers_path = os.path.join(patient_dir, POINTERS_NAME)
+    tmp_path = f"{pointers_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(pointers, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, pointers_path)
+
+
+# Patient locks held by the current thread: {lock path: depth}
+_held_locks = threading.local()
+
+
+@contextmanager
+def patient_lock(patient_dir, timeout=600):
+    """
+    Exclusive lock on one patient folder, across processes and threads, held
+    while its refs.json, manifest.json and conversion_hashes.json are read,
+    merged and rewritten. publish_references and update_manifest_structures
+    take it themselves; writers that update several files of a patient hold it
+    around all of them. It is re-entrant within a thread.
+
+    The lock is an OS lock on the `.lock` file (flock, or msvcrt.locking on
+    Windows). The OS releases it when its process dies, so a lock is never
+    broken by hand.
+    """
+    os.makedirs(patient_dir, exist_ok=True)
+    lock_path = os.path.abspath(os.path.join(patient_dir, LOCK_NAME))
+    held = _held_locks.__dict__.setdefault("paths", {})
+    if lock_path in held:
+        held[lock_path] += 1
+        try:
+            yield
+        finally:
+            held[lock_path] -= 1
+        return
+
+    with open(lock_path, 'a+b') as f:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                _lock_file(f)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for {lock_path}")
+                time.sleep(0.05)
+        held[lock_path] = 1
+        try:
+            yield
+        finally:
+            del held[lock_path]
+            _unlock_file(f)
+
+
+def _lock_file(f):
+    """Take the file's OS lock without blocking; raises OSError if it is held."""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+
+def _unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_object(references_dir, indices, origin_slice_index, compress):
+    version = reference_version(indices, origin_slice_index)
+    path = object_path(references_dir, version)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
+            f.write(encode_binary_reference(indices, origin_slice_index, compress))
+        os.replace(tmp_path, path)
+    return version
+
+
+def store_reference(references_dir, patient_id, structure_name, indices, origin_slice_index=0, compress=False):
+    """
+    Store a reference as an immutable object and point (patient, structure) at it.
+    Objects are never overwritten or removed, so earlier versions stay addressable.
+
+    Returns:
+        str: The reference version
+    """
+    return publish_references(references_dir, patient_id, {structure_name: indices}, origin_slice_index, compress)[structure_name]
+
+
+def publish_references(references_dir, patient_id, references, origin_slice_index=0, compress=False):
+    """
+    Store several references of one patient ({structure: indices}) and switch
+    their pointers together: all objects are written first, then refs.json is
+    replaced once, so readers see either none or all of the new versions.
+
+    Returns:
+        dict: {structure: version}
+    """
+    versions = {name: _write_object(references_dir, indices, origin_slice_index, compress)
+                for name, indices in references.items()}
+
+    patient_dir = os.path.join(references_dir, sanitize_name(patient_id))
+    with patient_lock(patient_dir):
+        pointers = load_pointers(patient_dir) or {"structures": {}}
+        changed = False
+        for name, version in versions.items():
+            entry = pointers["structures"].setdefault(sanitize_name(name), {"current": None, "history": []})
+            if entry["current"] != version:
+                entry["current"] = version
+                entry["history"].append({"version": version, "stored_at": datetime.now(timezone.utc).isoformat()})
+                changed = True
+        if changed:
+            write_pointers(patient_dir, pointers)
+    return versions
+
+
+def resolve_version(references_dir, patient_id, structure_name):
+    """
+    Current version of (patient, structure), or None if it is not in the store.
+    Only reads the pointer: in-place files edited after it was written are
+    stored by store_edited_references (import CLI and server startup).
+    """
+    pointers = cached_pointers(os.path.join(references_dir, sanitize_name(patient_id)))
+    if pointers is None:
+        return None
+    entry = pointers["structures"].get(sanitize_name(structure_name))
+    if entry is None:
+        return None
+    return entry["current"]
+
+
+# Parsed refs.json per patient folder: {patient_dir: (file identity, pointers)}
+_pointer_cache = {}
+
+
+def cached_pointers(patient_dir):
+    """
+    load_pointers, re-read only when refs.json was replaced (it is always
+    replaced, never rewritten in place), so a lookup costs one stat.
+    The returned table is shared and must not be modified.
+    """
+    try:
+        st = os.stat(os.path.join(patient_dir, POINTERS_NAME))
+    except OSError:
+        return None
+    identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _pointer_cache.get(patient_dir)
+    if cached is not None and cached[0] == identity:
+        return cached[1]
+    pointers = load_pointers(patient_dir)
+    _pointer_cache[patient_dir] = (identity, pointers)
+    return pointers
+
+
+def edited_in_place(references_dir, patient_id, structure_name):
+    """
+    Modification times of the in-place (.ref, .json) files of (patient, structure)
+    if one of them was modified after refs.json, else None.
+    """
+    patient_dir = os.path.join(references_dir, sanitize_name(patient_id))
+    try:
+        pointers_mtime = os.path.getmtime(os.path.join(patient_dir, POINTERS_NAME))
+    except OSError:
+        return None
+    paths = [os.path.join(patient_dir, f"{sanitize_name(structure_name)}{ext}") for ext in (REFERENCE_BINARY_EXT, '.json')]
+    mtimes = tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+    if not any(mtime is not None and mtime > pointers_mtime for mtime in mtimes):
+        return None
+    return mtimes
+
+
+def store_edited_references(references_dir, compress=False):
+    """
+    Store every in-place .ref/.json modified after its patient's refs.json that
+    holds another version than the pointer (e.g. a hand-corrected JSON), so it
+    is not shadowed by the stored version. Run by the import CLI and at server
+    startup; reads never publish a version.
+
+    Returns:
+        int: The number of references stored
+    """
+    if not os.path.isdir(references_dir):
+        return 0
+    count = 0
+    for patient in sorted(os.listdir(references_dir)):
+        patient_dir = os.path.join(references_dir, patient)
+        if patient == OBJECTS_DIR_NAME or not os.path.isdir(patient_dir):
+            continue
+        pointers = load_pointers(patient_dir)
+        if pointers is None or not any(edited_in_place(references_dir, patient, structure)
+                                       for structure in pointers["structures"]):
+            continue
+
+        with patient_lock(patient_dir):
+            pointers = load_pointers(patient_dir)
+            # Compared with refs.json before any of them rewrites it
+            edited = [(structure, entry["current"]) for structure, entry in sorted(pointers["structures"].items())
+                      if edited_in_place(references_dir, patient, structure)]
+            compared = True
+            for structure, current_version in edited:
+                try:
+                    indices, origin = load_reference(references_dir, patient, structure)
+                except (FileNotFoundError, ValueError) as e:
+                    print(f"[DEBUG] WARNING: Could not compare edited reference {patient}/{structure} with the store: {e}")
+                    compared = False
+                    continue
+                version = reference_version(indices, origin)
+                if version != current_version:
+                    print(f"[DEBUG] WARNING: {patient}/{structure} was edited in place after it was stored, "
+                          f"storing it as version {version[:12]} (was {current_version[:12]})")
+                    store_reference(references_dir, patient, structure, indices, origin, compress)
+                    count += 1
+            if compared:
+                # Files rewritten with their stored content are not compared again
+                os.utime(os.path.join(patient_dir, POINTERS_NAME))
+    return count
+
+
+def list_versions(references_dir, patient_id, structure_name):
+    """History of (patient, structure) as [{"version", "stored_at"}], oldest first."""
+    pointers = load_pointers(os.path.join(references_dir, sanitize_name(patient_id))) or {"structures": {}}
+    entry = pointers["structures"].get(sanitize_name(structure_name))
+    return list(entry["history"]) if entry else []
+
+
+def load_version(references_dir, version):
+    """
+    Load one stored version of a reference.
+
+    Returns:
+        (numpy.ndarray, int): Sorted uint32 indices and origin_slice_index
+
+    Raises:
+        FileNotFoundError: If the store has no such version
+    """
+    path = object_path(references_dir, version) if re.fullmatch(r'[0-9a-f]{64}', version or '') else None
+    if path is None or not os.path.exists(path):
+        raise FileNotFoundError(f"Reference version not found: {version}")
+    return read_binary_reference(path)
+
+
+def load_current_reference(references_dir, patient_id, structure_name):
+    """
+    Load the current version of a reference: the store's pointer when there is
+    one, otherwise the in-place .ref/.json file (whose version is computed).
+
+    Returns:
+        tuple: (indices, origin_slice_index, version)
+
+    Raises:
+        FileNotFoundError: If the reference does not exist
+        ValueError: If the reference file is malformed
+    """
+    version = resolve_version(references_dir, patient_id, structure_name)
+    if version is not None:
+        print(f"[DEBUG] Loading reference {patient_id}/{structure_name} at version {version[:12]}")
+        indices, origin = load_version(references_dir, version)
+        return indices, origin, version
+    indices, origin = load_reference(references_dir, patient_id, structure_name)
+    return indices, origin, reference_version(indices, origin)
+
+
+def import_references(references_dir, compress=False):
+    """
+    Store the in-place references of a References folder that are not in the
+    store yet, and those edited in place after they were stored. Returns the count.
+    """
+    # Imported here: reference_pack depends on this module
+    from reference_pack import iter_reference_names
+
+    count = store_edited_references(references_dir, compress)
+    for patient, structure in iter_reference_names(references_dir):
+        if resolve_version(references_dir, patient, structure) is not None:
+            continue
+        try:
+            indices, origin = load_reference(references_dir, patient, structure)
+        except ValueError as e:
+            print(f"Skipping {patient}/{structure}: {e}")
+            continue
+        version = store_reference(references_dir, patient, structure, indices, origin, compress)
+        print(f"Stored {patient}/{structure} -> {version[:12]}")
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import references into the content-addressed reference store.")
+    parser.add_argument("references_dir", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "References"))
+    parser.add_argument("--compress", action="store_true", help="Delta/varint-compress the stored objects (not memory-mappable)")
+    args = parser.parse_args()
+
+    count = import_references(args.references_dir, args.compress)
+    print(f"Done. Stored {count} references.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import logging
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from scorer import sparse_dice_score
+from reference_store import load_current_reference, load_version
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+
+# Standard DICOM volume shape: (295 slices, 512x512), same as app.py
+DEFAULT_TARGET_SHAPE = (295, 512, 512)
+
+RESULT_FIELDS = ["submission_id", "patient_id", "structure_name", "old_score", "new_score", "delta",
+                 "old_reference_version", "reference_version", "error"]
+
+# ---------------------------------------------------------
+# Part 1: Worker state (one copy per process)
+# ---------------------------------------------------------
+
+_worker_references_dir = None
+_worker_target_shape = DEFAULT_TARGET_SHAPE
+_worker_pinned = False
+_worker_reference_cache = {}
+
+
+def _init_worker(references_dir, target_shape, pinned=False):
+    global _worker_references_dir, _worker_target_shape, _worker_pinned
+    _worker_references_dir = references_dir
+    _worker_target_shape = tuple(target_shape)
+    _worker_pinned = pinned
+    _worker_reference_cache.clear()
+
+
+def _get_reference(patient_id, structure_name, version=None):
+    """
+    Loads each reference at most once per worker process.
+    Returns: (indices, version, error)
+    """
+    # Stored versions are immutable, so they are cached by version alone
+    key = version or (patient_id, structure_name)
+    if key not in _worker_reference_cache:
+        try:
+            if version:
+                indices, _ = load_version(_worker_references_dir, version)
+            else:
+                indices, _, version = load_current_reference(_worker_references_dir, patient_id, structure_name)
+            _worker_reference_cache[key] = (indices, version, None)
+        except (FileNotFoundError, ValueError) as e:
+            _worker_reference_cache[key] = (None, version, str(e))
+    return _worker_reference_cache[key]
+
+
+def _grade_record(submission_id, record):
+    patient_id = record.get('patient_id')
+    structure_name = record.get('structure_name')
+    old_score = record.get('dice_score')
+
+    row = {
+        "submission_id": record.get('submission_id', submission_id),
+        "patient_id": patient_id,
+        "structure_name": structure_name,
+        "old_score": old_score,
+        "new_score": None,
+        "delta": None,
+        "old_reference_version": record.get('reference_version'),
+        "reference_version": None,
+        "error": None,
+    }
+
+    if not patient_id or not structure_name or 'non_zero_indices' not in record:
+        row["error"] = "Missing 'patient_id', 'structure_name' or 'non_zero_indices'"
+        return row
+
+    pinned_version = record.get('reference_version') if _worker_pinned else None
+    ref_indices, row["reference_version"], error = _get_reference(patient_id, structure_name, pinned_version)
+    if error:
+        row["error"] = error
+        return row
+
+    # A malformed or legacy record fails on its own row, not the whole regrade
+    try:
+        new_score = sparse_dice_score(ref_indices, record['non_zero_indices'], _worker_target_shape)
+        row["new_score"] = new_score
+        if old_score is not None:
+            row["delta"] = new_score - float(old_score)
+    except (KeyError, TypeError, ValueError) as e:
+        row["new_score"] = None
+        row["error"] = f"Malformed submission: {e}"
+    return row
+
+
+def _grade_chunk(chunk):
+    """Grades a chunk of (submission_id, raw_json_or_path) items inside a worker."""
+    rows = []
+    loaded_before = len(_worker_reference_cache)
+    for submission_id, raw in chunk:
+        try:
+            if isinstance(raw, Path):
+                with open(raw, 'r') as f:
+                    record = json.load(f)
+            else:
+                record = json.loads(raw)
+        except (OSError, ValueError) as e:
+            rows.append(dict.fromkeys(RESULT_FIELDS) | {"submission_id": submission_id, "error": f"Unreadable submission: {e}"})
+            continue
+        if not isinstance(record, dict):
+            rows.append(dict.fromkeys(RESULT_FIELDS) | {"submission_id": submission_id, "error": "Submission is not a JSON object"})
+            continue
+        rows.append(_grade_record(submission_id, record))
+    return rows, len(_worker_reference_cache) - loaded_before
+
+# ---------------------------------------------------------
+# Part 2: Submission discovery
+# ---------------------------------------------------------
+
+def iter_submissions(source):
+    """
+    Yields (submission_id, raw) for every stored submission.
+    - A directory yields one item per *.json file (raw is the Path).
+    - A file is read as a JSON Lines log (raw is the line text), e.g. SUBMISSION_LOG of app.py.
+    Parsing is left to the workers so the main process stays cheap.
+    """
+    source = Path(source)
+    if source.is_dir():
+        for path in sorted(source.rglob("*.json")):
+            yield str(path.relative_to(source)), path
+    else:
+        with open(source, 'r') as f:
+            for line_number, line in enumerate(f, start=1):
+                if line.strip():
+                    yield f"{source.name}:{line_number}", line
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+# ---------------------------------------------------------
+# Part 3: Orchestration
+# ---------------------------------------------------------
+
+def regrade(source, references_dir, workers=None, chunk_size=64, target_shape=DEFAULT_TARGET_SHAPE, pinned=False):
+    """
+    Re-scores every stored submission against the current references, or with
+    `pinned` against the reference version each submission was graded with.
+    Returns: (rows, stats)
+    """
+    workers = workers or os.cpu_count() or 1
+    start_time = time.perf_counter()
+
+    rows = []
+    references_loaded = 0
+    chunks = chunked(iter_submissions(source), chunk_size)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(str(references_dir), tuple(target_shape), pinned)) as executor:
+        # map() keeps the submission order in the report
+        for chunk_rows, loaded in executor.map(_grade_chunk, chunks):
+            rows.extend(chunk_rows)
+            references_loaded += loaded
+
+    elapsed = time.perf_counter() - start_time
+    graded = [r for r in rows if r["error"] is None]
+    stats = {
+        "submissions": len(rows),
+        "graded": len(graded),
+        "errors": len(rows) - len(graded),
+        "changed": sum(1 for r in graded if r["delta"] is not None and abs(r["delta"]) > 1e-9),
+        "reference_changed": sum(1 for r in graded if r["old_reference_version"] and r["old_reference_version"] != r["reference_version"]),
+        "references_loaded": references_loaded,
+        "workers": workers,
+        "elapsed_seconds": round(elapsed, 3),
+        "submissions_per_second": round(len(rows) / elapsed, 1) if elapsed > 0 else None,
+    }
+    return rows, stats
+
+
+def write_report(rows, stats, output_path):
+    output_path = Path(output_path)
+    if output_path.suffix.lower() == ".json":
+        with open(output_path, 'w') as f:
+            json.dump({"stats": stats, "results": rows}, f, indent=2)
+    else:
+        with open(output_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main():
+    script_dir = Path(__file__).parent.absolute()
+
+    parser = argparse.ArgumentParser(description="Re-grade stored submissions against the current references.")
+    parser.add_argument("submissions", help="Directory of submission JSON files, or a JSON Lines submission log")
+    parser.add_argument("--references_dir", default=str(script_dir / "References"), help="Reference folder to grade against")
+    parser.add_argument("--output", default="regrade_report.csv", help="Report path (.csv or .json)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--chunk_size", type=int, default=64, help="Submissions per work unit")
+    parser.add_argument("--pinned", action="store_true", help="Grade against the reference version recorded with each submission")
+
+    args = parser.parse_args()
+
+    if not Path(args.submissions).exists():
+        logging.error(f"Submissions not found: {args.submissions}")
+        return 1
+
+    rows, stats = regrade(args.submissions, args.references_dir, args.workers, args.chunk_size, pinned=args.pinned)
+    write_report(rows, stats, args.output)
+
+    logging.info(f"Re-graded {stats['graded']}/{stats['submissions']} submissions "
+                 f"({stats['changed']} changed, {stats['reference_changed']} on a new reference version, {stats['errors']} errors) "
+                 f"in {stats['elapsed_seconds']}s with {stats['workers']} workers "
+                 f"({stats['submissions_per_second']} submissions/s).")
+    logging.info(f"Report written to: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
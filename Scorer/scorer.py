@@ -1,6 +1,81 @@
 import numpy as np
 import pydicom
+import json
 import os
+from volume_geometry import VolumeGeometry
+
+
+def sanitize_name(name):
+    """Restrict a patient/structure name to characters safe for a path component."""
+    return "".join([c for c in name if c.isalnum() or c in (' ', '.', '_', '-')]).strip()
+
+
+def load_reference_json(references_dir, patient_id, structure_name):
+    """Load the reference indices for (patient, structure) from a References folder.
+
+    Args:
+        references_dir (str): Root folder holding <patient>/<structure>.json files
+        patient_id (str): Patient folder name (sanitized before use)
+        structure_name (str): Structure file name without extension (sanitized before use)
+
+    Returns:
+        tuple: (list of reference non-zero indices, origin_slice_index)
+
+    Raises:
+        FileNotFoundError: If no reference JSON exists for the pair
+        ValueError: If the JSON is missing 'non_zero_indices'
+    """
+    json_path = os.path.join(references_dir, sanitize_name(patient_id), f"{sanitize_name(structure_name)}.json")
+
+    print(f"[DEBUG] Loading reference JSON from: {json_path}")
+
+    # Defaults
+    ref_origin_index = 28 # Legacy Default
+
+    if not os.path.exists(json_path):
+        raise FileNotFoundError(f"Reference JSON file not found at: {json_path}")
+
+    with open(json_path, 'r') as f:
+        ref_data = json.load(f)
+
+    if 'non_zero_indices' not in ref_data:
+        raise ValueError("JSON file missing 'non_zero_indices'")
+
+    # Check if JSON contains specific origin (Multi-structure support)
+    if 'origin_slice_index' in ref_data:
+        ref_origin_index = ref_data['origin_slice_index']
+        print(f"[DEBUG] Using origin_slice_index from JSON: {ref_origin_index}")
+    else:
+        print(f"[DEBUG] JSON missing 'origin_slice_index'. Using default: {ref_origin_index}")
+
+    return ref_data['non_zero_indices'], ref_origin_index
+
+
+def load_volume_geometry(references_dir, patient_id):
+    """Load the volume geometry recorded next to a patient's references.
+
+    The geometry is read from the patient's manifest.json, falling back to the
+    legacy geometry.json.
+
+    Returns:
+        dict: {"slice_positions": [z, ...] (sorted), "rows": int, "columns": int}
+
+    Raises:
+        FileNotFoundError: If no geometry is recorded for the patient
+    """
+    patient_dir = os.path.join(references_dir, sanitize_name(patient_id))
+    manifest_path = os.path.join(patient_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            geometry = json.load(f).get('geometry')
+        if geometry:
+            return geometry
+
+    geometry_path = os.path.join(patient_dir, "geometry.json")
+    if not os.path.exists(geometry_path):
+        raise FileNotFoundError(f"Volume geometry not found for patient: {patient_id}")
+    with open(geometry_path, 'r') as f:
+        return json.load(f)
 
 
 def reconstruct_mask(indices, origin_slice_index, target_shape=(295, 512, 512)):
@@ -64,6 +139,71 @@ def reconstruct_mask(indices, origin_slice_index, target_shape=(295, 512, 512)):
     return full_volume
 
 
+def decode_slice_mask(slice_data, slice_size):
+    """Decode one encoded slice mask into sorted in-slice flat indices.
+
+    Args:
+        slice_data (dict): Either {"indices": [...]} with flat in-slice indices,
+                           or {"rle": [start, length, ...]} run-length pairs.
+        slice_size (int): Number of pixels in one slice (rows * columns)
+
+    Returns:
+        numpy.ndarray: Sorted unique int64 indices in [0, slice_size)
+
+    Raises:
+        ValueError: If the encoding is missing, malformed or out of range
+    """
+    if 'rle' in slice_data:
+        runs = np.asarray(slice_data['rle'], dtype=np.int64)
+        if runs.ndim != 1 or len(runs) % 2 != 0:
+            raise ValueError("'rle' must be a flat list of [start, length] pairs")
+        starts, lengths = runs[0::2], runs[1::2]
+        if np.any(lengths < 0):
+            raise ValueError("'rle' run lengths must be non-negative")
+        if len(starts) == 0 or lengths.sum() == 0:
+            return np.empty(0, dtype=np.int64)
+        # Expand runs without a Python loop: offsets within each run + run start
+        run_offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        indices = np.unique(np.repeat(starts, lengths) + run_offsets)
+    elif 'indices' in slice_data:
+        indices = np.unique(np.asarray(slice_data['indices'], dtype=np.int64))
+    else:
+        raise ValueError("Slice mask must provide 'indices' or 'rle'")
+
+    if len(indices) > 0 and (indices[0] < 0 or indices[-1] >= slice_size):
+        raise ValueError(f"Slice mask indices must be within [0, {slice_size})")
+    return indices
+
+
+def encode_slice_runs(indices, slice_size):
+    """Encode flat volume indices as per-slice run-length masks (inverse of decode_slice_mask).
+
+    Args:
+        indices (array-like): Flat indices into the (slices, rows, columns) volume
+        slice_size (int): Number of pixels in one slice (rows * columns)
+
+    Returns:
+        list: [{"slice_index": z, "rle": [start, length, ...]}, ...] ordered by slice,
+              with in-slice run starts
+    """
+    indices = np.unique(np.asarray(indices, dtype=np.int64))
+    if len(indices) == 0:
+        return []
+
+    # A run ends where the next index is not adjacent or lies on another slice
+    breaks = np.flatnonzero((np.diff(indices) != 1) | (np.diff(indices // slice_size) != 0)) + 1
+    run_starts = indices[np.concatenate(([0], breaks))]
+    run_lengths = np.diff(np.concatenate(([0], breaks, [len(indices)])))
+
+    run_z = run_starts // slice_size
+    pairs = np.column_stack((run_starts % slice_size, run_lengths))
+    slice_breaks = np.flatnonzero(np.diff(run_z)) + 1
+    return [
+        {"slice_index": int(z_runs[0]), "rle": slice_pairs.ravel().tolist()}
+        for z_runs, slice_pairs in zip(np.split(run_z, slice_breaks), np.split(pairs, slice_breaks))
+    ]
+
+
 def load_segmentation_mask(filepath):
     """Load a DICOM Segmentation object and extract the 3D mask array.
 
@@ -90,6 +230,145 @@ def load_segmentation_mask(filepath):
         raise ValueError(f"Failed to load DICOM segmentation from {filepath}: {e}")
 
 
+SEGMENTATION_STORAGE_UID = '1.2.840.10008.5.1.4.1.1.66.4'
+
+
+def map_positions_to_slices(positions, slice_positions, tolerance=0.5):
+    """Map Z positions to the index of the nearest slice in a sorted position list.
+
+    Returns:
+        numpy.ndarray: Slice index per position, -1 where no slice is within tolerance
+    """
+    return VolumeGeometry(slice_positions).lookup(positions, tolerance)
+
+
+def _read_seg_frame_indices(dcm, frame_index, frame_pixels, decoded_frames):
+    """Return flat in-frame indices of one SEG frame, or None if the frame is empty.
+
+    Native (uncompressed) pixel data is sliced per frame straight from the
+    PixelData buffer and an all-zero frame is rejected before unpacking.
+    Compressed transfer syntaxes fall back to one full decode (shared through
+    `decoded_frames`).
+    """
+    if decoded_frames is not None:
+        frame = decoded_frames[frame_index]
+        return np.flatnonzero(frame) if frame.any() else None
+
+    pixel_bytes = dcm.PixelData
+    if dcm.BitsAllocated == 1:
+        start_bit = frame_index * frame_pixels
+        first_byte = start_bit // 8
+        last_byte = (start_bit + frame_pixels + 7) // 8
+        chunk = np.frombuffer(pixel_bytes, dtype=np.uint8, count=last_byte - first_byte, offset=first_byte)
+        if not chunk.any():
+            return None
+        bit_offset = start_bit - first_byte * 8
+        frame = np.unpackbits(chunk, bitorder='little')[bit_offset:bit_offset + frame_pixels]
+    else:
+        bytes_per_pixel = dcm.BitsAllocated // 8
+        dtype = np.uint8 if bytes_per_pixel == 1 else np.dtype(f'<u{bytes_per_pixel}')
+        frame = np.frombuffer(pixel_bytes, dtype=dtype, count=frame_pixels,
+                              offset=frame_index * frame_pixels * bytes_per_pixel)
+        if not frame.any():
+            return None
+
+    local_indices = np.flatnonzero(frame)
+    return local_indices if len(local_indices) > 0 else None
+
+
+def load_segmentation_indices(source, slice_positions, slice_shape, segment_number=None, segment_label=None, tolerance=0.5):
+    """Convert a DICOM SEG straight to sparse flat indices of the reference volume.
+
+    Frames are mapped to volume slices through the Z of their
+    PerFrameFunctionalGroupsSequence plane position, and only frames that
+    contain segment pixels are decoded. No dense 3D intermediate is built.
+
+    Args:
+        source: Path, file-like object or already read pydicom Dataset of the DICOM SEG
+        slice_positions (list): Sorted Z positions of the volume slices
+        slice_shape (tuple): (rows, columns) of the volume
+        segment_number (int, optional): Only use frames of this segment (default: all segments)
+        segment_label (str, optional): Select the segment by SegmentLabel instead of number,
+                                       ignored if no segment carries that label
+        tolerance (float): Maximum Z distance (mm) between a frame and its slice
+
+    Returns:
+        numpy.ndarray: Sorted unique int64 flat indices into the (slices, rows, columns) volume
+
+    Raises:
+        ValueError: If the object is not a usable DICOM Segmentation
+    """
+    if isinstance(source, pydicom.Dataset):
+        dcm = source
+    else:
+        try:
+            dcm = pydicom.dcmread(source)
+        except Exception as e:
+            raise ValueError(f"Failed to read DICOM: {e}")
+
+    if dcm.get('SOPClassUID') != SEGMENTATION_STORAGE_UID and dcm.get('Modality') != 'SEG':
+        raise ValueError(f"File is not a DICOM Segmentation (Modality: {dcm.get('Modality')})")
+
+    rows, columns = int(dcm.Rows), int(dcm.Columns)
+    if (rows, columns) != tuple(slice_shape):
+        raise ValueError(f"SEG frame size {(rows, columns)} does not match volume slice size {tuple(slice_shape)}")
+
+    if 'PerFrameFunctionalGroupsSequence' not in dcm:
+        raise ValueError("SEG missing PerFrameFunctionalGroupsSequence")
+
+    if segment_number is None and segment_label is not None:
+        for segment in dcm.get('SegmentSequence', []):
+            if str(segment.get('SegmentLabel', '')).strip().lower() == str(segment_label).strip().lower():
+                segment_number = int(segment.SegmentNumber)
+                break
+
+    pffgs = dcm.PerFrameFunctionalGroupsSequence
+    num_frames = int(dcm.get('NumberOfFrames', 1))
+    if len(pffgs) != num_frames:
+        raise ValueError(f"Frame count mismatch. Pixels: {num_frames}, Meta: {len(pffgs)}")
+
+    frame_zs = np.full(num_frames, np.nan)
+    for i, frame_group in enumerate(pffgs):
+        if segment_number is not None:
+            try:
+                frame_segment = frame_group.SegmentIdentificationSequence[0].ReferencedSegmentNumber
+            except (AttributeError, IndexError):
+                frame_segment = 1
+            if int(frame_segment) != int(segment_number):
+                continue
+        try:
+            frame_zs[i] = float(frame_group.PlanePositionSequence[0].ImagePositionPatient[2])
+        except (AttributeError, IndexError):
+            continue
+
+    selected = np.flatnonzero(~np.isnan(frame_zs))
+    slice_indices = map_positions_to_slices(frame_zs[selected], slice_positions, tolerance)
+    if np.any(slice_indices < 0):
+        print(f"[DEBUG SEG] WARNING: {int(np.sum(slice_indices < 0))} frames not found in volume geometry, skipping them")
+
+    decoded_frames = None
+    if dcm.file_meta.TransferSyntaxUID.is_compressed:
+        decoded_frames = dcm.pixel_array.reshape(num_frames, rows * columns)
+
+    slice_size = rows * columns
+    chunks = []
+    decoded_count = 0
+    for frame_index, slice_index in zip(selected, slice_indices):
+        if slice_index < 0:
+            continue
+        local_indices = _read_seg_frame_indices(dcm, int(frame_index), slice_size, decoded_frames)
+        if local_indices is None:
+            continue
+        decoded_count += 1
+        chunks.append(local_indices + int(slice_index) * slice_size)
+
+    print(f"[DEBUG SEG] Decoded {decoded_count} of {num_frames} frames")
+
+    if not chunks:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(chunks))
+
+
 def dice_score(mask1, mask2, user_origin_index=None):
     """Calculate Dice Similarity Coefficient (DSC) between two 3D masks.
 
@@ -134,3 +413,98 @@ def dice_score(mask1, mask2, user_origin_index=None):
     print(f"[DEBUG SCORER] Calculated Dice Score: {dice}")
     return float(dice)
 
+
+def sparse_dice_score(ref_indices, user_indices, target_shape=(295, 512, 512)):
+    """Calculate the Dice score directly on flat index lists.
+
+    Equivalent to `dice_score(reconstruct_mask(ref, ...), reconstruct_mask(user, ...))`
+    (duplicates and out-of-volume indices are ignored the same way) without
+    allocating the two full 3D volumes.
+
+    Args:
+        ref_indices: Flat indices of the reference mask
+        user_indices: Flat indices of the user mask
+        target_shape (tuple): Shape of the full 3D volume (depth, height, width)
+
+    Returns:
+        float: Dice score in [0.0, 1.0]
+    """
+    volume_size = int(np.prod(target_shape))
+
+    def _valid_unique(indices):
+        arr = np.unique(np.asarray(indices, dtype=np.int64))
+        return arr[(arr >= 0) & (arr < volume_size)]
+
+    ref = _valid_unique(ref_indices)
+    user = _valid_unique(user_indices)
+
+    if len(ref) + len(user) == 0:
+        return 1.0
+
+    volume_intersection = len(np.intersect1d(ref, user, assume_unique=True))
+    return float((2.0 * volume_intersection) / (len(ref) + len(user)))
+
+
+def cropped_dice_score(ref_indices, user_indices, bounding_box, target_shape=(295, 512, 512)):
+    """Calculate the Dice score using only the reference's bounding box.
+
+    User voxels outside the reference bounding box cannot intersect it, so the
+    intersection is computed on a small crop instead of the full volume, and
+    neither index list is sorted: voxels are counted by marking the crop, and
+    only user voxels outside the box are deduplicated. Results are identical to
+    `sparse_dice_score`; if a reference voxel lies outside the bounding box
+    (statistics of another reference version), that is used instead.
+
+    Args:
+        ref_indices: Flat indices of the reference mask
+        user_indices: Flat indices of the user mask
+        bounding_box (dict): Reference bounding box {"z": [min, max], "y": [...], "x": [...]}
+        target_shape (tuple): Shape of the full 3D volume (depth, height, width)
+
+    Returns:
+        float: Dice score in [0.0, 1.0]
+    """
+    depth, height, width = target_shape
+    volume_size = depth * height * width
+
+    def _valid(indices):
+        arr = np.asarray(indices, dtype=np.int64).reshape(-1)
+        return arr[(arr >= 0) & (arr < volume_size)]
+
+    ref = _valid(ref_indices)
+    user = _valid(user_indices)
+
+    if len(ref) + len(user) == 0:
+        return 1.0
+
+    (z0, z1), (y0, y1), (x0, x1) = bounding_box["z"], bounding_box["y"], bounding_box["x"]
+    z1, y1, x1 = min(z1, depth - 1), min(y1, height - 1), min(x1, width - 1)
+    if z0 > z1 or y0 > y1 or x0 > x1:
+        return sparse_dice_score(ref, user, target_shape)
+    crop_height, crop_width = y1 - y0 + 1, x1 - x0 + 1
+    crop_size = (z1 - z0 + 1) * crop_height * crop_width
+
+    def _to_crop(indices):
+        z = indices // (height * width)
+        remainder = indices % (height * width)
+        y = remainder // width
+        x = remainder % width
+        inside = (z >= z0) & (z <= z1) & (y >= y0) & (y <= y1) & (x >= x0) & (x <= x1)
+        return ((z[inside] - z0) * crop_height + (y[inside] - y0)) * crop_width + (x[inside] - x0), inside
+
+    ref_local, ref_inside = _to_crop(ref)
+    if not ref_inside.all():
+        print(f"[DEBUG] {int(np.count_nonzero(~ref_inside))} reference voxels outside the bounding box, scoring without it")
+        return sparse_dice_score(ref, user, target_shape)
+    ref_crop = np.zeros(crop_size, dtype=bool)
+    ref_crop[ref_local] = True
+    ref_count = int(np.count_nonzero(ref_crop))
+
+    user_local, user_inside = _to_crop(user)
+    user_crop = np.zeros(crop_size, dtype=bool)
+    user_crop[user_local] = True
+    user_count = int(np.count_nonzero(user_crop)) + len(np.unique(user[~user_inside]))
+
+    user_crop &= ref_crop
+    volume_intersection = int(np.count_nonzero(user_crop))
+    return float((2.0 * volume_intersection) / (ref_count + user_count))
@@ -0,0 +1,371 @@
+import os
+import sys
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+import pydicom
+
+from scorer import load_segmentation_indices, load_volume_geometry, load_reference_json, sanitize_name
+from reference_format import read_binary_reference, load_reference, REFERENCE_BINARY_EXT
+from reference_manifest import content_hash
+from reference_pack import ReferencePack, iter_reference_names
+from reference_store import load_pointers, load_version, reference_version
+from dicom_index import DicomIndex, open_header_cache
+from volume_geometry import VolumeGeometry
+
+# Checks every reference of a References folder (and optionally a pack) against
+# the DICOM object it was converted from: the indices are recomputed from the
+# source RTSTRUCT (Step 2 rasterizer) or SEG (frame-sparse reader) and compared by
+# voxel count and content hash with the version the scorer serves, with
+# references and sources processed in parallel. The JSON, binary and pack
+# copies of each reference are checked against that version.
+
+# Reference states
+OK, DRIFT, NO_SOURCE, ERROR = "ok", "drift", "no_source", "error"
+
+# Copies of a reference checked against the version the scorer serves
+COPIES = ("json", "binary", "pack")
+
+
+def file_name(name):
+    """A patient/structure name as the converters name reference files (alphanumerics, space, '_' and '-')."""
+    return "".join([c for c in str(name) if c.isalnum() or c in (' ', '_', '-')]).strip()
+
+
+def find_references(references_dir, pack_path=None):
+    """
+    Every reference of a References folder (in-place files and store pointers)
+    and of the reference pack, if one is given.
+
+    Returns:
+        list: {"patient_id", "structure_name", "references_dir", "json_path", "binary_path",
+               "version" (refs.json pointer), "pack_path"}, None where absent
+    """
+    names = set(iter_reference_names(references_dir)) if os.path.isdir(references_dir) else set()
+    packed = set()
+    if pack_path:
+        pack = ReferencePack(pack_path)
+        try:
+            packed = set(pack.keys())
+        finally:
+            pack.close()
+
+    references = []
+    pointers = {}
+    for patient, structure in sorted(names | packed):
+        patient_dir = os.path.join(references_dir, patient)
+        if patient not in pointers:
+            pointers[patient] = (load_pointers(patient_dir) if os.path.isdir(patient_dir) else None) or {"structures": {}}
+        entry = pointers[patient]["structures"].get(sanitize_name(structure))
+        json_path = os.path.join(patient_dir, structure + '.json')
+        binary_path = os.path.join(patient_dir, structure + REFERENCE_BINARY_EXT)
+        references.append({
+            "patient_id": patient,
+            "structure_name": structure,
+            "references_dir": str(references_dir),
+            "json_path": json_path if os.path.exists(json_path) else None,
+            "binary_path": binary_path if os.path.exists(binary_path) else None,
+            "version": entry["current"] if entry else None,
+            "pack_path": str(pack_path) if (patient, structure) in packed else None,
+        })
+    return references
+
+
+def find_sources(source_dirs, header_cache=None):
+    """
+    Index the RTSTRUCT ROIs and SEG segments of the source folders (searched recursively).
+    A single-segment SEG is named after its SeriesDescription, as Step 2 and
+    SEG_to_Ref.py name it, otherwise each segment after its SegmentLabel.
+
+    Returns:
+        dict: {(patient, structure): [{"kind": "rtstruct"|"seg", "path", "folder", "number"}]}
+    """
+    sources = {}
+
+    def add(patient_id, name, kind, path, number):
+        key = (file_name(patient_id or "UnknownPatient"), file_name(name))
+        sources.setdefault(key, []).append({"kind": kind, "path": path, "folder": os.path.dirname(path),
+                                            "number": int(number)})
+
+    for source_dir in source_dirs:
+        for root, _, files in os.walk(source_dir):
+            if not any(f.lower().endswith('.dcm') for f in files):
+                continue
+            index = DicomIndex.build(root, cache=header_cache)
+            for header in index.rtstructs():
+                for roi in header.dataset.get('StructureSetROISequence', []):
+                    add(header.patient_id, roi.get('ROIName', f"Unnamed_ROI_{roi.ROINumber}"),
+                        "rtstruct", header.path, roi.ROINumber)
+            for header in index.segmentations():
+                segments = list(header.dataset.get('SegmentSequence', []))
+                for segment in segments:
+                    name = str(segment.get('SegmentLabel', '') or f"Segment_{segment.SegmentNumber}")
+                    if len(segments) == 1 and header.dataset.get('SeriesDescription'):
+                        name = str(header.dataset.SeriesDescription)
+                    add(header.patient_id, name, "seg", header.path, segment.SegmentNumber)
+    return sources
+
+
+def digest(indices):
+    """(voxel count, content hash) of a set of indices."""
+    unique = np.unique(np.asarray(indices, dtype=np.int64))
+    return int(len(unique)), content_hash(unique)
+
+
+# Packs opened by this process, by path
+_packs = {}
+
+
+def pack_lookup(pack_path, patient_id, structure_name):
+    if pack_path not in _packs:
+        _packs[pack_path] = ReferencePack(pack_path)
+    return _packs[pack_path].lookup(patient_id, structure_name)
+
+
+def served_reference(reference):
+    """
+    (indices, origin) the scorer serves for a reference, resolved as
+    app.load_local_reference resolves it: the refs.json pointer's object, else
+    the pack entry, else the in-place .ref/.json.
+    """
+    references_dir, patient, structure = reference["references_dir"], reference["patient_id"], reference["structure_name"]
+    if reference["version"]:
+        return load_version(references_dir, reference["version"])
+    if not reference["version"] and reference["pack_path"]:
+        return pack_lookup(reference["pack_path"], patient, structure)
+    return load_reference(references_dir, patient, structure)
+
+
+def digest_reference(reference):
+    """
+    Worker: digest of the version the scorer serves for a reference, and whether
+    each copy of it (JSON, binary reference, pack entry) holds that version.
+
+    Returns:
+        dict: voxels, hash, version, and json, binary, pack
+              ("ok", "drift" or None where the copy does not exist)
+    """
+    indices, origin = served_reference(reference)
+    version = reference_version(indices, origin)
+    voxels, digest_hash = digest(indices)
+
+    def check(copy):
+        copy_indices, copy_origin = copy
+        return OK if copy_origin == origin and digest(copy_indices) == (voxels, digest_hash) else DRIFT
+
+    return {
+        "voxels": voxels,
+        "hash": digest_hash,
+        "version": version,
+        "json": check(load_reference_json(reference["references_dir"], reference["patient_id"], reference["structure_name"]))
+        if reference["json_path"] else None,
+        "binary": check(read_binary_reference(reference["binary_path"])) if reference["binary_path"] else None,
+        "pack": check(pack_lookup(reference["pack_path"], reference["patient_id"], reference["structure_name"]))
+        if reference["pack_path"] else None,
+    }
+
+
+def guarded(function, item):
+    """Run function(item) as (result, None), or (None, error message) if it raises."""
+    try:
+        return function(item), None
+    except Exception as e:
+        return None, str(e)
+
+
+def folder_geometry(folder):
+    """Sorted unique CT Z positions of a folder, as the converters build the reference volume."""
+    cts = DicomIndex.build(folder).images('CT')
+    if not cts:
+        raise ValueError(f"No CT series in {folder} to build the reference geometry from")
+    return VolumeGeometry.from_positions([ct.position[2] for ct in cts], cts[0].dimensions)
+
+
+def recompute_source(task):
+    """
+    Worker: recompute the indices of the wanted ROIs or segments of one source file.
+
+    task: {"kind", "path", "folder", "numbers": [ROI or segment numbers],
+           "geometry": recorded volume geometry dict, or None to use the folder's CT series}
+    Returns:
+        dict: {(patient, structure): (voxels, hash)}
+    """
+    if task["geometry"]:
+        geometry = VolumeGeometry(task["geometry"]["slice_positions"],
+                                  (task["geometry"]["rows"], task["geometry"]["columns"]))
+    else:
+        geometry = folder_geometry(task["folder"])
+
+    if task["kind"] == "seg":
+        dcm = pydicom.dcmread(task["path"])
+        segments = list(dcm.get('SegmentSequence', []))
+        patient_id = file_name(dcm.get('PatientID') or "UnknownPatient")
+        digests = {}
+        for segment in segments:
+            number = int(segment.SegmentNumber)
+            if number not in task["numbers"]:
+                continue
+            name = str(segment.get('SegmentLabel', '') or f"Segment_{number}")
+            if len(segments) == 1 and dcm.get('SeriesDescription'):
+                name = str(dcm.SeriesDescription)
+            indices = load_segmentation_indices(dcm, geometry.slice_positions, geometry.dimensions,
+                                                segment_number=number)
+            digests[(patient_id, file_name(name))] = digest(indices)
+        return digests
+
+    # Imported here: only RTSTRUCT sources need the Step 2 converter (and highdicom)
+    from ingest import _load_step2
+    converted = _load_step2().process_rtstruct(task["path"], task["folder"], target_roi_numbers=task["numbers"],
+                                               write_seg=False, reference_geometry=geometry)
+    return {(file_name(c["patient_id"]), file_name(c["structure_name"])): digest(c["indices"]) for c in converted}
+
+
+def verify_references(references_dir, source_dirs, workers=None, header_cache=None, pack_path=None):
+    """
+    Compare every reference with the source it was converted from.
+
+    Each reference is checked at the version the scorer serves (see
+    served_reference). It is "ok" if its voxel count and content hash match one
+    of its sources (several RTSTRUCTs or SEGs may hold the same structure),
+    "drift" if none matches or one of its copies (JSON, binary reference,
+    pack entry) holds another version than the served one, "no_source" if
+    no RTSTRUCT ROI or SEG segment of that patient and structure was found, and
+    "error" if it or all of its sources could not be read.
+
+    References and source files are processed in `workers` processes
+    (default: all cores; 1 = sequential).
+
+    Returns:
+        dict: Report with references_dir, the count per state and a result per reference
+    """
+    references = find_references(references_dir, pack_path)
+    sources = find_sources(source_dirs, header_cache)
+
+    # One task per source file, for the ROIs/segments that have a reference
+    tasks = {}
+    for reference in references:
+        key = (file_name(reference["patient_id"]), file_name(reference["structure_name"]))
+        for source in sources.get(key, []):
+            task = tasks.setdefault(source["path"], {"kind": source["kind"], "path": source["path"],
+                                                     "folder": source["folder"], "numbers": [], "geometry": None})
+            if source["number"] not in task["numbers"]:
+                task["numbers"].append(source["number"])
+            if task["geometry"] is None:
+                try:
+                    task["geometry"] = load_volume_geometry(references_dir, reference["patient_id"])
+                except FileNotFoundError:
+                    pass
+
+    workers = workers or os.cpu_count() or 1
+    task_list = list(tasks.values())
+    if workers > 1 and len(references) + len(task_list) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Both maps are submitted before either is collected
+            digests = executor.map(guarded, repeat(digest_reference), references)
+            recomputed = executor.map(guarded, repeat(recompute_source), task_list)
+            digests, recomputed = list(digests), list(recomputed)
+    else:
+        digests = [guarded(digest_reference, r) for r in references]
+        recomputed = [guarded(recompute_source, t) for t in task_list]
+
+    by_path = {task["path"]: result for task, result in zip(task_list, recomputed)}
+
+    report = {"references_dir": str(references_dir), "checked": len(references),
+              OK: 0, DRIFT: 0, NO_SOURCE: 0, ERROR: 0, "results": []}
+    for reference, (reference_digest, reference_error) in zip(references, digests):
+        key = (file_name(reference["patient_id"]), file_name(reference["structure_name"]))
+        result = {
+            "patient_id": reference["patient_id"],
+            "structure_name": reference["structure_name"],
+            "status": None,
+            "reference_voxels": reference_digest["voxels"] if reference_digest else None,
+            "version": reference_digest["version"] if reference_digest else None,
+            "sources": [],
+        }
+        for copy in COPIES:
+            result[copy] = reference_digest[copy] if reference_digest else None
+
+        for source in sources.get(key, []):
+            source_digests, source_error = by_path[source["path"]]
+            entry = {"kind": source["kind"], "path": source["path"], "voxels": None, "match": False}
+            if source_error is not None:
+                entry["error"] = source_error
+            else:
+                # A structure without voxels in the reference volume is not converted
+                voxels, source_hash = source_digests.get(key, (0, None))
+                entry["voxels"] = voxels
+                entry["match"] = reference_digest is not None and \
+                    (voxels, source_hash) == (reference_digest["voxels"], reference_digest["hash"])
+            result["sources"].append(entry)
+
+        if reference_error is not None:
+            result["status"], result["error"] = ERROR, reference_error
+        elif not result["sources"]:
+            result["status"] = NO_SOURCE
+        elif any(result[copy] == DRIFT for copy in COPIES):
+            result["status"] = DRIFT
+        elif any(s["match"] for s in result["sources"]):
+            result["status"] = OK
+        elif all("error" in s for s in result["sources"]):
+            result["status"] = ERROR
+        else:
+            result["status"] = DRIFT
+
+        report[result["status"]] += 1
+        report["results"].append(result)
+    return report
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Check that the references still match their source RTSTRUCTs and SEGs.")
+    parser.add_argument("references_dir", nargs="?", default=os.path.join(script_dir, "References"))
+    parser.add_argument("--sources", nargs="+", default=[os.path.join(script_dir, "Data to be converted")],
+                        help="Folders holding the RTSTRUCTs/SEGs with their CT series (searched recursively)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: all cores; 1 = sequential)")
+    parser.add_argument("--pack", help="Also check the references of this reference pack")
+    parser.add_argument("--report", help="Also write the full report as JSON to this path")
+    parser.add_argument("--no_header_cache", action="store_true",
+                        help="Read every DICOM header instead of using the shared header cache")
+    args = parser.parse_args()
+
+    header_cache = None if args.no_header_cache else open_header_cache()
+    report = verify_references(args.references_dir, args.sources, workers=args.workers, header_cache=header_cache,
+                               pack_path=args.pack)
+
+    for result in report["results"]:
+        if result["status"] == OK:
+            continue
+        name = f"{result['patient_id']}/{result['structure_name']}"
+        if result["status"] == NO_SOURCE:
+            print(f"NO SOURCE  {name}")
+        elif result["status"] == ERROR:
+            errors = [result.get("error")] if result.get("error") else [s.get("error") for s in result["sources"]]
+            print(f"ERROR      {name}: {'; '.join(e for e in errors if e)}")
+        else:
+            details = [f"reference {result['reference_voxels']} voxels (version {result['version'][:12]})"]
+            if result["json"] == DRIFT:
+                details.append("JSON differs from the served version")
+            if result["binary"] == DRIFT:
+                details.append("binary reference differs from the served version")
+            if result["pack"] == DRIFT:
+                details.append("pack entry differs from the served version")
+            details.extend(f"{os.path.basename(s['path'])} {s['voxels']} voxels" for s in result["sources"]
+                           if s["voxels"] is not None and not s["match"])
+            print(f"DRIFT      {name}: {', '.join(details)}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    print(f"Checked {report['checked']} references: {report[OK]} ok, {report[DRIFT]} drift, "
+          f"{report[NO_SOURCE]} without source, {report[ERROR]} errors.")
+    return 1 if report[DRIFT] or report[ERROR] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
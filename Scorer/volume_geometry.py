@@ -0,0 +1,140 @@
+import numpy as np
+
+
+class VolumeGeometry:
+    """Slice positions of one image series with vectorized nearest-slice queries.
+
+    Slice i is the i-th of the given Z positions (NaN for a slice without a
+    position), so callers keep their own slice order. Queries run on a sorted
+    copy built once, with np.searchsorted, for any number of positions at a time.
+    """
+
+    def __init__(self, z_positions, dimensions=None):
+        self.z_positions = np.asarray(z_positions, dtype=np.float64).reshape(-1)
+        self.dimensions = (int(dimensions[0]), int(dimensions[1])) if dimensions is not None else None
+
+        valid = np.flatnonzero(~np.isnan(self.z_positions))
+        self._order = valid[np.argsort(self.z_positions[valid], kind='stable')]
+        self._sorted_zs = self.z_positions[self._order]
+
+    @classmethod
+    def from_positions(cls, z_positions, dimensions=None):
+        """Geometry of the sorted unique positions (slice 0 is the lowest Z), as the converters index volumes."""
+        return cls(sorted(set(float(z) for z in z_positions)), dimensions)
+
+    def __len__(self):
+        return len(self.z_positions)
+
+    @property
+    def slice_positions(self):
+        """Z positions as a list of floats, in slice order."""
+        return self.z_positions.tolist()
+
+    @property
+    def slice_spacing(self):
+        """Distance between the two lowest slices, or None for fewer than two slices."""
+        if len(self._sorted_zs) < 2:
+            return None
+        return float(self._sorted_zs[1] - self._sorted_zs[0])
+
+    def nearest(self, positions):
+        """
+        Nearest slice of each Z position (ties go to the lower Z).
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): Slice indices (int64) and absolute distances;
+            -1 and inf for every position if the geometry has no slices
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1)
+        zs = self._sorted_zs
+        if len(zs) == 0:
+            return np.full(len(positions), -1, dtype=np.int64), np.full(len(positions), np.inf)
+
+        right = np.clip(np.searchsorted(zs, positions), 0, len(zs) - 1)
+        left = np.maximum(right - 1, 0)
+        take_left = np.abs(zs[left] - positions) <= np.abs(zs[right] - positions)
+        nearest_sorted = np.where(take_left, left, right)
+        distances = np.abs(zs[nearest_sorted] - positions)
+        return self._order[nearest_sorted].astype(np.int64), distances
+
+    def lookup(self, positions, tolerance=0.5):
+        """Slice index of each Z position, -1 where no slice is within `tolerance`."""
+        indices, distances = self.nearest(positions)
+        indices[~(distances <= tolerance)] = -1
+        return indices
+
+    def index_of(self, z, tolerance=0.5):
+        """Slice index of one Z position, or None if no slice is within `tolerance`."""
+        index = int(self.lookup([z], tolerance)[0])
+        return index if index >= 0 else None
+
+
+class PhysicalToIndexTransform:
+    """Affine map from patient coordinates (mm) to continuous voxel indices.
+
+    Same mapping as ITK's TransformPhysicalPointToContinuousIndex,
+    index = (direction * diag(spacing))^-1 * (point - origin), with the matrix
+    inverted once so any number of points map in one matrix multiply.
+    """
+
+    def __init__(self, origin, spacing, direction):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        direction = np.asarray(direction, dtype=np.float64).reshape(3, 3)
+        self.matrix = np.linalg.inv(direction * np.asarray(spacing, dtype=np.float64))
+
+    @classmethod
+    def from_itk_image(cls, image):
+        return cls(image.GetOrigin(), image.GetSpacing(), image.GetDirection())
+
+    def __call__(self, points):
+        """
+        Args:
+            points: (N, 3) patient coordinates
+        Returns:
+            numpy.ndarray: (N, 3) continuous (x, y, z) indices
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        return (points - self.origin) @ self.matrix.T
+
+
+class SeriesGeometry:
+    """Origin, spacing, direction and size (x, y, z) of an image series, as ITK reports them.
+
+    from_headers derives them from the slice headers alone (ImagePositionPatient,
+    ImageOrientationPatient, PixelSpacing, Rows/Columns), without decoding a voxel.
+    """
+
+    def __init__(self, origin, spacing, direction, size):
+        self.origin = tuple(float(v) for v in origin)
+        self.spacing = tuple(float(v) for v in spacing)
+        self.direction = tuple(float(v) for v in direction)
+        self.size = tuple(int(v) for v in size)
+
+    @classmethod
+    def from_headers(cls, headers):
+        """
+        Args:
+            headers: dicom_index.DicomHeader of every slice, sorted along the slice normal
+        """
+        first, last = headers[0], headers[-1]
+        orientation = first.orientation or (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+        row, column = np.array(orientation[:3]), np.array(orientation[3:])
+        normal = np.cross(row, column)
+
+        row_spacing, column_spacing = first.pixel_spacing or (1.0, 1.0)
+        if len(headers) > 1:
+            slice_spacing = float(np.dot(np.subtract(last.position, first.position), normal)) / (len(headers) - 1)
+        else:
+            slice_spacing = 1.0
+
+        rows, columns = first.dimensions
+        direction = np.column_stack([row, column, normal]).reshape(-1)
+        return cls(first.position, (column_spacing, row_spacing, slice_spacing), direction, (columns, rows, len(headers)))
+
+    @classmethod
+    def from_itk_image(cls, image):
+        return cls(image.GetOrigin(), image.GetSpacing(), image.GetDirection(), image.GetSize())
+
+    def to_index(self):
+        """The PhysicalToIndexTransform of the series."""
+        return PhysicalToIndexTransform(self.origin, self.spacing, self.direction)
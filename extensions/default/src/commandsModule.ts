@@ -1064,6 +1064,8 @@ const commandsModule = ({
           reference_mask_data: 'placeholder_for_backend_lookup',
           patient_id: context.patientId,
           structure_name: context.structureName,
+          // Per-slice run-length overlay instead of every reference voxel index
+          reference_format: 'rle',
         };
 
         const response = await fetch('http://localhost:5001/grade_submission', {
@@ -1089,7 +1091,7 @@ const commandsModule = ({
         (window as any).ohifDiceScore = diceScore;
 
         // --- REVEAL REFERENCE CONTOUR ---
-        if (referenceData && referenceData.non_zero_indices) {
+        if (referenceData && (referenceData.slices || referenceData.non_zero_indices)) {
           try {
             console.log('Revealing pre-loaded reference segmentation on ALL viewports...');
 